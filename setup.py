@@ -91,6 +91,7 @@ setup(name='protect',
       license='Apache',
       install_requires=[
           'PyYAML',
+          'numpy',
           'pandas==0.19.2'
       ],
       tests_require=[
@@ -15,6 +15,7 @@
 from __future__ import print_function
 from protect.addons.common import TCGAToGTEx
 from protect.common import export_results, get_files_from_filestore, untargz
+from protect.expression_profiling.rsem import load_gene_expression
 from protect.haplotyping.phlat import parse_phlat_file
 
 import os
@@ -31,8 +32,10 @@ def run_car_t_validity_assessment(job, rsem_files, univ_options, reports_options
     :return: The results of running assess_car_t_validity
     :rtype: toil.fileStore.FileID
     """
-    return job.addChildJobFn(assess_car_t_validity, rsem_files['rsem.genes.results'],
-                             univ_options, reports_options).rv()
+    # Prefer the expression table, falling back to the rsem gene results
+    gene_expression = rsem_files.get('rsem.expression.npz') or rsem_files['rsem.genes.results']
+    return job.addChildJobFn(assess_car_t_validity, gene_expression, univ_options,
+                             reports_options).rv()
 
 
 def assess_car_t_validity(job, gene_expression, univ_options, reports_options):
@@ -42,7 +45,8 @@ def assess_car_t_validity(job, gene_expression, univ_options, reports_options):
     It also gives a list of clinical trials available for other types of cancer with the same
     overexpressed gene.
 
-    :param toil.fileStore.FileID gene_expression: The resm gene expression
+    :param toil.fileStore.FileID gene_expression: The expression table from make_expression_table
+           or the rsem gene expression
     :param dict univ_options: Dict of universal options used by almost all tools
     :param dict reports_options: Options specific to reporting modules
     :return: The results of running assess_car_t_validity
@@ -62,89 +66,126 @@ def assess_car_t_validity(job, gene_expression, univ_options, reports_options):
                                                  work_dir)
 
     target_data = pd.read_table(input_files['car_t_targets.tsv'], index_col=0)
-    patient_df = pd.read_csv('rsem_quant.tsv', sep=' ', delimiter='\t', header='infer', index_col=0)
-    patient_df.index = (patient_df.index).str.replace('\\..*$', '')
+    with open('car_t_target_report.txt', 'w') as car_t_report:
+        write_car_t_validity_report(load_gene_expression(input_files['rsem_quant.tsv']),
+                                    target_data, tumor_type, car_t_report)
+
+    output_file = job.fileStore.writeGlobalFile(car_t_report.name)
+    export_results(job, output_file, car_t_report.name, univ_options, subfolder='reports')
+    return output_file
+
+
+def _observed_expression(gene_expression, genes):
+    """
+    Get the formatted TPM of each gene, or 'NA' if it has no expression value.
+
+    :param pandas.DataFrame gene_expression: The gene expression from load_gene_expression
+    :param pandas.Series genes: The genes
+    :return: The formatted TPMs
+    :rtype: list
+    """
+    tpm = gene_expression['TPM'].reindex(genes.values)
+    return list(tpm.map('{0:.2f}'.format).where(tpm.index.isin(gene_expression.index), 'NA'))
 
-    overexpressed = []
+
+def write_car_t_validity_report(gene_expression, target_data, tumor_type, car_t_report):
+    """
+    Write the report on the available clinical trials and scientific literature for the
+    overexpressed CAR-T targets in the tumor type, and for other cancers with the same overexpressed
+    targets.
+
+    :param pandas.DataFrame gene_expression: The gene expression from load_gene_expression
+    :param pandas.DataFrame target_data: The car t targets table
+    :param str tumor_type: The TCGA tumor type of the patient
+    :param file car_t_report: An open file descriptor to the report
+    :return: None
+    """
     # Check if the tumor has a corresponding normal
     try:
         tissue_of_origin = TCGAToGTEx[tumor_type]
     except KeyError:
         tissue_of_origin = 'NA'
-    # Write the report
-    with open('car_t_target_report.txt', 'w') as car_t_report:
-        #print(target_data.index, file=car_t_report)
-        if tissue_of_origin in target_data.index:
-            print('Available clinical trials for ' + str.lower(tissue_of_origin) +
-                  ' cancer with GTEX and TCGA median values', file=car_t_report)
-
-            print(('\t{:10}{:<10}{:<10}{:<10}{:<40}{:<12}\n'.format('Gene', 'GTEX',
-                                                                    'TCGA N', 'Observed',
-                                                                    'DOI for gene papers',
-                                                                    'Clinical Trials')),
-                                                                     file=car_t_report)
-            collected_values = []
-            # Get the gene name, GTEX, TCGA, and observed values
-            for index, row in target_data.iterrows():
-                if index == tissue_of_origin:
-                    gene = row['ENSG']
-                    gtex = '{0:.2f}'.format(float(row['GTEX']))
-                    tcga = '{0:.2f}'.format(float(row['TCGA']))
-                    observed = '{0:.2f}'.format(
-                        float(patient_df.loc[gene, 'TPM'])) if gene in patient_df.index else 'NA'
-                    doi = row['DOI']
-                    target = str.upper(row['TARGET'])
-                    clinical_trial = row['Clinical trials']
-                    collection = [target, gtex, tcga, observed, doi, clinical_trial]
-                    collected_values.append(collection)
-                    if observed != 'NA':
-                        if float(gtex) <= float(observed) or float(tcga) <= float(observed):
-                            overexpressed.append(gene)
-
-            collected_values = sorted(collected_values, key=lambda col: float(col[3]), reverse=True)
-            for entry in collected_values:
-                print(('\t{:10}{:<10}{:<10}{:<10}{:<40}{:<12}'.format(entry[0],
-                                                                      entry[1], entry[2],
-                                                                      str(entry[3]), entry[4],
-                                                                      entry[5])), file=car_t_report)
-
-            print('\nBased on the genes overexpressed in this cancer type, here\'s a list of clinical '
-                 'trials for other types of cancer', file=car_t_report)
-            if len(overexpressed) != 0:
-                # Check if there are other clinical trials for other cancer types
-                print(('\t{:10}{:<10}{:<10}{:<10}{:<40}{:<17}{:<20}\n'.format('Gene', 'GTEX',
-                                                                              'TCGA N', 'Observed',
-                                                                              'DOI for gene papers',
-                                                                              'Clinical Trials',
-                                                                              'Cancer')),
-                                                                              file=car_t_report)
-                other_trials = []
-                for index, row in target_data.iterrows():
-                    if row['ENSG'] in overexpressed and index != tissue_of_origin:
-                        gene = row['ENSG']
-                        gtex = '{0:.2f}'.format(float(row['GTEX']))
-                        tcga = '{0:.2f}'.format(float(row['TCGA']))
-                        doi = row['DOI']
-                        target = str.upper(row['TARGET'])
-                        observed = '{0:.2f}'.format(
-                            float(patient_df.loc[gene, 'TPM'])) if gene in patient_df.index else 'NA'
-                        collected_values = [target, gtex, tcga, observed, doi, row['Clinical trials'],
-                                            index]
-                        other_trials.append(collected_values)
-
-                other_trials = sorted(other_trials, key=lambda col: col[0])
-                for entry in other_trials:
-                    print(('\t{:10}{:<10}{:<10}{:<10}{:<40}{:<17}{:<20}'.format(entry[0], entry[1],
-                                                                                entry[2], entry[3],
-                                                                                entry[4], entry[5],
-                                                                                entry[6])),
-                                                                                file=car_t_report)
-            else:
-                print("Data not available", file=car_t_report)
-
-        else:
-            print('Data not available for ' + tumor_type, file=car_t_report)
-
-    output_file = job.fileStore.writeGlobalFile(car_t_report.name)
-    export_results(job, output_file, car_t_report.name, univ_options, subfolder='reports')
-    return output_file
+    if tissue_of_origin not in target_data.index:
+        print('Data not available for ' + tumor_type, file=car_t_report)
+        return None
+    print('Available clinical trials for ' + str.lower(tissue_of_origin) +
+          ' cancer with GTEX and TCGA median values', file=car_t_report)
+
+    print(('\t{:10}{:<10}{:<10}{:<10}{:<40}{:<12}\n'.format('Gene', 'GTEX',
+                                                            'TCGA N', 'Observed',
+                                                            'DOI for gene papers',
+                                                            'Clinical Trials')),
+                                                             file=car_t_report)
+    # Get the gene name, GTEX, TCGA, and observed values
+    in_tissue = target_data.index == tissue_of_origin
+    rows = target_data[in_tissue]
+    collected_values = [[str.upper(target), '{0:.2f}'.format(float(gtex)),
+                         '{0:.2f}'.format(float(tcga)), observed, doi, clinical_trial]
+                        for target, gtex, tcga, observed, doi, clinical_trial in
+                        zip(rows['TARGET'], rows['GTEX'], rows['TCGA'],
+                            _observed_expression(gene_expression, rows['ENSG']), rows['DOI'],
+                            rows['Clinical trials'])]
+    calls = car_t_overexpression(gene_expression[['TPM']], target_data, tumor_type)['TPM']
+    overexpressed = list(rows['ENSG'][calls.values])
+
+    collected_values = sorted(collected_values, key=lambda col: float(col[3])
+                              if col[3] != 'NA' else float('-inf'), reverse=True)
+    for entry in collected_values:
+        print(('\t{:10}{:<10}{:<10}{:<10}{:<40}{:<12}'.format(entry[0],
+                                                              entry[1], entry[2],
+                                                              str(entry[3]), entry[4],
+                                                              entry[5])), file=car_t_report)
+
+    print('\nBased on the genes overexpressed in this cancer type, here\'s a list of clinical '
+          'trials for other types of cancer', file=car_t_report)
+    if len(overexpressed) != 0:
+        # Check if there are other clinical trials for other cancer types
+        print(('\t{:10}{:<10}{:<10}{:<10}{:<40}{:<17}{:<20}\n'.format('Gene', 'GTEX',
+                                                                      'TCGA N', 'Observed',
+                                                                      'DOI for gene papers',
+                                                                      'Clinical Trials',
+                                                                      'Cancer')),
+                                                                      file=car_t_report)
+        rows = target_data[target_data['ENSG'].isin(overexpressed).values & ~in_tissue]
+        other_trials = [[str.upper(target), '{0:.2f}'.format(float(gtex)),
+                         '{0:.2f}'.format(float(tcga)), observed, doi, clinical_trial, cancer]
+                        for target, gtex, tcga, observed, doi, clinical_trial, cancer in
+                        zip(rows['TARGET'], rows['GTEX'], rows['TCGA'],
+                            _observed_expression(gene_expression, rows['ENSG']), rows['DOI'],
+                            rows['Clinical trials'], rows.index)]
+
+        other_trials = sorted(other_trials, key=lambda col: col[0])
+        for entry in other_trials:
+            print(('\t{:10}{:<10}{:<10}{:<10}{:<40}{:<17}{:<20}'.format(entry[0], entry[1],
+                                                                        entry[2], entry[3],
+                                                                        entry[4], entry[5],
+                                                                        entry[6])),
+                                                                        file=car_t_report)
+    else:
+        print("Data not available", file=car_t_report)
+    return None
+
+
+def car_t_overexpression(expression, target_data, tumor_type):
+    """
+    Find the CAR-T targets for the tissue of origin of the tumor type that are overexpressed in any
+    number of samples at once.  A target is overexpressed if it is expressed at or above either its
+    GTEx or its TCGA normal median.
+
+    :param pandas.DataFrame expression: TPMs of the samples with genes as rows and one column per
+           sample
+    :param pandas.DataFrame target_data: The car t targets table
+    :param str tumor_type: The TCGA tumor type of the samples
+    :return: Whether each target is overexpressed (targets for the tissue, in table order, indexed
+             by ENSG x samples), or None if there is no data for the tumor type
+    :rtype: pandas.DataFrame|None
+    """
+    tissue_of_origin = TCGAToGTEx.get(tumor_type, 'NA')
+    if tissue_of_origin not in target_data.index:
+        return None
+    rows = target_data[target_data.index == tissue_of_origin]
+    # Missing values are NaN, and compare False
+    observed = expression.reindex(rows['ENSG'].values).round(2).values
+    overexpressed = ((rows['GTEX'].astype(float).round(2).values[:, None] <= observed) |
+                     (rows['TCGA'].astype(float).round(2).values[:, None] <= observed))
+    return pd.DataFrame(overexpressed, index=rows['ENSG'].values, columns=expression.columns)
@@ -15,8 +15,10 @@
 from __future__ import print_function
 from protect.addons.common import TCGAToGTEx
 from protect.common import export_results, get_files_from_filestore, untargz
+from protect.expression_profiling.rsem import load_gene_expression
 
 import json
+import numpy as np
 import os
 import pandas as pd
 import textwrap
@@ -32,8 +34,10 @@ def run_itx_resistance_assessment(job, rsem_files, univ_options, reports_options
     :return: The results of running assess_itx_resistance
     :rtype: toil.fileStore.FileID
     """
-    return job.addChildJobFn(assess_itx_resistance, rsem_files['rsem.genes.results'],
-                             univ_options, reports_options).rv()
+    # Prefer the expression table, falling back to the rsem gene results
+    gene_expression = rsem_files.get('rsem.expression.npz') or rsem_files['rsem.genes.results']
+    return job.addChildJobFn(assess_itx_resistance, gene_expression, univ_options,
+                             reports_options).rv()
 
 
 def assess_itx_resistance(job, gene_expression, univ_options, reports_options):
@@ -41,7 +45,8 @@ def assess_itx_resistance(job, gene_expression, univ_options, reports_options):
     Assess the prevalence of the various genes in various cancer pathways and return a report in the txt
     format.
 
-    :param toil.fileStore.FileID gene_expression: fsID for the rsem gene expression file
+    :param toil.fileStore.FileID gene_expression: fsID for the expression table from
+           make_expression_table or the rsem gene expression file
     :param dict univ_options: Dict of universal options used by almost all tools
     :param dict reports_options: Options specific to reporting modules
     :return: The fsID for the itx resistance report file
@@ -67,61 +72,108 @@ def assess_itx_resistance(job, gene_expression, univ_options, reports_options):
     with open(input_files['immune_resistance_pathways.json']) as json_file:
         json_data = json.load(json_file)
 
-    # Read patient file
-    patient_df = pd.read_csv('rsem_quant.tsv', sep=' ', delimiter='\t', header='infer', index_col=0)
-    patient_df.index = (patient_df.index).str.replace('\\..*$', '')
-
     with open('immunotherapy_resistance_report.txt', 'w') as report_file:
-        # Check if data exsits for specified tumor type
-        try:
-            pathways = json_data['Cancer_to_pathway'][tumor_type]
-        except KeyError:
-            print('Data not available for ' + tumor_type, file=report_file)
-        else:
-            # If data exists, write a report
-            for pathway in pathways:
-                up_is_good = json_data['Pathways'][pathway]['up_is_good']
-
-                if up_is_good:
-                    comp_fn = lambda x, y: x >= y
-                else:
-                    comp_fn = lambda x, y: x < y
-
-                # Describe pathway and genes for it
-                print('Pathway: ' + pathway + '\n', file=report_file)
-                print ('Papers: ' + json_data['Pathways'][pathway]['paper'], file=report_file)
-                description = json_data['Pathways'][pathway]['description']
-                print('Description of pathway:\n' + textwrap.fill(description, width=100),
-                      file=report_file)
-                print('Pathway genes: ', file=report_file)
-                print('\t{:10}{:<20}{:<20}{:<12}'.format('Gene', 'GTEX Median',
-                                                         'TCGA N Median', 'Observed'),
-                                                         file=report_file)
-                status = []
-                # Write TCGA, GTEX, and observed values
-                for gene in json_data['Pathways'][pathway]['genes']:
-                    gtex = '{0:.2f}'.format(
-                            float(full_data.loc[gene, TCGAToGTEx[tumor_type]])) \
-                            if gene in full_data.index else 'NA'
-                    tcga = '{0:.2f}'.format(
-                            float(full_data.loc[gene, tumor_type + ' normal'])) \
-                            if gene in full_data.index else 'NA'
-                    tpm_value = '{0:.2f}'.format(float(patient_df.loc[gene, 'TPM'])) \
-                                if gene in patient_df.index else 'NA'
-                    ensg = json_data['Pathways'][pathway]['genes'][gene]
-                    print('\t{:10}{:<20}{:<20}{:<12}'.format(ensg, gtex, tcga, tpm_value),
-                          file=report_file)
-                    if gtex != 'NA' and tpm_value != 'NA':
-                        tcga_bool = comp_fn(float(tpm_value), float(tcga))
-                        gtex_bool = comp_fn(float(tpm_value), float(gtex))
-                        status.append(tcga_bool and gtex_bool)
-                    else:
-                        status.append(False)
-
-                # Based on the number of genes with expression values above normal, assess the status
-                print ('Status: ' + json_data['Pathways'][pathway]['status'][
-                    str(sum(status) >= 0.75 * len(status))] + '\n', file=report_file)
+        write_itx_resistance_report(load_gene_expression(input_files['rsem_quant.tsv']),
+                                    full_data, json_data, tumor_type, report_file)
 
     output_file = job.fileStore.writeGlobalFile(report_file.name)
     export_results(job, output_file, report_file.name, univ_options, subfolder='reports')
     return output_file
+
+
+def write_itx_resistance_report(gene_expression, full_data, json_data, tumor_type, report_file):
+    """
+    Write the immunotherapy resistance report assessing the status of each resistance pathway for
+    the tumor type from the expression of its genes against their TCGA normal and GTEx backgrounds.
+
+    :param pandas.DataFrame gene_expression: The gene expression from load_gene_expression
+    :param pandas.DataFrame full_data: The itx resistance background table
+    :param dict json_data: The immune resistance pathway descriptions
+    :param str tumor_type: The TCGA tumor type of the patient
+    :param file report_file: An open file descriptor to the report
+    :return: None
+    """
+    # Check if data exsits for specified tumor type
+    try:
+        pathways = json_data['Cancer_to_pathway'][tumor_type]
+    except KeyError:
+        print('Data not available for ' + tumor_type, file=report_file)
+        return None
+    full_data = full_data[~full_data.index.duplicated()]
+    backgrounds = {'gtex': TCGAToGTEx.get(tumor_type), 'tcga': tumor_type + ' normal'}
+    statuses = itx_pathway_calls(gene_expression[['TPM']], full_data, json_data, tumor_type)['TPM']
+    # If data exists, write a report
+    for pathway in pathways:
+        # Describe pathway and genes for it
+        print('Pathway: ' + pathway + '\n', file=report_file)
+        print ('Papers: ' + json_data['Pathways'][pathway]['paper'], file=report_file)
+        description = json_data['Pathways'][pathway]['description']
+        print('Description of pathway:\n' + textwrap.fill(description, width=100),
+              file=report_file)
+        print('Pathway genes: ', file=report_file)
+        print('\t{:10}{:<20}{:<20}{:<12}'.format('Gene', 'GTEX Median',
+                                                 'TCGA N Median', 'Observed'),
+                                                 file=report_file)
+        genes = list(json_data['Pathways'][pathway]['genes'])
+        # Write TCGA, GTEX, and observed values
+        values = {}
+        for name, column, table in (('gtex', backgrounds['gtex'], full_data),
+                                    ('tcga', backgrounds['tcga'], full_data),
+                                    ('tpm', 'TPM', gene_expression)):
+            if column in table.columns:
+                value = table[column].reindex(genes)
+                values[name] = value.map('{0:.2f}'.format).where(value.index.isin(table.index),
+                                                                 'NA')
+            else:
+                values[name] = pd.Series('NA', index=genes)
+        for gene, gtex, tcga, tpm_value in zip(genes, values['gtex'], values['tcga'],
+                                               values['tpm']):
+            ensg = json_data['Pathways'][pathway]['genes'][gene]
+            print('\t{:10}{:<20}{:<20}{:<12}'.format(ensg, gtex, tcga, tpm_value),
+                  file=report_file)
+
+        # Based on the number of genes with expression values above normal, assess the status
+        print ('Status: ' + json_data['Pathways'][pathway]['status'][
+            str(bool(statuses[pathway]))] + '\n', file=report_file)
+    return None
+
+
+def itx_pathway_calls(expression, full_data, json_data, tumor_type):
+    """
+    Assess the status of each immunotherapy resistance pathway for the tumor type for any number of
+    samples at once.  A pathway is called (True) in a sample if at least 75% of its genes are
+    expressed beyond both their TCGA normal and GTEx backgrounds, in the direction given by
+    `up_is_good`.
+
+    :param pandas.DataFrame expression: TPMs of the samples with genes as rows and one column per
+           sample
+    :param pandas.DataFrame full_data: The itx resistance background table
+    :param dict json_data: The immune resistance pathway descriptions
+    :param str tumor_type: The TCGA tumor type of the samples
+    :return: The status of each pathway (pathways x samples), or None if there is no data for the
+             tumor type
+    :rtype: pandas.DataFrame|None
+    """
+    try:
+        pathways = json_data['Cancer_to_pathway'][tumor_type]
+    except KeyError:
+        return None
+    full_data = full_data[~full_data.index.duplicated()]
+    backgrounds = {'gtex': TCGAToGTEx.get(tumor_type), 'tcga': tumor_type + ' normal'}
+    statuses = pd.DataFrame(False, index=pathways, columns=expression.columns)
+    for pathway in pathways:
+        genes = list(json_data['Pathways'][pathway]['genes'])
+        # Missing values are NaN, and compare False either way
+        tpm = expression.reindex(genes).round(2).values
+        gene_calls = np.ones(tpm.shape, dtype=bool)
+        for column in backgrounds.values():
+            if column in full_data.columns:
+                background = full_data[column].reindex(genes).astype(float).round(2).values[:, None]
+            else:
+                background = np.full((len(genes), 1), np.nan)
+            if json_data['Pathways'][pathway]['up_is_good']:
+                gene_calls &= tpm >= background
+            else:
+                gene_calls &= tpm < background
+        statuses.loc[pathway] = gene_calls.sum(axis=0) >= 0.75 * len(genes)
+    return statuses
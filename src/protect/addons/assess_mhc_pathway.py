@@ -13,12 +13,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from __future__ import print_function
-from collections import Counter
 from protect.addons.common import TCGAToGTEx
 from protect.common import export_results, get_files_from_filestore, untargz
+from protect.expression_profiling.rsem import load_gene_expression
 from protect.haplotyping.phlat import parse_phlat_file
 
 import json
+import numpy as np
 import os
 import pandas as pd
 
@@ -34,8 +35,10 @@ def run_mhc_gene_assessment(job, rsem_files, rna_haplotype, univ_options, report
     :return: The results of running assess_mhc_genes
     :rtype: toil.fileStore.FileID
     """
-    return job.addChildJobFn(assess_mhc_genes, rsem_files['rsem.genes.results'], rna_haplotype,
-                             univ_options, reports_options).rv()
+    # Prefer the expression table, falling back to the rsem gene results
+    gene_expression = rsem_files.get('rsem.expression.npz') or rsem_files['rsem.genes.results']
+    return job.addChildJobFn(assess_mhc_genes, gene_expression, rna_haplotype, univ_options,
+                             reports_options).rv()
 
 
 
@@ -44,7 +47,8 @@ def assess_mhc_genes(job, gene_expression, rna_haplotype, univ_options, reports_
     Assess the prevalence of the various genes in the MHC pathway and return a report in the tsv
     format.
 
-    :param toil.fileStore.FileID gene_expression: fsID for the rsem gene expression file
+    :param toil.fileStore.FileID gene_expression: fsID for the expression table from
+           make_expression_table or the rsem gene expression file
     :param toil.fileStore.FileID|None rna_haplotype: fsID for the RNA PHLAT file
     :param dict univ_options: Dict of universal options used by almost all tools
     :param dict reports_options: Options specific to reporting modules
@@ -55,9 +59,6 @@ def assess_mhc_genes(job, gene_expression, rna_haplotype, univ_options, reports_
     work_dir = os.getcwd()
     # Take file parameters for both TCGA and GTEX files
     tumor_type = univ_options['tumor_type']
-    b_types = {
-    'tcga': tumor_type + " normal",
-    'gtex': TCGAToGTEx[tumor_type] if tumor_type in TCGAToGTEx else "NA"}
 
     input_files = {
         'rsem_quant.tsv': gene_expression,
@@ -69,72 +70,107 @@ def assess_mhc_genes(job, gene_expression, rna_haplotype, univ_options, reports_
     input_files['mhc_pathways.tsv'] = untargz(input_files['mhc_pathways.tsv.tar.gz'], work_dir)
 
     # Read the background file
-
     background_df = pd.read_table(input_files['mhc_pathways.tsv'], index_col=0, header=0)
 
     # Parse the rna phlat file
+    mhc_alleles = None
     if rna_haplotype is not None:
         with open(input_files['rna_haplotype.sum']) as rna_mhc:
             mhc_alleles = {'HLA_A': [], 'HLA_B': [], 'HLA_C': [], 'HLA_DPA': [], 'HLA_DQA': [],
                            'HLA_DPB': [], 'HLA_DQB': [], 'HLA_DRB': []}
             mhc_alleles = parse_phlat_file(rna_mhc, mhc_alleles)
 
-    # Read the patient gene values into a dictionary
-    gene_expressions = pd.read_table(input_files['rsem_quant.tsv'], index_col=0, header=0)
-    gene_expressions = Counter({x.split('.')[0]: y for x, y in gene_expressions['TPM'].to_dict().items()})
-    # Print the report
-    roles = {x for x in background_df['Roles'].values if ',' not in x}
     with open('mhc_pathway_report.txt', 'w') as mpr:
-        for role in roles:
-            role_df = background_df[background_df['Roles'].str.contains(role)]
-            print(role.center(90, ' '), file=mpr)
-            print(
-                "{:12}{:<12}{:<17}{:<12}{:<20}{:<17}\n".format('Gene', 'Observed', 'Threshold_GTEX',
-                                                                 'Result', 'Threshold_TCGA_N', 'Result'),
-                file=mpr)
-            # If tumor_type in TCGAToGTEx.keys():
-            if role == 'MHCI loading':
-                for mhci_allele in 'HLA_A', 'HLA_B', 'HLA_C':
-                    if rna_haplotype is not None:
-                        num_alleles = len(mhc_alleles[mhci_allele])
-                        result = ('FAIL' if num_alleles == 0 else
-                                  'LOW' if num_alleles == 1 else
-                                  'PASS')
-                    else:
-                        result = num_alleles = 'NA'
-                    print("{:12}{:<12}{:<17}{:<12}{:<20}{:<17}".format(mhci_allele, 2,
-                                                                           num_alleles, result,
-                                                                           2, result), file=mpr)
-            elif role == 'MHCII loading':
-                for mhcii_allele in ('HLA_DQA', 'HLA_DQB', 'HLA_DRB'):
-                    if rna_haplotype is not None:
-                        num_alleles = len(mhc_alleles[mhcii_allele])
-                        result = ('FAIL' if num_alleles == 0 else
-                                  'LOW' if num_alleles == 1 else
-                                  'PASS')
-                    else:
-                        result = num_alleles = 'NA'
-                    print(
-                        "{:12}{:<12}{:<17}{:<12}{:<20}{:<17}".format(mhcii_allele, 2, num_alleles,
-                                                                     result, 2, result), file=mpr)
-
-            for ensg in role_df.index:
-                ensgName = background_df.ix[ensg, 'Name']
-                b_vals = {}
-                for bkg in b_types:
-                    val = "{0:.2f}".format(role_df.loc[ensg].get(b_types[bkg], default='NA'))
-                    result = ('NA' if val == 'NA' else
-                              'LOW' if float(val) >= float(gene_expressions[ensg]) else
-                              'PASS')
-                    b_vals[bkg] = val, result
-                print(
-                    "{:12}{:<12}{:<17}{:<12}{:<20}{:<17}".format(ensgName, float(gene_expressions[ensg]),
-                                                                 b_vals['gtex'][0], b_vals['gtex'][1],
-                                                                 b_vals['tcga'][0], b_vals['tcga'][1]),
-                    file=mpr)
-
-            print('\n', file=mpr)
+        write_mhc_pathway_report(load_gene_expression(input_files['rsem_quant.tsv']),
+                                 background_df, mhc_alleles, tumor_type, mpr)
 
     output_file = job.fileStore.writeGlobalFile(mpr.name)
     export_results(job, output_file, mpr.name, univ_options, subfolder='reports')
     return output_file
+
+
+def write_mhc_pathway_report(gene_expression, background_df, mhc_alleles, tumor_type, mpr):
+    """
+    Write the MHC pathway report comparing the expression of the genes in the MHC pathway against
+    their TCGA normal and GTEx backgrounds.
+
+    :param pandas.DataFrame gene_expression: The gene expression from load_gene_expression
+    :param pandas.DataFrame background_df: The mhc pathways background table
+    :param dict|None mhc_alleles: The alleles called per MHC gene from the RNA PHLAT file, if any
+    :param str tumor_type: The TCGA tumor type of the patient
+    :param file mpr: An open file descriptor to the report
+    :return: None
+    """
+    # Genes without expression are treated as not expressed
+    observed = gene_expression['TPM'].reindex(background_df.index).fillna(0.0)
+    calls = mhc_pathway_calls(gene_expression[['TPM']], background_df, tumor_type)
+    b_vals = {}
+    for bkg in calls:
+        if calls[bkg] is not None:
+            val = background_df[calls[bkg][0]].map('{0:.2f}'.format)
+            result = calls[bkg][1]['TPM']
+        else:
+            val = result = pd.Series('NA', index=background_df.index)
+        b_vals[bkg] = val, result
+    roles = {x for x in background_df['Roles'].values if ',' not in x}
+    for role in roles:
+        in_role = background_df['Roles'].str.contains(role).values
+        print(role.center(90, ' '), file=mpr)
+        print(
+            "{:12}{:<12}{:<17}{:<12}{:<20}{:<17}\n".format('Gene', 'Observed', 'Threshold_GTEX',
+                                                             'Result', 'Threshold_TCGA_N', 'Result'),
+            file=mpr)
+        if role in ('MHCI loading', 'MHCII loading'):
+            mhc_genes = (('HLA_A', 'HLA_B', 'HLA_C') if role == 'MHCI loading' else
+                         ('HLA_DQA', 'HLA_DQB', 'HLA_DRB'))
+            for mhc_gene in mhc_genes:
+                if mhc_alleles is not None:
+                    num_alleles = len(mhc_alleles[mhc_gene])
+                    result = ('FAIL' if num_alleles == 0 else
+                              'LOW' if num_alleles == 1 else
+                              'PASS')
+                else:
+                    result = num_alleles = 'NA'
+                print("{:12}{:<12}{:<17}{:<12}{:<20}{:<17}".format(mhc_gene, 2, num_alleles,
+                                                                   result, 2, result), file=mpr)
+        rows = zip(background_df['Name'].values[in_role], observed.values[in_role],
+                   b_vals['gtex'][0].values[in_role], b_vals['gtex'][1].values[in_role],
+                   b_vals['tcga'][0].values[in_role], b_vals['tcga'][1].values[in_role])
+        for row in rows:
+            print("{:12}{:<12}{:<17}{:<12}{:<20}{:<17}".format(row[0], float(row[1]), *row[2:]),
+                  file=mpr)
+        print('\n', file=mpr)
+    return None
+
+
+def mhc_pathway_calls(expression, background_df, tumor_type):
+    """
+    Call each gene in the MHC pathway LOW or PASS against its TCGA normal and GTEx backgrounds for
+    any number of samples at once.
+
+    :param pandas.DataFrame expression: TPMs of the samples with genes as rows and one column per
+           sample
+    :param pandas.DataFrame background_df: The mhc pathways background table
+    :param str tumor_type: The TCGA tumor type of the samples
+    :return: The background column and the calls (genes of `background_df` x samples) per
+             background, or None if the background isn't available for the tumor type
+             calls:
+                |- 'gtex': (str, pandas.DataFrame)|None
+                +- 'tcga': (str, pandas.DataFrame)|None
+    :rtype: dict
+    """
+    b_types = {
+        'tcga': tumor_type + " normal",
+        'gtex': TCGAToGTEx[tumor_type] if tumor_type in TCGAToGTEx else "NA"}
+    # Genes without expression are treated as not expressed
+    observed = expression.reindex(background_df.index).fillna(0.0).values
+    calls = {}
+    for bkg in b_types:
+        if b_types[bkg] in background_df.columns:
+            threshold = background_df[b_types[bkg]].astype(float).round(2).values[:, None]
+            calls[bkg] = b_types[bkg], pd.DataFrame(np.where(threshold >= observed, 'LOW', 'PASS'),
+                                                    index=background_df.index,
+                                                    columns=expression.columns)
+        else:
+            calls[bkg] = None
+    return calls
@@ -0,0 +1,254 @@
+#!/usr/bin/env python2.7
+# Copyright 2016 Arjun Arkal Rao
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Cohort level reporting over the output folders of many ProTECT runs.
+
+The gene expression of every patient is kept in a cohort folder as a gene x patient TPM matrix that
+is memory-mapped when read.  The matrix is stored patient-major so adding a patient only appends a
+row to it.
+
+cohort_folder
+    |- genes.list: One gene per line, in matrix column order
+    |- patients.list: <patient>\t<tumor type> per line, in matrix row order
+    +- tpm.matrix: The TPMs as float64 in C order (patients x genes)
+"""
+from __future__ import print_function
+from protect.addons.assess_car_t_validity import car_t_overexpression
+from protect.addons.assess_immunotherapy_resistance import itx_pathway_calls
+from protect.addons.assess_mhc_pathway import mhc_pathway_calls
+from protect.common import ParameterError, untargz
+from protect.expression_profiling.rsem import load_gene_expression
+
+import json
+import numpy as np
+import os
+import pandas as pd
+import sys
+
+COHORT_DTYPE = np.float64
+
+
+def read_cohort(cohort_folder):
+    """
+    Read the genes and patients of a cohort folder, and memory-map its TPM matrix.
+
+    :param str cohort_folder: The cohort folder
+    :return: The genes, the patients with their tumor types, and the read-only TPM matrix
+             (patients x genes), or None if the cohort is empty
+    :rtype: tuple(pandas.Index, list(tuple(str, str)), numpy.memmap|None)
+    """
+    genes_file = os.path.join(cohort_folder, 'genes.list')
+    if not os.path.exists(genes_file):
+        return pd.Index([]), [], None
+    with open(genes_file) as g_f:
+        genes = pd.Index([line.strip() for line in g_f])
+    patients = []
+    patients_file = os.path.join(cohort_folder, 'patients.list')
+    if os.path.exists(patients_file):
+        with open(patients_file) as p_f:
+            patients = [tuple(line.rstrip('\n').split('\t')) for line in p_f]
+    if not patients:
+        return genes, patients, None
+    # The matrix may hold a partial row from an interrupted update.  Only the listed patients count.
+    matrix = np.memmap(os.path.join(cohort_folder, 'tpm.matrix'), dtype=COHORT_DTYPE, mode='r',
+                       shape=(len(patients), len(genes)))
+    return genes, patients, matrix
+
+
+def update_cohort(cohort_folder, patients):
+    """
+    Add new patients to the cohort folder, creating it if required.  Patients already in the cohort
+    are skipped so the existing matrix is never rebuilt.  The genes of the cohort are fixed by the
+    first patient added.  Genes missing for later patients are NaN and extra ones are ignored.
+
+    :param str cohort_folder: The cohort folder
+    :param dict patients: The expression file and tumor type of each patient
+           patients:
+                |- <patient>: (str, str)
+                ..
+                +- <patient>: (str, str)
+    :return: The patients that were added
+    :rtype: list
+    """
+    genes, cohort, _ = read_cohort(cohort_folder)
+    known = {patient for patient, _ in cohort}
+    new_patients = sorted(set(patients) - known)
+    if not new_patients:
+        return []
+    if not os.path.isdir(cohort_folder):
+        os.makedirs(cohort_folder)
+    matrix_file = os.path.join(cohort_folder, 'tpm.matrix')
+    if len(genes) == 0:
+        genes = load_gene_expression(patients[new_patients[0]][0]).index
+        with open(os.path.join(cohort_folder, 'genes.list'), 'w') as g_f:
+            for gene in genes:
+                print(gene, file=g_f)
+        open(matrix_file, 'w').close()
+    row_size = len(genes) * np.dtype(COHORT_DTYPE).itemsize
+    with open(matrix_file, 'r+b') as m_f:
+        # Drop any partial row left by an interrupted update
+        m_f.truncate(len(cohort) * row_size)
+    with open(matrix_file, 'ab') as m_f, \
+            open(os.path.join(cohort_folder, 'patients.list'), 'a') as p_f:
+        for patient in new_patients:
+            expression_file, tumor_type = patients[patient]
+            tpm = load_gene_expression(expression_file)['TPM'].reindex(genes)
+            m_f.write(tpm.values.astype(COHORT_DTYPE).tobytes())
+            # The row has to be on disk before the patient is listed
+            m_f.flush()
+            os.fsync(m_f.fileno())
+            print('%s\t%s' % (patient, tumor_type), file=p_f)
+            p_f.flush()
+    return new_patients
+
+
+def cohort_expression(cohort_folder, genes):
+    """
+    Get the TPMs of the requested genes for all patients in the cohort.  Only the columns of the
+    requested genes are read from the matrix.
+
+    :param str cohort_folder: The cohort folder
+    :param list genes: The genes
+    :return: The TPMs (genes x patients) and the tumor type of each patient
+    :rtype: tuple(pandas.DataFrame, pandas.Series)
+    """
+    cohort_genes, cohort, matrix = read_cohort(cohort_folder)
+    patients = [patient for patient, _ in cohort]
+    tumor_types = pd.Series([tumor_type for _, tumor_type in cohort], index=patients)
+    genes = pd.Index(genes).unique()
+    tpm = np.full((len(genes), len(patients)), np.nan, dtype=COHORT_DTYPE)
+    if matrix is not None:
+        columns = cohort_genes.get_indexer(genes)
+        found = columns >= 0
+        tpm[found] = matrix[:, columns[found]].T
+    return pd.DataFrame(tpm, index=genes, columns=patients), tumor_types
+
+
+def write_cohort_reports(cohort_folder, mhc_pathways, itx_resistance, json_data, car_t_targets,
+                         out_folder):
+    """
+    Evaluate the MHC pathway, immunotherapy resistance and CAR-T validity reports for every patient
+    in the cohort at once, and write one patient-wise tsv per report.  Patients are evaluated
+    against the backgrounds for their own tumor type.  Entries that don't apply to a patient's tumor
+    type are NA.
+
+    :param str cohort_folder: The cohort folder
+    :param pandas.DataFrame mhc_pathways: The mhc pathways background table
+    :param pandas.DataFrame itx_resistance: The itx resistance background table
+    :param dict json_data: The immune resistance pathway descriptions
+    :param pandas.DataFrame car_t_targets: The car t targets table
+    :param str out_folder: Where to write the reports
+    :return: Paths to the reports
+             reports:
+                |- 'cohort_car_t_targets.tsv': str
+                |- 'cohort_immunotherapy_resistance.tsv': str
+                +- 'cohort_mhc_pathway.tsv': str
+    :rtype: dict
+    """
+    genes = set(mhc_pathways.index) | set(car_t_targets['ENSG'])
+    for pathway in json_data['Pathways'].values():
+        genes.update(pathway['genes'])
+    tpm, tumor_types = cohort_expression(cohort_folder, sorted(genes))
+
+    mhc_calls = []
+    itx_calls = []
+    car_t_calls = []
+    for tumor_type, patients in tumor_types.groupby(tumor_types):
+        expression = tpm[patients.index]
+        calls = mhc_pathway_calls(expression, mhc_pathways, tumor_type)
+        mhc_calls.append(pd.concat(
+            [calls[bkg][1] if calls[bkg] is not None else
+             pd.DataFrame('NA', index=mhc_pathways.index, columns=patients.index)
+             for bkg in ('gtex', 'tcga')], keys=['GTEX', 'TCGA_N']))
+        itx_calls.append(itx_pathway_calls(expression, itx_resistance, json_data, tumor_type))
+        car_t_calls.append(car_t_overexpression(expression, car_t_targets, tumor_type))
+
+    def _combine(calls):
+        # Tumor types without data have no rows.  Fill in their patients as NA.
+        calls = [x[~x.index.duplicated()].astype(object) for x in calls if x is not None]
+        if not calls:
+            return pd.DataFrame(columns=tumor_types.index)
+        return pd.concat(calls, axis=1).reindex(columns=tumor_types.index).fillna('NA')
+
+    mhc_calls = _combine(mhc_calls)
+    mhc_calls.index = pd.MultiIndex.from_arrays(
+        [mhc_pathways['Name'].reindex(mhc_calls.index.get_level_values(1)).values,
+         mhc_calls.index.get_level_values(0)], names=['Gene', 'Background'])
+    itx_calls = _combine(itx_calls)
+    itx_calls.index.name = 'Pathway'
+    car_t_calls = _combine(car_t_calls)
+    car_t_calls.index = pd.Index(
+        car_t_targets.drop_duplicates('ENSG').set_index('ENSG')['TARGET'].reindex(
+            car_t_calls.index).str.upper().values, name='Target')
+
+    if not os.path.isdir(out_folder):
+        os.makedirs(out_folder)
+    reports = {}
+    for name, calls in (('cohort_mhc_pathway.tsv', mhc_calls),
+                        ('cohort_immunotherapy_resistance.tsv', itx_calls),
+                        ('cohort_car_t_targets.tsv', car_t_calls)):
+        reports[name] = os.path.join(out_folder, name)
+        calls.to_csv(reports[name], sep='\t')
+    return reports
+
+
+def find_patient_expression(output_folder, patients):
+    """
+    Find the exported gene expression of each patient in the ProTECT output folder.  Patients
+    without expression results (e.g. runs that haven't finished) are skipped, as are patients
+    without a tumor type (with a warning) since they can't be assessed.
+
+    :param str output_folder: The output folder of the ProTECT runs
+    :param dict patients: The tumor type of each patient
+    :return: The expression file and tumor type of each patient with results
+    :rtype: dict
+    """
+    found = {}
+    for patient, tumor_type in patients.items():
+        if tumor_type is None:
+            print('WARNING: No tumor_type provided for patient %s. Skipping it.' % patient,
+                  file=sys.stderr)
+            continue
+        expression_file = os.path.join(output_folder, patient, 'expression',
+                                       'rsem.genes.results')
+        if os.path.exists(expression_file):
+            found[patient] = expression_file, tumor_type
+    return found
+
+
+def read_report_inputs(reports_options, work_dir):
+    """
+    Read the background tables and the immune resistance pathway descriptions used by the reports
+    from the local tar.gz archives in the reports section of a ProTECT config.
+
+    :param dict reports_options: Options specific to reporting modules
+    :param str work_dir: The directory to untar the archives into
+    :return: The mhc pathways table, the itx resistance table, the immune resistance pathway
+             descriptions and the car t targets table
+    :rtype: tuple(pandas.DataFrame, pandas.DataFrame, dict, pandas.DataFrame)
+    """
+    inputs = {}
+    for name in ('mhc_pathways', 'itx_resistance', 'immune_resistance_pathways', 'car_t_targets'):
+        archive = reports_options[name + '_file']
+        if not os.path.exists(archive):
+            raise ParameterError('Cohort reports need a local copy of %s_file. %s was not found. '
+                                 'S3 and http URLs are not fetched.' % (name, archive))
+        inputs[name] = untargz(archive, work_dir)
+    with open(inputs['immune_resistance_pathways']) as json_file:
+        json_data = json.load(json_file)
+    return (pd.read_table(inputs['mhc_pathways'], index_col=0, header=0),
+            pd.read_table(inputs['itx_resistance'], index_col=0, header=0),
+            json_data,
+            pd.read_table(inputs['car_t_targets'], index_col=0, header=0))
@@ -0,0 +1,119 @@
+#!/usr/bin/env python2.7
+# Copyright 2016 Arjun Arkal Rao
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+from protect.addons.assess_car_t_validity import write_car_t_validity_report
+from protect.addons.assess_immunotherapy_resistance import write_itx_resistance_report
+from protect.addons.assess_mhc_pathway import write_mhc_pathway_report
+from protect.common import export_results, get_file_digest, get_files_from_filestore, untargz
+from protect.expression_profiling.rsem import load_gene_expression
+from protect.haplotyping.phlat import parse_phlat_file
+
+import errno
+import json
+import os
+import pandas as pd
+
+
+def run_reports(job, rsem_files, rna_haplotype, univ_options, reports_options):
+    """
+    Write the MHC pathway, immunotherapy resistance and CAR-T validity reports in a single job.  The
+    patient expression and each background table are loaded once.  If reports_options['table_cache']
+    is set, the parsed background tables are kept there in binary form and reused by later runs.
+
+    :param dict rsem_files: Results from running rsem
+    :param toil.fileStore.FileID|None rna_haplotype: fsID for the RNA PHLAT file
+    :param dict univ_options: Dict of universal options used by almost all tools
+    :param dict reports_options: Options specific to reporting modules
+    :return: Dict of fsIDs for the reports
+             output_files:
+                |- 'car_t_target_report.txt': fsID
+                |- 'immunotherapy_resistance_report.txt': fsID
+                +- 'mhc_pathway_report.txt': fsID
+    :rtype: dict
+    """
+    job.fileStore.logToMaster('Running reports on %s' % univ_options['patient'])
+    work_dir = os.getcwd()
+    tumor_type = univ_options['tumor_type']
+
+    input_files = {
+        'rsem_quant': rsem_files.get('rsem.expression.npz', rsem_files['rsem.genes.results']),
+        'immune_resistance_pathways.json.tar.gz': reports_options['immune_resistance_pathways_file']}
+    if rna_haplotype is not None:
+        input_files['rna_haplotype.sum'] = rna_haplotype
+    input_files = get_files_from_filestore(job, input_files, work_dir, docker=False)
+    input_files['immune_resistance_pathways.json'] = untargz(
+        input_files['immune_resistance_pathways.json.tar.gz'], work_dir)
+
+    gene_expression = load_gene_expression(input_files['rsem_quant'])
+    tables = {name: _load_background_table(job, reports_options[name + '_file'], name,
+                                           reports_options.get('table_cache'), work_dir)
+              for name in ('mhc_pathways', 'itx_resistance', 'car_t_targets')}
+    with open(input_files['immune_resistance_pathways.json']) as json_file:
+        json_data = json.load(json_file)
+    mhc_alleles = None
+    if rna_haplotype is not None:
+        with open(input_files['rna_haplotype.sum']) as rna_mhc:
+            mhc_alleles = {'HLA_A': [], 'HLA_B': [], 'HLA_C': [], 'HLA_DPA': [], 'HLA_DQA': [],
+                           'HLA_DPB': [], 'HLA_DQB': [], 'HLA_DRB': []}
+            mhc_alleles = parse_phlat_file(rna_mhc, mhc_alleles)
+
+    with open('mhc_pathway_report.txt', 'w') as mpr:
+        write_mhc_pathway_report(gene_expression, tables['mhc_pathways'], mhc_alleles, tumor_type,
+                                 mpr)
+    with open('immunotherapy_resistance_report.txt', 'w') as report_file:
+        write_itx_resistance_report(gene_expression, tables['itx_resistance'], json_data,
+                                    tumor_type, report_file)
+    with open('car_t_target_report.txt', 'w') as car_t_report:
+        write_car_t_validity_report(gene_expression, tables['car_t_targets'], tumor_type,
+                                    car_t_report)
+    output_files = {}
+    for report in (mpr.name, report_file.name, car_t_report.name):
+        output_files[report] = job.fileStore.writeGlobalFile(report)
+        export_results(job, output_files[report], report, univ_options, subfolder='reports')
+    return output_files
+
+
+def _load_background_table(job, table, name, table_cache, work_dir):
+    """
+    Load a tar.gz'd tsv background table indexed by its first column.  If `table_cache` is set, the
+    parsed table is pickled there, keyed by the name and the md5 digest of the tarball, and loaded
+    from the pickle instead whenever it exists.
+
+    :param toil.fileStore.FileID table: fsID for the tar.gz'd table
+    :param str name: The name of the table
+    :param str table_cache: A directory to cache the parsed tables in, or None
+    :param str work_dir: The directory to download the table into
+    :return: The table
+    :rtype: pandas.DataFrame
+    """
+    if table_cache:
+        cached_table = os.path.join(os.path.abspath(table_cache),
+                                    '%s_%s.pkl' % (name, get_file_digest(job, table)))
+        if os.path.exists(cached_table):
+            return pd.read_pickle(cached_table)
+    input_files = get_files_from_filestore(job, {name + '.tsv.tar.gz': table}, work_dir,
+                                           docker=False)
+    background = pd.read_table(untargz(input_files[name + '.tsv.tar.gz'], work_dir), index_col=0,
+                               header=0)
+    if table_cache:
+        try:
+            os.makedirs(os.path.dirname(cached_table))
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        # Write to a temporary file first so concurrent runs never see a partial table
+        background.to_pickle(cached_table + '.%s.tmp' % os.getpid())
+        os.rename(cached_table + '.%s.tmp' % os.getpid(), cached_table)
+    return background
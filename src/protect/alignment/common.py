@@ -29,6 +29,12 @@ def sort_disk(bamfile):
     return int(2.5 * ceil(bamfile.size + 524288))
 
 
+# disk for slicing
+def slice_disk(bamfiles):
+    return int(2 * ceil(sum([b.size for f, b in bamfiles.items() if f.endswith('.bam')]) +
+                        524288))
+
+
 def index_bamfile(job, bamfile, sample_type, univ_options, samtools_options, sample_info=None,
                   export=True):
     """
@@ -102,3 +108,150 @@ def sort_bamfile(job, bamfile, sample_type, univ_options, samtools_options):
                 dockerhub=univ_options['dockerhub'], tool_version=samtools_options['version'])
     job.fileStore.deleteGlobalFile(bamfile)
     return job.fileStore.writeGlobalFile(out_bamfile)
+
+
+def slice_bamfile(job, bamfiles, target_bed, sample_type, univ_options, samtools_options,
+                  sample_info=None):
+    """
+    Restrict a bam to the reads overlapping the regions in `target_bed` using samtools, and index
+    the result.
+
+    :param dict bamfiles: Dict containing the bam and bai for the sample
+    :param toil.fileStore.FileID target_bed: fsID for the bed file of regions to retain
+    :param str sample_type: Description of the sample to inject into the filename
+    :param dict univ_options: Dict of universal options used by almost all tools
+    :param dict samtools_options: Options specific to samtools
+    :param str sample_info: Information regarding the sample that will be injected into the filename
+               as `sample_type`_`sample_info`.bam(.bai)
+    :return: Dict containing the sliced bam and its index, keyed identically to `bamfiles`
+             output_files:
+                 |- '<sample_type>(_<sample_info>).bam': fsID
+                 +- '<sample_type>(_<sample_info>).bam.bai': fsID
+    :rtype: dict
+    """
+    job.fileStore.logToMaster('Running samtools-view on %s:%s' % (univ_options['patient'],
+                                                                  sample_type))
+    work_dir = os.getcwd()
+    in_bamfile = sample_type
+    if sample_info is not None:
+        assert isinstance(sample_info, str)
+        in_bamfile = '_'.join([in_bamfile, sample_info])
+    in_bamfile += '.bam'
+    input_files = {
+        in_bamfile: bamfiles[in_bamfile],
+        in_bamfile + '.bai': bamfiles[in_bamfile + '.bai'],
+        'targets.bed': target_bed}
+    input_files = get_files_from_filestore(job, input_files, work_dir, docker=True)
+    out_bamfile = '/'.join([work_dir, 'sliced', in_bamfile])
+    os.mkdir(os.path.dirname(out_bamfile))
+    parameters = ['view',
+                  '-b',
+                  '-L', input_files['targets.bed'],
+                  '-o', docker_path(out_bamfile, work_dir),
+                  input_files[in_bamfile]]
+    docker_call(tool='samtools', tool_parameters=parameters, work_dir=work_dir,
+                dockerhub=univ_options['dockerhub'], tool_version=samtools_options['version'])
+    parameters = ['index',
+                  docker_path(out_bamfile, work_dir)]
+    docker_call(tool='samtools', tool_parameters=parameters, work_dir=work_dir,
+                dockerhub=univ_options['dockerhub'], tool_version=samtools_options['version'])
+    output_files = {in_bamfile: job.fileStore.writeGlobalFile(out_bamfile),
+                    in_bamfile + '.bai': job.fileStore.writeGlobalFile(out_bamfile + '.bai')}
+    return output_files
+
+
+def split_bam_by_chromosome(job, bamfiles, sample_type, chromosomes, univ_options,
+                            samtools_options, sample_info=None):
+    """
+    Split a bam into one indexed bam per chromosome, extracting each chromosome in its own job.
+    Callers that can't be restricted to a region are run per chromosome on these so each of their
+    jobs doesn't have to read, and extract its chromosome from, the full bam.
+
+    :param dict bamfiles: Dict containing the bam and bai for the sample
+    :param str sample_type: Description of the sample to inject into the filename
+    :param list chromosomes: The chromosomes to extract
+    :param dict univ_options: Dict of universal options used by almost all tools
+    :param dict samtools_options: Options specific to samtools
+    :param str sample_info: Information regarding the sample that will be injected into the filename
+               as `sample_type`_`sample_info`.bam(.bai)
+    :return: Dict containing the bam and its index for each chromosome, keyed identically to
+             `bamfiles`
+             output_files:
+                 |- 'chr1':
+                 |      |- '<sample_type>(_<sample_info>).bam': fsID
+                 |      +- '<sample_type>(_<sample_info>).bam.bai': fsID
+                 |- ...
+                 +- 'chrM':
+                        |- '<sample_type>(_<sample_info>).bam': fsID
+                        +- '<sample_type>(_<sample_info>).bam.bai': fsID
+    :rtype: dict
+    """
+    output_files = {}
+    for chrom in chromosomes:
+        output_files[chrom] = job.addChildJobFn(extract_chromosome, bamfiles, sample_type, chrom,
+                                                univ_options, samtools_options,
+                                                sample_info=sample_info,
+                                                disk=slice_disk(bamfiles)).rv()
+    return output_files
+
+
+def extract_chromosome(job, bamfiles, sample_type, chrom, univ_options, samtools_options,
+                       sample_info=None):
+    """
+    Extract the reads on a single chromosome from a bam into a new indexed bam using samtools.
+
+    :param dict bamfiles: Dict containing the bam and bai for the sample
+    :param str sample_type: Description of the sample to inject into the filename
+    :param str chrom: The chromosome to extract
+    :param dict univ_options: Dict of universal options used by almost all tools
+    :param dict samtools_options: Options specific to samtools
+    :param str sample_info: Information regarding the sample that will be injected into the filename
+               as `sample_type`_`sample_info`.bam(.bai)
+    :return: Dict containing the bam of `chrom` and its index, keyed identically to `bamfiles`
+             output_files:
+                 |- '<sample_type>(_<sample_info>).bam': fsID
+                 +- '<sample_type>(_<sample_info>).bam.bai': fsID
+    :rtype: dict
+    """
+    job.fileStore.logToMaster('Extracting %s from %s:%s' % (chrom, univ_options['patient'],
+                                                           sample_type))
+    work_dir = os.getcwd()
+    in_bamfile = sample_type
+    if sample_info is not None:
+        assert isinstance(sample_info, str)
+        in_bamfile = '_'.join([in_bamfile, sample_info])
+    in_bamfile += '.bam'
+    input_files = {
+        in_bamfile: bamfiles[in_bamfile],
+        in_bamfile + '.bai': bamfiles[in_bamfile + '.bai']}
+    input_files = get_files_from_filestore(job, input_files, work_dir, docker=True)
+    out_bamfile = '/'.join([work_dir, chrom, in_bamfile])
+    os.mkdir(os.path.dirname(out_bamfile))
+    parameters = ['view',
+                  '-b',
+                  '-o', docker_path(out_bamfile, work_dir),
+                  input_files[in_bamfile],
+                  chrom]
+    docker_call(tool='samtools', tool_parameters=parameters, work_dir=work_dir,
+                dockerhub=univ_options['dockerhub'], tool_version=samtools_options['version'])
+    parameters = ['index',
+                  docker_path(out_bamfile, work_dir)]
+    docker_call(tool='samtools', tool_parameters=parameters, work_dir=work_dir,
+                dockerhub=univ_options['dockerhub'], tool_version=samtools_options['version'])
+    output_files = {in_bamfile: job.fileStore.writeGlobalFile(out_bamfile),
+                    in_bamfile + '.bai': job.fileStore.writeGlobalFile(out_bamfile + '.bai')}
+    return output_files
+
+
+def delete_split_bams(job, split_bams, patient_id):
+    """
+    Delete the per-chromosome bams written by split_bam_by_chromosome once the callers are done
+    with them.
+
+    :param dict split_bams: Dict of bam and bai files for each chromosome
+    :param str patient_id: The ID of the patient for logging purposes.
+    """
+    job.fileStore.logToMaster('Deleting the per-chromosome bams for patient "%s".' % patient_id)
+    for bams in split_bams.values():
+        for fsid in bams.values():
+            job.fileStore.deleteGlobalFile(fsid)
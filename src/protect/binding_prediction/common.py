@@ -14,14 +14,17 @@
 # limitations under the License.
 from __future__ import absolute_import, print_function
 from collections import defaultdict
+from math import ceil
 
 from protect.binding_prediction.mhci import predict_mhci_binding
 from protect.binding_prediction.mhcii import predict_mhcii_binding, predict_netmhcii_binding
 from protect.common import get_files_from_filestore, export_results, read_peptide_file, untargz
 
 import json
+import numpy as np
 import os
 import pandas
+import random
 import re
 
 
@@ -90,6 +93,35 @@ def spawn_antigen_predictors(job, transgened_files, phlat_files, univ_options, m
         mhci_restrictions = json.load(restfile)
     with open(input_files['mhcii_restrictions.json'], 'r') as restfile:
         mhcii_restrictions = json.load(restfile)
+    netmhciipan_alleles = None
+    if mhcii_options['netmhciipan'].get('allele_file'):
+        allele_file = get_files_from_filestore(job, {'netmhciipan_alleles.list':
+                                                     mhcii_options['netmhciipan']['allele_file']},
+                                               work_dir)
+        with open(allele_file['netmhciipan_alleles.list'], 'r') as alleles:
+            netmhciipan_alleles = set(line.strip() for line in alleles if line.strip())
+    # If position specific scoring matrices have been provided, only the best scoring fraction of
+    # the peptides for each allele are sent to the predictors.
+    pssms = {}
+    for mhc, options in (('mhci', mhci_options), ('mhcii', mhcii_options)):
+        if options.get('pssm_file'):
+            pssm_file = get_files_from_filestore(job, {mhc + '_pssm.json.tar.gz':
+                                                       options['pssm_file']}, work_dir)
+            pssms[mhc] = load_pssms(untargz(pssm_file[mhc + '_pssm.json.tar.gz'], work_dir))
+    # Every allele is predicted on the unique peptides of each length rather than on the IARs, so
+    # peptides shared by overlapping IARs are only scored once per allele.
+    input_files = get_files_from_filestore(job, pept_files, work_dir)
+    unique_peptides, peptide_tables = {}, {}
+    for peplen in ('9', '10', '15'):
+        iars = read_fastas({x: y for x, y in input_files.items() if x[2:] == peplen + '_mer.faa'})
+        with iars['tumor'], iars['normal']:
+            unique_peptides[peplen], unique_file, table_file = build_peptide_table(iars, peplen,
+                                                                                   work_dir)
+        pept_files['U_' + peplen + '_mer.faa'] = job.fileStore.writeGlobalFile(unique_file)
+        peptide_tables[peplen] = job.fileStore.writeGlobalFile(table_file)
+    job.fileStore.logToMaster('Predicting binding on %s unique peptides for %s' %
+                              ('/'.join(str(len(unique_peptides[x])) for x in ('9', '10', '15')),
+                               univ_options['patient']))
     # For each mhci allele:peptfile combination, spawn a job and store the job handle in the dict.
     # Then do the same for mhcii
     mhci_preds, mhcii_preds = {}, {}
@@ -102,79 +134,358 @@ def spawn_antigen_predictors(job, transgened_files, phlat_files, univ_options, m
                     continue
             except KeyError:
                 continue
-            mhci_job = job.addChildJobFn(predict_mhci_binding, pept_files['T_' + peptfile], allele,
-                                         peplen, univ_options, mhci_options, disk='100M',
-                                         memory='100M', cores=1)
+            tumor_peptfile, prefilter = pept_files['U_' + peptfile], None
+            if allele in pssms.get('mhci', {}).get('matrices', {}) and \
+                    peplen in pssms['mhci']['matrices'][allele]:
+                tumor_peptfile, prefilter = _prefilter_peptides(job, unique_peptides[peplen],
+                                                                allele, peplen, pssms['mhci'],
+                                                                mhci_options, univ_options)
+            if mhci_options['chunk_size']:
+                mhci_job = job.addChild(job.wrapJobFn(
+                    predict_in_chunks, predict_mhci_binding, tumor_peptfile,
+                    int(mhci_options['chunk_size']), allele, peplen, univ_options, mhci_options,
+                    disk='100M', memory='100M', cores=1).encapsulate())
+            else:
+                mhci_job = job.addChildJobFn(predict_mhci_binding, tumor_peptfile, allele,
+                                             peplen, univ_options, mhci_options, disk='100M',
+                                             memory='100M', cores=1)
             mhci_preds[(allele, peplen)] = mhci_job.addChildJobFn(
                 predict_normal_binding,
                 mhci_job.rv(),
-                {x: y for x, y in pept_files.items() if peplen in x},
+                peptide_tables[peplen],
                 allele,
                 peplen,
                 univ_options,
                 mhci_options,
+                prefilter=prefilter,
                 disk='100M',
                 memory='100M',
                 cores=1).rv()
+    routes = mhcii_predictor_routes(mhcii_restrictions, mhcii_options,
+                                    netmhciipan_alleles=netmhciipan_alleles)
     for allele in mhcii_alleles:
         if allele not in mhcii_restrictions[mhcii_options['pred']]:
             continue
-        mhcii_job = job.addChildJobFn(predict_mhcii_binding, pept_files['T_15_mer.faa'],  allele,
-                                      univ_options, mhcii_options, disk='100M', memory='100M',
-                                      cores=1)
+        tumor_peptfile, prefilter = pept_files['U_15_mer.faa'], None
+        if allele in pssms.get('mhcii', {}).get('matrices', {}) and \
+                '15' in pssms['mhcii']['matrices'][allele]:
+            tumor_peptfile, prefilter = _prefilter_peptides(job, unique_peptides['15'],
+                                                            allele, '15', pssms['mhcii'],
+                                                            mhcii_options, univ_options)
+        if routes.get(allele) == 'netMHCIIpan':
+            predict_fn, predict_args, predict_kwargs = predict_netmhcii_binding, \
+                (allele, univ_options, mhcii_options['netmhciipan']), {}
+        else:
+            predict_fn, predict_args, predict_kwargs = predict_mhcii_binding, \
+                (allele, univ_options, mhcii_options), {'predictor': routes.get(allele)}
+        if mhcii_options['chunk_size']:
+            mhcii_job = job.addChild(job.wrapJobFn(
+                predict_in_chunks, predict_fn, tumor_peptfile, int(mhcii_options['chunk_size']),
+                *predict_args, disk='100M', memory='100M', cores=1,
+                **predict_kwargs).encapsulate())
+        else:
+            mhcii_job = job.addChildJobFn(predict_fn, tumor_peptfile, *predict_args,
+                                          disk='100M', memory='100M', cores=1, **predict_kwargs)
         mhcii_preds[(allele, 15)] = mhcii_job.addFollowOnJobFn(
             predict_normal_binding,
             mhcii_job.rv(),
-            {x: y for x, y in pept_files.items() if '15' in x},
+            peptide_tables['15'],
             allele,
             '15',
             univ_options,
             mhcii_options,
+            prefilter=prefilter,
             disk='100M',
             memory='100M',
             cores=1).rv()
     return mhci_preds, mhcii_preds
 
 
-def read_fastas(input_files):
+def predict_in_chunks(job, predict_fn, peptfile, chunk_size, *args, **kwargs):
+    """
+    Split a peptide fasta into chunks of `chunk_size` records, run `predict_fn` on each chunk in
+    parallel and concatenate the results with merge_prediction_chunks.  Files with no more than
+    `chunk_size` records are predicted on as is.
+
+    :param function predict_fn: The prediction job function (predict_mhci_binding,
+           predict_mhcii_binding or predict_netmhcii_binding)
+    :param toil.fileStore.FileID peptfile: The input peptide fasta
+    :param int chunk_size: The number of fasta records in each chunk
+    :param list args: Positional arguments for `predict_fn` after the peptide file
+    :param dict kwargs: Keyword arguments for `predict_fn`
+    :return: The return value of `predict_fn` for the whole file
+    :rtype: toil.fileStore.FileID|tuple(toil.fileStore.FileID, str)
     """
-    Read the tumor and normal fastas into a joint dict.
+    work_dir = os.getcwd()
+    input_files = get_files_from_filestore(job, {'peptfile.faa': peptfile}, work_dir)
+    with read_peptide_file(input_files['peptfile.faa']) as peptides:
+        names = peptides.keys()
+        if len(names) <= chunk_size:
+            predictions = job.addChildJobFn(predict_fn, peptfile, *args, disk='100M',
+                                            memory='100M', cores=1, **kwargs)
+            return predictions.rv()
+        chunk_files = []
+        for chunk, start in enumerate(range(0, len(names), chunk_size)):
+            with open(os.path.join(work_dir, 'chunk_%s.faa' % chunk), 'w') as chunkfile:
+                for name in names[start:start + chunk_size]:
+                    print('>', name, '\n', peptides[name], sep='', file=chunkfile)
+            chunk_files.append(chunkfile.name)
+    chunks = [job.addChildJobFn(predict_fn, job.fileStore.writeGlobalFile(chunk_file), *args,
+                                disk='100M', memory='100M', cores=1, **kwargs)
+              for chunk_file in chunk_files]
+    job.fileStore.logToMaster('Predicting binding for %s peptide records from %s in %s chunks' %
+                              (len(names), predict_fn.__name__, len(chunks)))
+    merge = job.addFollowOnJobFn(merge_prediction_chunks, [chunk.rv() for chunk in chunks],
+                                 disk='100M', memory='100M', cores=1)
+    return merge.rv()
+
+
+def merge_prediction_chunks(job, chunk_predictions):
+    """
+    Concatenate the predictions made on each chunk of a peptide file into a single file in the
+    format of the predictor.  IEDB header lines are skipped by the parsers so they are kept as is,
+    but only the first netMHCIIpan header is kept.
 
-    :param dict input_files: A dict containing filename: filepath for T_ and N_ transgened files.
-    :return: The read fastas in a dictionary of tuples
+    :param list chunk_predictions: The return values of the prediction function on each chunk
+    :return: The predictions in the same form as those returned by the prediction function
+    :rtype: toil.fileStore.FileID|tuple(toil.fileStore.FileID, str)
+    """
+    work_dir = os.getcwd()
+    if isinstance(chunk_predictions[0], (tuple, list)):
+        predictors = [pred for _, pred in chunk_predictions if pred != 'None']
+        predictor = predictors[0] if predictors else 'None'
+        chunk_files = [fsid for fsid, pred in chunk_predictions if pred != 'None']
+    else:
+        predictor = None
+        chunk_files = chunk_predictions
+    with open(os.path.join(work_dir, 'predictions.tsv'), 'w') as outfile:
+        header_written = False
+        for chunk_file in chunk_files:
+            with open(job.fileStore.readGlobalFile(chunk_file)) as infile:
+                if predictor == 'netMHCIIpan':
+                    header = [infile.readline(), infile.readline()]
+                    if not header_written:
+                        outfile.writelines(header)
+                        header_written = True
+                for line in infile:
+                    outfile.write(line)
+    output_file = job.fileStore.writeGlobalFile(outfile.name)
+    return output_file if predictor is None else (output_file, predictor)
+
+
+# The predictors IEDB_recommended falls back through for MHCII, in order, and the names the
+# corresponding methods may be listed under in the restrictions file.
+_MHCII_ROUTES = (('Consensus', ('consensus3', 'consensus')),
+                 ('Sturniolo', ('sturniolo',)),
+                 ('netMHCIIpan', ('netmhciipan',)))
+
+
+def mhcii_predictor_routes(mhcii_restrictions, mhcii_options, netmhciipan_alleles=None):
+    """
+    Decide which predictor IEDB will use for each MHCII allele so that alleles IEDB would send to
+    netMHCIIpan are run on netMHCIIpan directly instead of after a wasted IEDB run.  Only done for
+    the IEDB_recommended method, using the per-method allele lists in the restrictions file and the
+    list of alleles netMHCIIpan supports.
+
+    :param dict mhcii_restrictions: The contents of the mhcii restrictions file
+    :param dict mhcii_options: Options specific to mhcii binding predictions
+    :param set netmhciipan_alleles: The alleles supported by netMHCIIpan, if known
+    :return: Dict of allele: predictor ('Consensus', 'Sturniolo' or 'netMHCIIpan').  Alleles
+             missing from the dict have to be detected from the IEDB predictions.  Consensus and
+             Sturniolo routes are only hints that predict_mhcii_binding checks against the method
+             IEDB reports.
     :rtype: dict
     """
-    tumor_file = [y for x, y in input_files.items() if x.startswith('T')][0]
-    normal_file = [y for x, y in input_files.items() if x.startswith('N')][0]
-    output_files = defaultdict(list)
-    output_files = _read_fasta(tumor_file, output_files)
-    num_entries = len(output_files)
-    output_files = _read_fasta(normal_file, output_files)
-    assert len(output_files) == num_entries
-    return output_files
+    if mhcii_options['pred'] != 'IEDB_recommended':
+        return {}
+    methods = {method.lower(): set(alleles) for method, alleles in mhcii_restrictions.items()}
+    if netmhciipan_alleles is not None:
+        methods['netmhciipan'] = set(netmhciipan_alleles)
+    routes = {}
+    for allele in mhcii_restrictions[mhcii_options['pred']]:
+        for predictor, names in _MHCII_ROUTES:
+            method = [name for name in names if name in methods]
+            if not method:
+                # We can't tell whether IEDB would use this predictor so leave it to IEDB
+                break
+            if allele in methods[method[0]]:
+                routes[allele] = predictor
+                break
+    return routes
+
+
+def load_pssms(pssm_file):
+    """
+    Load the position specific scoring matrices used to pre-filter peptides.  The file is a json
+    dict of <allele>: <peptide length>: matrix, where each matrix is a list of the scores for every
+    amino acid in `alphabet` at each position.  A matrix may be shorter than the peptide length
+    (e.g. a 9-mer core matrix for 15-mers) in which case a peptide gets the best score of any of its
+    cores.  The optional key `alphabet` gives the order of the amino acids in the matrices.
+
+    :param str pssm_file: Path to the json file of matrices
+    :return: The matrices and their alphabet
+             pssms:
+                |- 'alphabet': str
+                +- 'matrices':
+                      +- <allele>:
+                            +- <peptide length>: numpy.ndarray
+    :rtype: dict
+    """
+    with open(pssm_file, 'r') as infile:
+        matrices = json.load(infile)
+    alphabet = str(matrices.pop('alphabet', 'ACDEFGHIKLMNPQRSTVWY'))
+    for allele in matrices:
+        for peplen in matrices[allele]:
+            matrix = np.array(matrices[allele][peplen], dtype=float)
+            assert matrix.ndim == 2 and matrix.shape[1] == len(alphabet), \
+                'Bad matrix for %s:%s in the pssm file' % (allele, peplen)
+            # Residues outside the alphabet (X, *, etc) add nothing to the score
+            matrices[allele][peplen] = np.hstack([matrix, np.zeros((matrix.shape[0], 1))])
+    return {'alphabet': alphabet,
+            'matrices': matrices}
+
+
+def score_peptides(peptides, matrix, alphabet):
+    """
+    Score equal length peptides with a position specific scoring matrix.
+
+    :param list peptides: The peptides to score
+    :param numpy.ndarray matrix: The matrix returned by load_pssms
+    :param str alphabet: The amino acids in the order of the columns of `matrix`
+    :return: The score of each peptide
+    :rtype: numpy.ndarray
+    """
+    lookup = np.full(256, len(alphabet), dtype=np.intp)
+    lookup[np.frombuffer(alphabet, dtype=np.uint8)] = np.arange(len(alphabet))
+    peplen = len(peptides[0])
+    encoded = lookup[np.frombuffer(''.join(peptides), dtype=np.uint8).reshape(len(peptides),
+                                                                              peplen)]
+    positions = np.arange(matrix.shape[0])
+    scores = np.full(len(peptides), -np.inf)
+    for offset in range(peplen - matrix.shape[0] + 1):
+        scores = np.maximum(scores, matrix[positions, encoded[:, offset:offset +
+                                                              matrix.shape[0]]].sum(axis=1))
+    return scores
+
+
+def _prefilter_peptides(job, peptides, allele, peplen, pssms, mhc_options, univ_options):
+    """
+    Score the unique tumor peptides of length `peplen` for `allele` and write the best
+    `pssm_fraction` of them to a new peptide file.  A random `pssm_audit_fraction` of the remaining
+    peptides is also sent on so the recall of the filter can be estimated from the predictor results
+    in merge_mhc_peptide_calls.
+
+    :param list peptides: The unique tumor peptides returned by build_peptide_table
+    :param str allele: The allele to score for
+    :param str peplen: The length of the peptides
+    :param dict pssms: The matrices returned by load_pssms
+    :param dict mhc_options: Options specific to mhci or mhcii binding predictions
+    :param dict univ_options: Dict of universal options used by almost all tools
+    :return: fsID for the filtered peptide file, and the filter statistics
+             prefilter:
+                |- 'peptides': int
+                |- 'forwarded': int
+                |- 'audit_fraction': float
+                +- 'audit': fsID
+    :rtype: tuple(toil.fileStore.FileID, dict)
+    """
+    forward, audit, rest = set(), [], []
+    if peptides:
+        scores = score_peptides(peptides, pssms['matrices'][allele][peplen], pssms['alphabet'])
+        order = np.argsort(-scores, kind='mergesort')
+        num_kept = int(ceil(float(mhc_options['pssm_fraction']) * len(peptides)))
+        forward = set(order[:num_kept])
+        rest = list(order[num_kept:])
+        # Seeded so that re-runs forward the same peptides
+        audit = random.Random(len(peptides)).sample(
+            rest, int(round(float(mhc_options['pssm_audit_fraction']) * len(rest))))
+        forward.update(audit)
+    with open('_'.join([allele.replace('*', '').replace(':', '').replace('/', '_'), peplen,
+                        'prefiltered.faa']), 'w') as outfile:
+        for i in sorted(forward):
+            print('>', i, '\n', peptides[i], sep='', file=outfile)
+    with open(outfile.name + '.audit', 'w') as auditfile:
+        auditfile.writelines(peptides[i] + '\n' for i in audit)
+    job.fileStore.logToMaster('Forwarding %s of %s %s-mers for %s:%s to the predictors' %
+                              (len(forward), len(peptides), peplen, univ_options['patient'],
+                               allele))
+    return job.fileStore.writeGlobalFile(outfile.name), {
+        'peptides': len(peptides),
+        'forwarded': len(forward),
+        'audit_fraction': float(len(audit)) / len(rest) if rest else 0.0,
+        'audit': job.fileStore.writeGlobalFile(auditfile.name)}
+
+
+def build_peptide_table(iars, peplen, work_dir):
+    """
+    Build the table of unique tumor peptides of length `peplen` in the IARs.  Each peptide gets an
+    integer ID (its index in the returned list) and is stored with its normal counterpart and the
+    names of all the IARs containing it.  Peptides from IARs without a normal (fusions) get a normal
+    counterpart of all N's.  The unique peptides are also written to a fasta, named by ID, to be
+    sent to the predictors.  The IAR names are used to name the predictions for each peptide in
+    merge_mhc_peptide_calls.
+
+    :param dict iars: The tumor and normal peptide stores returned by read_fastas
+    :param str peplen: The length of the peptides
+    :param str work_dir: The directory to write the files into
+    :return: The unique peptides, the path to the fasta of unique peptides and the path to the table
+    :rtype: tuple(list, str, str)
+    """
+    peplen = int(peplen)
+    table = {}
+    peptides = []
+    for iar in iars['tumor']:
+        tum = iars['tumor'][iar]
+        norm = iars['normal'][iar] if iar in iars['normal'] else None
+        for i in range(len(tum) - peplen + 1):
+            pept = tum[i:i + peplen]
+            if pept not in table:
+                table[pept] = ('N' * peplen if norm is None else norm[i:i + peplen], [])
+                peptides.append(pept)
+            if iar not in table[pept][1]:
+                table[pept][1].append(iar)
+    unique_file = os.path.join(work_dir, 'unique_%s_mer.faa' % peplen)
+    table_file = os.path.join(work_dir, 'peptide_table_%s_mer.tsv' % peplen)
+    with open(unique_file, 'w') as ufile, open(table_file, 'w') as tfile:
+        for i, pept in enumerate(peptides):
+            print('>', i, '\n', pept, sep='', file=ufile)
+            print(i, pept, table[pept][0], ','.join(table[pept][1]), sep='\t', file=tfile)
+    return peptides, unique_file, table_file
+
+
+def read_peptide_table(table_file):
+    """
+    Read a table written by build_peptide_table.
 
+    :param str table_file: Path to the peptide table
+    :return: Dict of tumor peptide: (normal peptide, [IAR names])
+    :rtype: dict
+    """
+    table = {}
+    with open(table_file, 'r') as infile:
+        for line in infile:
+            _, pept, normal_pept, names = line.rstrip('\n').split('\t')
+            table[pept] = (normal_pept, names.split(','))
+    return table
 
-def _read_fasta(fasta_file, output_dict):
+
+def read_fastas(input_files):
     """
-    Read the peptide fasta into an existing dict.
+    Read the tumor and normal fastas into indexed, memory-mapped peptide stores.
 
-    :param str fasta_file: The peptide file
-    :param dict output_dict: The dict to appends results to.
-    :return: output_dict
+    :param dict input_files: A dict containing filename: filepath for T_ and N_ transgened files.
+    :return: The tumor and normal peptide stores
+             iars:
+                |- 'tumor': IndexedFasta
+                +- 'normal': IndexedFasta
     :rtype: dict
     """
-    read_name = None
-    with open(fasta_file, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            if line.startswith('>'):
-                read_name = line.lstrip('>')
-            else:
-                assert read_name is not None, line
-                output_dict[read_name].append(line.strip())
-    return output_dict
+    tumor_file = [y for x, y in input_files.items() if x.startswith('T')][0]
+    normal_file = [y for x, y in input_files.items() if x.startswith('N')][0]
+    iars = {'tumor': read_peptide_file(tumor_file),
+            'normal': read_peptide_file(normal_file)}
+    assert all(iar in iars['tumor'] for iar in iars['normal'])
+    return iars
 
 
 def _process_consensus_mhcii(mhc_file, normal=False):
@@ -304,63 +615,65 @@ def _process_mhci(mhc_file, normal=False):
     return results
 
 
-def _get_normal_peptides(mhc_df, iars, peplen):
+def _get_normal_peptides(mhc_df, peptide_table):
     """
-    Get the corresponding normal peptides for the tumor peptides that have already been subjected to
-    mhc:peptide binding prediction.
+    Get the corresponding normal peptides, and the names of the IARs holding them, for the tumor
+    peptides that have already been subjected to mhc:peptide binding prediction.
 
     :param pandas.DataFrame mhc_df: The dataframe of mhc:peptide binding results
-    :param dict iars: The dict of lists of tumor and normal peptide iar sequences
-    :param str peplen: Length of the peptides to consider.
-    :return: normal peptides and the updated results containing the normal peptides
+    :param dict peptide_table: The peptide table returned by read_peptide_table
+    :return: The updated results containing the normal peptides and the comma separated IAR names,
+             and the normal peptides
     :rtype: tuple(pandas.DataFrame, list)
     """
-    peplen = int(peplen)
-    normal_peptides = []
-    for pred in mhc_df.itertuples():
-        containing_iars = [i for i, sl in iars.items() if pred.pept in sl[0]]
-        assert len(containing_iars) != 0, "No IARS contained the peptide"
-        if len(containing_iars) > 1:
-            # If there are multiple IARs, they all or none of them have to have a corresponding
-            # normal.
-            assert len(set([len(y) for x, y in iars.items() if x in containing_iars])) == 1
-        if len(iars[containing_iars[0]]) == 1:
-            # This is a fusion and has no corresponding normal
-            normal_peptides.append('N'*peplen)
-        else:
-            tum, norm = iars[containing_iars[0]]
-            pos = tum.find(pred.pept)
-            normal_peptides.append(norm[pos:pos+peplen])
+    normal_peptides = [peptide_table[pept][0] for pept in mhc_df['pept']]
     mhc_df['normal_pept'] = normal_peptides
+    mhc_df['iars'] = [','.join(peptide_table[pept][1]) for pept in mhc_df['pept']]
     return mhc_df, normal_peptides
 
 
-def predict_normal_binding(job, binding_result, transgened_files, allele, peplen, univ_options,
-                           mhc_options):
+def _write_normal_peptides(job, peptides):
+    """
+    Write each of the unique normal peptides to a peptide file once, named by its sequence.
+
+    :param list peptides: The normal peptides
+    :return: fsID for the peptide file
+    :rtype: toil.fileStore.FileID
+    """
+    with open('peptides.faa', 'w') as pfile:
+        for pept in sorted(set(peptides)):
+            print('>', pept, '\n', pept, sep='', file=pfile)
+    return job.fileStore.writeGlobalFile(pfile.name)
+
+
+def predict_normal_binding(job, binding_result, peptide_table, allele, peplen, univ_options,
+                           mhc_options, prefilter=None):
     """
     Predict the binding score for the normal counterparts of the peptides in mhc_dict and then
     return the results in a properly formatted structure.
 
     :param str binding_result: The results from running predict_mhci_binding or
            predict_mhcii_binding on a single allele
-    :param dict transgened_files: A dictionary containing the jobstore IDs for "T_<peplen>_mer.faa"
-           and "N_<peplen>_mer.faa"
+    :param toil.fileStore.FileID peptide_table: fsID for the peptide table of length `peplen` built
+           by build_peptide_table
     :param str allele: The allele to get binding for
     :param str peplen: The peptide length
     :param dict univ_options: Dict of universal options used by almost all tools
     :param dict mhc_options: Options specific to mhci or mhcii binding predictions
+    :param dict prefilter: The statistics from pre-filtering the tumor peptides, if they were
     :return: A fully filled out mhc_dict with normal information
              output_dict:
                 |- 'tumor': fsID
-                +- 'normal': fsID or (fsID, str)     -- Depending on MHCI or MHCII
+                |- 'normal': fsID or (fsID, str)     -- Depending on MHCI or MHCII
+                +- 'prefilter': dict or None
     :rtype: dict
     """
     job.fileStore.logToMaster('Running predict_normal_binding on %s for allele %s and length %s' %
                               (univ_options['patient'], allele, peplen))
     work_dir = os.getcwd()
     results = pandas.DataFrame(columns=['allele', 'pept', 'tumor_pred', 'core'])
-    input_files = get_files_from_filestore(job, transgened_files, work_dir)
-    iars = read_fastas(input_files)
+    input_files = get_files_from_filestore(job, {'peptide_table.tsv': peptide_table}, work_dir)
+    peptide_table = read_peptide_table(input_files['peptide_table.tsv'])
     if peplen == '15':  # MHCII
         mhc_file = job.fileStore.readGlobalFile(binding_result[0],
                                                 os.path.join(work_dir, 'mhci_results'))
@@ -368,42 +681,36 @@ def predict_normal_binding(job, binding_result, transgened_files, allele, peplen
         core_col = None  # Variable to hold the column number with the core
         if predictor == 'Consensus':
             results = _process_consensus_mhcii(mhc_file)
-            results, peptides = _get_normal_peptides(results, iars, peplen)
-            with open('peptides.faa', 'w') as pfile:
-                for pept in peptides:
-                    print('>', pept, '\n', pept, sep='', file=pfile)
-            peptfile = job.fileStore.writeGlobalFile(pfile.name)
+            results, peptides = _get_normal_peptides(results, peptide_table)
+            peptfile = _write_normal_peptides(job, peptides)
             with open('results.json', 'w') as rj:
                 json.dump(results.to_json(), rj)
             return {'tumor': job.fileStore.writeGlobalFile(rj.name),
+                    'prefilter': prefilter,
                     'normal': job.addChildJobFn(predict_mhcii_binding, peptfile, allele,
                                                 univ_options, mhc_options, disk='100M',
                                                 memory='100M', cores=1).rv(),
                     'predictor': 'Consensus'}
         elif predictor == 'Sturniolo':
             results = _process_sturniolo_mhcii(mhc_file)
-            results, peptides = _get_normal_peptides(results, iars, peplen)
-            with open('peptides.faa', 'w') as pfile:
-                for pept in peptides:
-                    print('>', pept, '\n', pept, sep='', file=pfile)
-            peptfile = job.fileStore.writeGlobalFile(pfile.name)
+            results, peptides = _get_normal_peptides(results, peptide_table)
+            peptfile = _write_normal_peptides(job, peptides)
             with open('results.json', 'w') as rj:
                 json.dump(results.to_json(), rj)
             return {'tumor': job.fileStore.writeGlobalFile(rj.name),
+                    'prefilter': prefilter,
                     'normal': job.addChildJobFn(predict_mhcii_binding, peptfile, allele,
                                                 univ_options, mhc_options, disk='100M',
                                                 memory='100M', cores=1).rv(),
                     'predictor': 'Sturniolo'}
         elif predictor == 'netMHCIIpan':
             results = _process_net_mhcii(mhc_file)
-            results, peptides = _get_normal_peptides(results, iars, peplen)
-            with open('peptides.faa', 'w') as pfile:
-                for pept in peptides:
-                    print('>', pept, '\n', pept, sep='', file=pfile)
-            peptfile = job.fileStore.writeGlobalFile(pfile.name)
+            results, peptides = _get_normal_peptides(results, peptide_table)
+            peptfile = _write_normal_peptides(job, peptides)
             with open('results.json', 'w') as rj:
                 json.dump(results.to_json(), rj)
             return {'tumor': job.fileStore.writeGlobalFile(rj.name),
+                    'prefilter': prefilter,
                     'normal': job.addChildJobFn(predict_netmhcii_binding, peptfile, allele,
                                                 univ_options, mhc_options['netmhciipan'],
                                                 disk='100M', memory='100M',
@@ -416,14 +723,12 @@ def predict_normal_binding(job, binding_result, transgened_files, allele, peplen
         mhc_file = job.fileStore.readGlobalFile(binding_result,
                                                 os.path.join(work_dir, 'mhci_results'))
         results = _process_mhci(mhc_file)
-        results, peptides = _get_normal_peptides(results, iars, peplen)
-        with open('peptides.faa', 'w') as pfile:
-            for pept in peptides:
-                print('>', pept, '\n', pept, sep='', file=pfile)
-        peptfile = job.fileStore.writeGlobalFile(pfile.name)
+        results, peptides = _get_normal_peptides(results, peptide_table)
+        peptfile = _write_normal_peptides(job, peptides)
         with open('results.json', 'w') as rj:
             json.dump(results.to_json(), rj)
         return {'tumor': job.fileStore.writeGlobalFile(rj.name),
+                'prefilter': prefilter,
                 'normal': job.addChildJobFn(predict_mhci_binding, peptfile, allele, peplen,
                                             univ_options, mhc_options, disk='100M', memory='100M',
                                             cores=1).rv()}
@@ -431,7 +736,9 @@ def predict_normal_binding(job, binding_result, transgened_files, allele, peplen
 
 def merge_mhc_peptide_calls(job, antigen_predictions, transgened_files, univ_options):
     """
-    Merge all the calls generated by spawn_antigen_predictors.
+    Merge all the calls generated by spawn_antigen_predictors.  The prediction files for all alleles
+    are fetched from the file store up front, and then each allele is joined with its normal
+    predictions and written out in turn so only one allele is held in memory at a time.
 
     :param dict antigen_predictions: The return value from running :meth:`spawn_antigen_predictors`
     :param dict transgened_files: The transgened peptide files
@@ -444,111 +751,157 @@ def merge_mhc_peptide_calls(job, antigen_predictions, transgened_files, univ_opt
     """
     job.fileStore.logToMaster('Merging MHC calls')
     work_dir = os.getcwd()
-    pept_files = {
-        '10_mer.faa': transgened_files['transgened_tumor_10_mer_snpeffed.faa'],
-        '10_mer.faa.map': transgened_files['transgened_tumor_10_mer_snpeffed.faa.map'],
-        '15_mer.faa': transgened_files['transgened_tumor_15_mer_snpeffed.faa'],
-        '15_mer.faa.map': transgened_files['transgened_tumor_15_mer_snpeffed.faa.map']}
+    pept_files = {peplen + '_mer.faa.map':
+                  transgened_files['transgened_tumor_%s_mer_snpeffed.faa.map' % peplen]
+                  for peplen in ('9', '10', '15')
+                  if 'transgened_tumor_%s_mer_snpeffed.faa.map' % peplen in transgened_files}
     pept_files = get_files_from_filestore(job, pept_files, work_dir)
+    # The calls are named after the IARs of their own peptide length, so each length is mapped
+    # with its own .map file.  Without a 9-mer .map file the 9-mer calls fall back to the 10-mer
+    # one, and write_mhc_peptides fails on any IAR that isn't in it.
+    pepmaps = {}
+    for peplen in ('9', '10', '15'):
+        if peplen + '_mer.faa.map' in pept_files:
+            with open(pept_files[peplen + '_mer.faa.map'], 'r') as mapfile:
+                pepmaps[peplen] = json.load(mapfile)
+    if '9' not in pepmaps:
+        pepmaps['9'] = pepmaps['10']
     mhci_preds, mhcii_preds = antigen_predictions
-
-    # Merge MHCI calls
-    # Read 10-mer pepts into memory
-    peptides = read_peptide_file(pept_files['10_mer.faa'])
-    with open(pept_files['10_mer.faa.map'], 'r') as mapfile:
-        pepmap = json.load(mapfile)
-    with open('/'.join([work_dir, 'mhci_merged_files.list']), 'w') as mhci_resfile:
-        for key in mhci_preds:
-            tumor_file = job.fileStore.readGlobalFile(mhci_preds[key]['tumor'])
-            with open(tumor_file) as t_f:
-                tumor_df = pandas.read_json(eval(t_f.read()))
-            if tumor_df.empty:
-                continue
-            # TODO: There must be a better way of doing this
-            normal_df = _process_mhci(job.fileStore.readGlobalFile(mhci_preds[key]['normal']),
-                                      normal=True)
-            normal_dict = normal_df.set_index('pept')['tumor_pred']
-            normal_preds = [normal_dict[x] for x in list(tumor_df['normal_pept'])]
-            tumor_df['normal_pred'] = normal_preds
-            for pred in tumor_df.itertuples():
-                print_mhc_peptide(pred, peptides, pepmap, mhci_resfile)
-    # Merge MHCII calls
-    # read 15-mer pepts into memory
-    peptides = read_peptide_file(pept_files['15_mer.faa'])
-    with open(pept_files['15_mer.faa.map'], 'r') as mapfile:
-        pepmap = json.load(mapfile)
-    # Incorporate peptide names into the merged calls
-    with open('/'.join([work_dir, 'mhcii_merged_files.list']), 'w') as \
-            mhcii_resfile:
-        for key in mhcii_preds:
-            if mhcii_preds[key]['predictor'] == 'None':
-                continue
-            tumor_file = job.fileStore.readGlobalFile(mhcii_preds[key]['tumor'])
-            with open(tumor_file) as t_f:
-                tumor_df = pandas.read_json(eval(t_f.read()))
-            if tumor_df.empty:
-                continue
-            # TODO: There must be a better way of doing this
-            if mhcii_preds[key]['predictor'] == 'Consensus':
-                normal_df = _process_consensus_mhcii(
-                    job.fileStore.readGlobalFile(mhcii_preds[key]['normal'][0]),
-                    normal=True)
-            elif mhcii_preds[key]['predictor'] == 'Sturniolo':
-                normal_df = _process_sturniolo_mhcii(
-                    job.fileStore.readGlobalFile(mhcii_preds[key]['normal'][0]),
-                    normal=True)
-            elif mhcii_preds[key]['predictor'] == 'netMHCIIpan':
-                normal_df = _process_net_mhcii(
-                    job.fileStore.readGlobalFile(mhcii_preds[key]['normal'][0]),
-                    normal=True)
-            else:
-                assert False
-            normal_dict = normal_df.set_index('pept')['tumor_pred']
-            normal_preds = [normal_dict[x] for x in list(tumor_df['normal_pept'])]
-            tumor_df['normal_pred'] = normal_preds
-            for pred in tumor_df.itertuples():
-                print_mhc_peptide(pred, peptides, pepmap, mhcii_resfile,
-                                  netmhc=mhcii_preds[key]['predictor'] == 'netMHCIIpan')
+    mhcii_preds = {key: preds for key, preds in mhcii_preds.items()
+                   if preds['predictor'] != 'None'}
+    prediction_files = _prefetch_predictions(job, mhci_preds, mhcii_preds)
+    prefilter_stats = []
+    processors = {'Consensus': _process_consensus_mhcii,
+                  'Sturniolo': _process_sturniolo_mhcii,
+                  'netMHCIIpan': _process_net_mhcii}
+    for mhc, preds in (('mhci', mhci_preds), ('mhcii', mhcii_preds)):
+        with open('/'.join([work_dir, mhc + '_merged_files.list']), 'w', 1 << 20) as resfile:
+            for key in sorted(preds):
+                tumor_file, normal_file = prediction_files[(mhc, key)]
+                with open(tumor_file) as t_f:
+                    tumor_df = pandas.read_json(json.load(t_f))
+                prefilter_stats.append(_prefilter_recall(job, key, preds[key], tumor_df))
+                if tumor_df.empty:
+                    continue
+                if mhc == 'mhci':
+                    normal_df = _process_mhci(normal_file, normal=True)
+                else:
+                    normal_df = processors[preds[key]['predictor']](normal_file, normal=True)
+                write_mhc_peptides(join_normal_predictions(tumor_df, normal_df),
+                                   pepmaps[str(key[1])], resfile)
+    prefilter_stats = [x for x in prefilter_stats if x is not None]
+    if prefilter_stats:
+        with open('/'.join([work_dir, 'mhc_prefilter_recall.tsv']), 'w') as recall_file:
+            print('allele', 'length', 'peptides', 'forwarded', 'binders', 'audit_binders',
+                  'estimated_recall', sep='\t', file=recall_file)
+            for stats in prefilter_stats:
+                print(*stats, sep='\t', file=recall_file)
+        export_results(job, job.fileStore.writeGlobalFile(recall_file.name), recall_file.name,
+                       univ_options, subfolder='binding_predictions')
     output_files = defaultdict()
-    for mhc_file in [mhci_resfile.name, mhcii_resfile.name]:
+    for mhc in ('mhci', 'mhcii'):
+        mhc_file = '/'.join([work_dir, mhc + '_merged_files.list'])
         output_files[os.path.split(mhc_file)[1]] = job.fileStore.writeGlobalFile(mhc_file)
         export_results(job, output_files[os.path.split(mhc_file)[1]], mhc_file, univ_options,
                        subfolder='binding_predictions')
     return output_files
 
 
-def print_mhc_peptide(neoepitope_info, peptides, pepmap, outfile, netmhc=False):
+def _prefetch_predictions(job, mhci_preds, mhcii_preds):
     """
-    Accept data about one neoepitope from merge_mhc_peptide_calls and print it to outfile.  This is
-    a generic module to reduce code redundancy.
+    Read the tumor and normal prediction files for every allele from the file store.
 
-    :param pandas.core.frame neoepitope_info: object containing with allele, pept, pred, core,
-           normal_pept, normal_pred
-    :param dict peptides: Dict of pepname: pep sequence for all IARS considered
-    :param dict pepmap: Dict containing teh contents from the peptide map file.
+    :param dict mhci_preds: The mhci predictions returned by spawn_antigen_predictors
+    :param dict mhcii_preds: The mhcii predictions returned by spawn_antigen_predictors
+    :return: Dict of (mhc, key): (path to tumor file, path to normal file)
+    :rtype: dict
+    """
+    fsids = {}
+    for mhc, preds in (('mhci', mhci_preds), ('mhcii', mhcii_preds)):
+        for key in preds:
+            normal = preds[key]['normal'][0] if mhc == 'mhcii' else preds[key]['normal']
+            fsids[(mhc, key)] = (preds[key]['tumor'], normal)
+    # The file store isn't thread safe so the files are read one at a time
+    return {key: (job.fileStore.readGlobalFile(tumor), job.fileStore.readGlobalFile(normal))
+            for key, (tumor, normal) in fsids.items()}
+
+
+def join_normal_predictions(tumor_df, normal_df):
+    """
+    Add the predictions for the normal counterparts of the tumor peptides to the tumor predictions
+    for an allele.  Fusion peptides (with a normal counterpart of all N's) get 'NA' for both the
+    normal peptide and its prediction.
+
+    :param pandas.DataFrame tumor_df: The tumor predictions with a normal_pept column
+    :param pandas.DataFrame normal_df: The normal predictions
+    :return: The tumor predictions with a normal_pred column
+    :rtype: pandas.DataFrame
+    """
+    normal_df = normal_df[['pept', 'tumor_pred']].drop_duplicates('pept')
+    normal_df.columns = ['normal_pept', 'normal_pred']
+    merged = tumor_df.merge(normal_df, on='normal_pept', how='left')
+    fusions = merged['normal_pept'].str.count('N') == merged['pept'].str.len()
+    merged['normal_pept'] = merged['normal_pept'].where(~fusions, 'NA')
+    merged['normal_pred'] = merged['normal_pred'].where(~fusions, 'NA')
+    return merged
+
+
+def write_mhc_peptides(merged_df, pepmap, outfile, buffer_lines=100000):
+    """
+    Write the merged calls for an allele to outfile, one line per IAR containing each peptide.  The
+    lines are written in blocks of `buffer_lines`.
+
+    :param pandas.DataFrame merged_df: The merged calls from join_normal_predictions
+    :param dict pepmap: Dict containing the contents from the peptide map file for the length of
+           the calls
     :param file outfile: An open file descriptor to the output file
-    :param bool netmhc: Does this record correspond to a netmhcIIpan record? These are processed
-           differently.
+    :param int buffer_lines: The number of lines to hold before writing them out
     """
-    if netmhc:
-        peptide_names = [neoepitope_info.peptide_name]
-    else:
-        peptide_names = [x for x, y in peptides.items() if neoepitope_info.pept in y]
-    # Convert named tuple to dict so it can be modified
-    neoepitope_info = neoepitope_info._asdict()
-    # Handle fusion peptides (They are characterized by having all N's as the normal partner)
-    if neoepitope_info['normal_pept'] == 'N' * len(neoepitope_info['pept']):
-        neoepitope_info['normal_pept'] = neoepitope_info['normal_pred'] = 'NA'
-    # For each peptide, append the ensembl gene
-    for peptide_name in peptide_names:
-        print('{ni[allele]}\t'
-              '{ni[pept]}\t'
-              '{ni[normal_pept]}\t'
-              '{pname}\t'
-              '{ni[core]}\t'
-              '0\t'
-              '{ni[tumor_pred]}\t'
-              '{ni[normal_pred]}\t'
-              '{pmap}'.format(ni=neoepitope_info, pname=peptide_name,
-                                                  pmap=pepmap[peptide_name]), file=outfile)
+    lines = []
+    columns = [merged_df[x] for x in ('allele', 'pept', 'normal_pept', 'core', 'tumor_pred',
+                                      'normal_pred', 'iars')]
+    for allele, pept, normal_pept, core, tumor_pred, normal_pred, iars in zip(*columns):
+        # The predictors only see the unique peptides so fan each one back out to every IAR
+        # holding it
+        for peptide_name in iars.split(','):
+            if peptide_name not in pepmap:
+                raise RuntimeError('The IAR %s holding %s (called for %s) is not in the peptide '
+                                   'map file.' % (peptide_name, pept, allele))
+            lines.append('{}\t{}\t{}\t{}\t{}\t0\t{}\t{}\t{}\n'.format(
+                allele, pept, normal_pept, peptide_name, core, tumor_pred, normal_pred,
+                pepmap[peptide_name]))
+        if len(lines) >= buffer_lines:
+            outfile.writelines(lines)
+            lines = []
+    outfile.writelines(lines)
     return None
+
+
+def _prefilter_recall(job, key, preds, tumor_df):
+    """
+    Estimate the recall of the pssm pre-filter for one allele from the binders predicted among the
+    forwarded peptides, and among the random audit sample of the peptides that were filtered out.
+
+    :param tuple key: The (allele, peptide length) the predictions are for
+    :param dict preds: The predictions for the allele returned by predict_normal_binding
+    :param pandas.DataFrame tumor_df: The predicted tumor binders for the allele
+    :return: allele, length, peptides, forwarded, binders, audit binders and estimated recall, or
+             None if the peptides weren't pre-filtered
+    :rtype: list|None
+    """
+    if not preds.get('prefilter'):
+        return None
+    prefilter = preds['prefilter']
+    with open(job.fileStore.readGlobalFile(prefilter['audit'])) as auditfile:
+        audit = set(line.strip() for line in auditfile)
+    binders = set(tumor_df['pept']) if not tumor_df.empty else set()
+    audit_binders = len(binders & audit)
+    binders = len(binders) - audit_binders
+    if prefilter['audit_fraction'] and binders + audit_binders:
+        recall = '%.3f' % (binders / (binders + audit_binders / prefilter['audit_fraction']))
+    else:
+        recall = 'NA'
+    job.fileStore.logToMaster('Estimated recall of the pssm pre-filter for %s:%s is %s' %
+                              (key[0], key[1], recall))
+    return [key[0], key[1], prefilter['peptides'], prefilter['forwarded'], binders, audit_binders,
+            recall]
@@ -38,8 +38,9 @@ def predict_mhci_binding(job, peptfile, allele, peplen, univ_options, mhci_optio
     input_files = {
         'peptfile.faa': peptfile}
     input_files = get_files_from_filestore(job, input_files, work_dir, docker=True)
-    peptides = read_peptide_file(os.path.join(os.getcwd(), 'peptfile.faa'))
-    if not peptides:
+    with read_peptide_file(os.path.join(os.getcwd(), 'peptfile.faa')) as peptides:
+        empty = not peptides
+    if empty:
         return job.fileStore.writeGlobalFile(job.fileStore.getLocalTempFile())
     parameters = [mhci_options['pred'],
                   allele,
@@ -20,7 +20,7 @@ import os
 import re
 
 
-def predict_mhcii_binding(job, peptfile, allele, univ_options, mhcii_options):
+def predict_mhcii_binding(job, peptfile, allele, univ_options, mhcii_options, predictor=None):
     """
     Predict binding for each peptide in `peptfile` to `allele` using the IEDB mhcii binding
     prediction tool.
@@ -29,6 +29,9 @@ def predict_mhcii_binding(job, peptfile, allele, univ_options, mhcii_options):
     :param str allele: Allele to predict binding against
     :param dict univ_options: Dict of universal options used by almost all tools
     :param dict mhcii_options: Options specific to mhcii binding prediction
+    :param str predictor: The predictor ('Consensus' or 'Sturniolo') IEDB is expected to use for
+           `allele`.  The predictor is always read from the predictions, and netMHCIIpan is run if
+           that is what IEDB used.  A mismatch with the expected predictor is logged.
     :return: tuple of fsID for file containing the predictions and the predictor used
     :rtype: tuple(toil.fileStore.FileID, str)
     """
@@ -37,39 +40,53 @@ def predict_mhcii_binding(job, peptfile, allele, univ_options, mhcii_options):
     input_files = {
         'peptfile.faa': peptfile}
     input_files = get_files_from_filestore(job, input_files, work_dir, docker=True)
-    peptides = read_peptide_file(os.path.join(os.getcwd(), 'peptfile.faa'))
+    with read_peptide_file(os.path.join(os.getcwd(), 'peptfile.faa')) as peptides:
+        empty = not peptides
     parameters = [mhcii_options['pred'],
                   allele,
                   input_files['peptfile.faa']]
-    if not peptides:
+    if empty:
         return job.fileStore.writeGlobalFile(job.fileStore.getLocalTempFile()), 'None'
     with open('/'.join([work_dir, 'predictions.tsv']), 'w') as predfile:
         docker_call(tool='mhcii', tool_parameters=parameters, work_dir=work_dir,
                     dockerhub=univ_options['dockerhub'], outfile=predfile, interactive=True,
                     tool_version=mhcii_options['version'])
-    run_netmhciipan = True
-    predictor = None
-    with open(predfile.name, 'r') as predfile:
-        for line in predfile:
-            if not line.startswith('HLA'):
-                continue
-            if line.strip().split('\t')[5] == 'NetMHCIIpan':
-                break
-            # If the predictor type is sturniolo then it needs to be processed differently
-            elif line.strip().split('\t')[5] == 'Sturniolo':
-                predictor = 'Sturniolo'
-            else:
-                predictor = 'Consensus'
-            run_netmhciipan = False
-            break
-    if run_netmhciipan:
+    used_predictor = _read_mhcii_predictor(predfile.name)
+    if predictor is not None and used_predictor != predictor:
+        job.fileStore.logToMaster('IEDB used %s instead of the expected %s for %s:%s' %
+                                  (used_predictor, predictor, univ_options['patient'], allele))
+    if used_predictor == 'netMHCIIpan':
         netmhciipan = job.addChildJobFn(predict_netmhcii_binding, peptfile, allele, univ_options,
                                         mhcii_options['netmhciipan'], disk='100M', memory='100M',
                                         cores=1)
         return netmhciipan.rv()
     else:
         output_file = job.fileStore.writeGlobalFile(predfile.name)
-        return output_file, predictor
+        return output_file, used_predictor
+
+
+def _read_mhcii_predictor(predfile):
+    """
+    Read the predictor IEDB used from the method column of the first prediction in `predfile`.
+
+    :param str predfile: Path to the IEDB mhcii predictions
+    :return: The predictor used ('Consensus', 'Sturniolo' or 'netMHCIIpan').  A file without
+             predictions is treated as netMHCIIpan so that netMHCIIpan is run instead.
+    :rtype: str
+    """
+    with open(predfile, 'r') as infile:
+        for line in infile:
+            if not line.startswith('HLA'):
+                continue
+            method = line.strip().split('\t')[5]
+            if method == 'NetMHCIIpan':
+                return 'netMHCIIpan'
+            # If the predictor type is sturniolo then it needs to be processed differently
+            elif method == 'Sturniolo':
+                return 'Sturniolo'
+            else:
+                return 'Consensus'
+    return 'netMHCIIpan'
 
 
 def predict_netmhcii_binding(job, peptfile, allele, univ_options, netmhciipan_options):
@@ -88,8 +105,9 @@ def predict_netmhcii_binding(job, peptfile, allele, univ_options, netmhciipan_op
     input_files = {
         'peptfile.faa': peptfile}
     input_files = get_files_from_filestore(job, input_files, work_dir, docker=True)
-    peptides = read_peptide_file(os.path.join(os.getcwd(), 'peptfile.faa'))
-    if not peptides:
+    with read_peptide_file(os.path.join(os.getcwd(), 'peptfile.faa')) as peptides:
+        empty = not peptides
+    if empty:
         return job.fileStore.writeGlobalFile(job.fileStore.getLocalTempFile()), 'None'
     # netMHCIIpan accepts differently formatted alleles so we need to modify the input alleles
     if allele.startswith('HLA-DQA') or allele.startswith('HLA-DPA'):
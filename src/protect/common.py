@@ -22,16 +22,20 @@ Details can also be obtained by running the script with -h .
 """
 from __future__ import print_function
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from urlparse import urlparse
 
 import errno
+import fcntl
 import gzip
+import hashlib
 import logging
+import mmap
 import os
 import re
+import shutil
 import smtplib
 import socket
 import subprocess
@@ -159,6 +163,83 @@ def untargz(input_targz_file, untar_to_dir):
     return return_value
 
 
+def get_cached_index(job, index, cache_dir, cache_key, work_dir):
+    """
+    Get an untarred copy of a tar.gz'd index in `work_dir`.  The index is only downloaded and
+    untarred if it isn't already in the node-local `cache_dir`, so jobs on the same node (e.g.
+    shards of the same tool) and later runs reuse the same copy.  The cached copy is hard-linked
+    into `work_dir` (or copied if the cache is on a different device) so it is visible to docker.
+
+    :param toil.fileStore.FileID index: fsID for the tar.gz'd index
+    :param str cache_dir: The node-local directory to cache untarred indexes in
+    :param str cache_key: A name that uniquely identifies the index in the cache
+    :param str work_dir: The directory to place the index in
+    :return: path to the untar-ed directory/file in `work_dir`
+    :rtype: str
+    """
+    cache_dir = os.path.join(os.path.abspath(cache_dir), cache_key)
+    try:
+        os.makedirs(cache_dir)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    # Only one job per node untars the index. The rest wait on the lock and then reuse it.
+    with open(os.path.join(cache_dir, '.lock'), 'w') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(os.path.join(cache_dir, '.complete')):
+                with open(os.path.join(cache_dir, '.complete')) as complete:
+                    index_name = complete.read().strip()
+            else:
+                tarball = get_files_from_filestore(job, {'index.tar.gz': index}, work_dir)
+                index_name = os.path.basename(untargz(tarball['index.tar.gz'], cache_dir))
+                os.remove(tarball['index.tar.gz'])
+                with open(os.path.join(cache_dir, '.complete'), 'w') as complete:
+                    complete.write(index_name)
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+    _link_or_copy(os.path.join(cache_dir, index_name), os.path.join(work_dir, index_name))
+    return os.path.join(work_dir, index_name)
+
+
+def get_file_digest(job, fsid, block_size=1048576):
+    """
+    Get the md5 digest of the contents of a file in the file store.  Caches of files derived from a
+    reference are keyed on this so an updated reference is never served from a stale entry.
+
+    :param toil.fileStore.FileID fsid: fsID for the file
+    :param int block_size: The number of bytes to read at a time
+    :return: The hex digest
+    :rtype: str
+    """
+    digest = hashlib.md5()
+    with job.fileStore.readGlobalFileStream(fsid) as in_file:
+        for block in iter(lambda: in_file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _link_or_copy(src, dst):
+    """
+    Recreate the file or directory tree at `src` at `dst` using hard links, falling back to copying
+    the files if `src` and `dst` are on different devices.
+
+    :param str src: The file or directory to link
+    :param str dst: The path to link it to
+    """
+    if os.path.isdir(src):
+        os.mkdir(dst)
+        for name in os.listdir(src):
+            _link_or_copy(os.path.join(src, name), os.path.join(dst, name))
+        return
+    try:
+        os.link(src, dst)
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+        shutil.copy2(src, dst)
+
+
 def gunzip(input_gzip_file, block_size=1024):
     """
     Gunzips the input file to the same directory
@@ -202,6 +283,28 @@ def is_gzipfile(filename):
             return False
 
 
+def bgzip_and_tabix_vcf(job, in_vcf, univ_options, htslib_options):
+    """
+    Bgzip a position-sorted vcf in place and index it with tabix.
+
+    :param str in_vcf: Path to the sorted, uncompressed vcf
+    :param dict univ_options: Dict of universal options used by almost all tools
+    :param dict htslib_options: Options specific to htslib
+    :return: Path to the bgzipped vcf.  The index is at the same path + '.tbi'
+    :rtype: str
+    """
+    work_dir = os.path.dirname(os.path.abspath(in_vcf))
+    # Creates in_vcf.gz in place of in_vcf
+    parameters = ['bgzip', '-f', docker_path(in_vcf)]
+    docker_call(tool='htslib', tool_parameters=parameters, work_dir=work_dir,
+                dockerhub=univ_options['dockerhub'], tool_version=htslib_options['version'])
+    # Creates in_vcf.gz.tbi
+    parameters = ['tabix', '-f', '-p', 'vcf', docker_path(in_vcf) + '.gz']
+    docker_call(tool='htslib', tool_parameters=parameters, work_dir=work_dir,
+                dockerhub=univ_options['dockerhub'], tool_version=htslib_options['version'])
+    return in_vcf + '.gz'
+
+
 def get_file_from_gdc(job, gdc_url, gdc_download_token, write_to_jobstore=True):
     """
     Download a supplied "URL" that points to a file in the NCBI GDC database.  The path to the gdc
@@ -499,22 +602,85 @@ class ParameterError(Exception):
 
 def read_peptide_file(in_peptfile):
     """
-    Reads an input peptide fasta file into memory in the form of a dict of fasta record: sequence
+    Reads an input peptide fasta file into an indexed, memory-mapped store of fasta record: sequence
 
     :param str in_peptfile: Path to a peptide fasta
-    :return: Dict of fasta record: sequence
-    :rtype: dict
+    :return: Dict-like store of fasta record: sequence
+    :rtype: IndexedFasta
     """
-    peptides = defaultdict()
-    pept = None
-    with open(in_peptfile, 'r') as peptfile:
-        for line in peptfile:
-            if line.startswith('>'):
-                pept = line.strip().lstrip('>')
-                peptides[pept] = ''
-            else:
-                peptides[pept] = line.strip()
-    return peptides
+    return IndexedFasta(in_peptfile)
+
+
+class IndexedFasta(object):
+    """
+    A read-only fasta file that is memory-mapped and indexed by record name (faidx-style) so that
+    records are read from the page cache on demand instead of being held in memory as python
+    strings.  Pages of the file are shared between processes that open the same fasta.  Use it as a
+    context manager (or call close()) to release the file and the mapping.
+    """
+    def __init__(self, fasta_file, index=None):
+        """
+        :param str fasta_file: Path to the fasta file
+        :param OrderedDict index: A previously built index (IndexedFasta.index) of the same file,
+               to skip re-indexing it
+        """
+        self.fasta_file = fasta_file
+        self._handle = open(fasta_file, 'rb')
+        if os.path.getsize(fasta_file) == 0:
+            self._mmap = ''
+        else:
+            self._mmap = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index = self._build_index() if index is None else index
+        self._names = list(self.index)
+
+    def _build_index(self):
+        """
+        Find the start and end of the sequence of every record in the fasta.
+
+        :return: Dict of record name: (sequence start, sequence end) in file order
+        :rtype: OrderedDict
+        """
+        index = OrderedDict()
+        header_start = self._mmap.find('>')
+        while header_start != -1:
+            header_end = self._mmap.find('\n', header_start)
+            if header_end == -1:
+                header_end = len(self._mmap)
+            next_start = self._mmap.find('\n>', header_end)
+            seq_end = len(self._mmap) if next_start == -1 else next_start
+            index[self._mmap[header_start + 1:header_end].strip()] = (header_end + 1, seq_end)
+            header_start = next_start if next_start == -1 else next_start + 1
+        return index
+
+    def __getitem__(self, name):
+        start, end = self.index[name]
+        return self._mmap[start:end].replace('\n', '').replace('\r', '')
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def keys(self):
+        return list(self._names)
+
+    def items(self):
+        return [(name, self[name]) for name in self._names]
+
+    def close(self):
+        if self._mmap:
+            self._mmap.close()
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 def parse_chromosome_string(job, chromosome_string):
@@ -615,6 +781,68 @@ def canonical_chrom_sorted(in_chroms):
     return in_chroms
 
 
+def split_vcf_into_shards(in_vcf, num_shards, work_dir):
+    """
+    Split a vcf into at most `num_shards` vcfs, each containing all the records from a set of whole
+    chromosomes.  Chromosomes are assigned largest first to the shard with the fewest records so
+    far.  Each shard gets the full header of the input vcf.
+
+    :param str in_vcf: Path to the vcf to split
+    :param int num_shards: The maximum number of shards to create
+    :param str work_dir: The directory to write the shards into
+    :return: Paths to the shard vcfs (Empty if the vcf has no records)
+    :rtype: list[str]
+    """
+    header = []
+    records = defaultdict(list)
+    with open(in_vcf) as infile:
+        for line in infile:
+            if line.startswith('#'):
+                header.append(line)
+            else:
+                records[line.split('\t', 1)[0]].append(line)
+    shards = [[] for _ in range(min(num_shards, len(records)))]
+    shard_sizes = [0] * len(shards)
+    for chrom in sorted(records, key=lambda x: len(records[x]), reverse=True):
+        shard = shard_sizes.index(min(shard_sizes))
+        shards[shard].append(chrom)
+        shard_sizes[shard] += len(records[chrom])
+    prefix = os.path.splitext(os.path.basename(in_vcf))[0]
+    shard_vcfs = []
+    for shard, chroms in enumerate(shards):
+        shard_vcfs.append(os.path.join(work_dir, '%s_shard%s.vcf' % (prefix, shard)))
+        with open(shard_vcfs[-1], 'w') as outfile:
+            outfile.writelines(header)
+            for chrom in chrom_sorted(chroms):
+                outfile.writelines(records[chrom])
+    return shard_vcfs
+
+
+def merge_sharded_vcfs(in_vcfs, out_vcf):
+    """
+    Merge vcfs produced from the shards created by split_vcf_into_shards into a single vcf with the
+    header of the first vcf and the records in chromosome order.
+
+    :param list in_vcfs: Paths to the vcfs to merge
+    :param str out_vcf: Path to the output vcf
+    :return: Path to the output vcf
+    :rtype: str
+    """
+    records = defaultdict(list)
+    with open(out_vcf, 'w') as outfile:
+        for i, in_vcf in enumerate(in_vcfs):
+            with open(in_vcf) as infile:
+                for line in infile:
+                    if line.startswith('#'):
+                        if i == 0:
+                            outfile.write(line)
+                    else:
+                        records[line.split('\t', 1)[0]].append(line)
+        for chrom in chrom_sorted(records.keys()):
+            outfile.writelines(records[chrom])
+    return out_vcf
+
+
 def email_report(job, univ_options):
     """
     Send an email to the user when the run finishes.
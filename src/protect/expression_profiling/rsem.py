@@ -22,7 +22,10 @@ from protect.common import (docker_call,
                             untargz)
 from toil.job import PromisedRequirement
 
+import numpy as np
 import os
+import pandas
+import zipfile
 
 
 # disk for rsem
@@ -39,8 +42,10 @@ def wrap_rsem(job, star_bams, univ_options, rsem_options):
     :param dict star_bams: dict of results from star
     :param dict univ_options: Dict of universal options used by almost all tools
     :param dict rsem_options: Options specific to rsem
-    :return: Dict of gene- and isoform-level expression calls
+    :return: Dict of gene- and isoform-level expression calls, and the table of both made by
+             make_expression_table
              output_files:
+                 |- 'rsem.expression.npz': fsID
                  |- 'rsem.genes.results': fsID
                  +- 'rsem.isoforms.results': fsID
     :rtype: dict
@@ -49,8 +54,9 @@ def wrap_rsem(job, star_bams, univ_options, rsem_options):
                              univ_options, rsem_options, cores=rsem_options['n'],
                              disk=PromisedRequirement(rsem_disk, star_bams,
                                                       rsem_options['index']))
-
-    return rsem.rv()
+    expression_table = rsem.addChildJobFn(make_expression_table, rsem.rv(), univ_options,
+                                          disk='100M', memory='100M', cores=1)
+    return expression_table.rv()
 
 
 def run_rsem(job, rna_bam, univ_options, rsem_options):
@@ -92,3 +98,125 @@ def run_rsem(job, rna_bam, univ_options, rsem_options):
         export_results(job, output_files[filename], '/'.join([work_dir, filename]), univ_options,
                        subfolder='expression')
     return output_files
+
+
+def make_expression_table(job, rsem_files, univ_options):
+    """
+    Parse the rsem gene and isoform results once into a single binary table so the reports and
+    rankboost can load the expression without re-parsing the rsem output.  See
+    write_expression_table.
+
+    :param dict rsem_files: Dict of results from rsem
+    :param dict univ_options: Dict of universal options used by almost all tools
+    :return: The rsem results with the expression table added
+             output_files:
+                 |- 'rsem.expression.npz': fsID
+                 |- 'rsem.genes.results': fsID
+                 +- 'rsem.isoforms.results': fsID
+    :rtype: dict
+    """
+    job.fileStore.logToMaster('Making the expression table for %s' % univ_options['patient'])
+    work_dir = os.getcwd()
+    input_files = {
+        'rsem.genes.results': rsem_files['rsem.genes.results'],
+        'rsem.isoforms.results': rsem_files['rsem.isoforms.results']}
+    input_files = get_files_from_filestore(job, input_files, work_dir, docker=False)
+    write_expression_table(input_files['rsem.genes.results'], input_files['rsem.isoforms.results'],
+                           os.path.join(work_dir, 'rsem.expression.npz'))
+    output_files = dict(rsem_files)
+    output_files['rsem.expression.npz'] = job.fileStore.writeGlobalFile(
+        os.path.join(work_dir, 'rsem.expression.npz'))
+    return output_files
+
+
+# The columns kept from the rsem results
+EXPRESSION_COLUMNS = ('expected_count', 'TPM', 'FPKM')
+
+
+def _read_rsem_results(rsem_file):
+    """
+    Read an rsem gene or isoform results file, dropping the version from the ids.  Ids that only
+    differ in their version (e.g. the PAR_Y copies of genes) are summed.
+
+    :param str rsem_file: Path to the rsem results
+    :return: The expression indexed by id, with the gene id of each isoform for isoform results
+    :rtype: pandas.DataFrame
+    """
+    results = pandas.read_table(rsem_file, index_col=0)
+    results.index = results.index.str.split('.').str[0]
+    aggregation = {column: 'sum' for column in EXPRESSION_COLUMNS}
+    if 'IsoPct' in results.columns:
+        results['gene_id'] = results['gene_id'].str.split('.').str[0]
+        aggregation['gene_id'] = 'first'
+    return results.groupby(level=0).agg(aggregation)
+
+
+def write_expression_table(genes_file, isoforms_file, out_file):
+    """
+    Write the gene and isoform expression from rsem to a numpy .npz file of versionless ids and
+    their expected counts, TPM and FPKM.
+
+    :param str genes_file: Path to the rsem gene results
+    :param str isoforms_file: Path to the rsem isoform results
+    :param str out_file: Path to write the table to
+    :return: None
+    """
+    arrays = {}
+    for level, rsem_file in (('genes', genes_file), ('isoforms', isoforms_file)):
+        results = _read_rsem_results(rsem_file)
+        arrays[level + '_id'] = np.array(results.index, dtype=str)
+        for column in EXPRESSION_COLUMNS:
+            arrays[level + '_' + column] = results[column].values.astype(float)
+        if level == 'isoforms':
+            arrays['isoforms_gene_id'] = np.array(results['gene_id'], dtype=str)
+    with open(out_file, 'wb') as outfile:
+        np.savez(outfile, **arrays)
+
+
+def _load_expression(expression_file, level):
+    """
+    Load the gene or isoform expression from a table written by write_expression_table, or from the
+    corresponding rsem results file.
+
+    :param str expression_file: Path to the table or rsem results
+    :param str level: 'genes' or 'isoforms'
+    :return: The expression indexed by versionless id
+    :rtype: pandas.DataFrame
+    """
+    if not zipfile.is_zipfile(expression_file):
+        return _read_rsem_results(expression_file)
+    table = np.load(expression_file)
+    try:
+        results = pandas.DataFrame({column: table[level + '_' + column]
+                                    for column in EXPRESSION_COLUMNS},
+                                   index=table[level + '_id'].astype(str))
+        if level == 'isoforms':
+            results['gene_id'] = table['isoforms_gene_id'].astype(str)
+    finally:
+        table.close()
+    return results
+
+
+def load_gene_expression(expression_file):
+    """
+    Load the gene expression for a patient.
+
+    :param str expression_file: Path to the table made by make_expression_table, or to the rsem
+           gene results
+    :return: The expected_count, TPM and FPKM of each gene, indexed by versionless gene id
+    :rtype: pandas.DataFrame
+    """
+    return _load_expression(expression_file, 'genes')
+
+
+def load_isoform_expression(expression_file):
+    """
+    Load the isoform expression for a patient.
+
+    :param str expression_file: Path to the table made by make_expression_table, or to the rsem
+           isoform results
+    :return: The gene_id, expected_count, TPM and FPKM of each isoform, indexed by versionless
+             transcript id
+    :rtype: pandas.DataFrame
+    """
+    return _load_expression(expression_file, 'isoforms')
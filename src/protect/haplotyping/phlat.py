@@ -21,10 +21,26 @@ from protect.common import (docker_call,
                             export_results,
                             get_files_from_filestore,
                             is_gzipfile,
+                            ParameterError,
                             untargz)
 
+import errno
+import gzip
+import hashlib
+import itertools
+import numbers
+import numpy as np
 import os
 import re
+import shutil
+import uuid
+
+# 2-bit codes for the bases.  Any other base (N, etc.) is coded 4 and breaks the k-mers spanning it.
+_BASE_CODES = np.full(256, 4, dtype=np.uint8)
+_BASE_CODES[np.frombuffer(b'ACGTacgt', dtype=np.uint8)] = [0, 1, 2, 3, 0, 1, 2, 3]
+
+# The number of read pairs to subsample to with read_budget: auto
+_AUTO_READ_BUDGET = 20000000
 
 
 # disk for phlat
@@ -75,6 +91,265 @@ def run_phlat(job, fastqs, sample_type, univ_options, phlat_options):
     return output_file
 
 
+def subsample_phlat_reads(job, fastqs, sample_type, univ_options, phlat_options):
+    """
+    Subsample a pair of input fastqs of type `sample_type` to about phlat_options['read_budget']
+    read pairs before running PHLAT on them.  If the budget is 'auto', _AUTO_READ_BUDGET is used.
+    The subsample is seeded with phlat_options['subsample_seed'] and keeps reads paired.  Fastqs
+    estimated (from their size) to be within the budget are returned as is.
+
+    :param list fastqs: List of input fastq files
+    :param str sample_type: Description of the sample type
+    :param dict univ_options: Dict of universal options used by almost all tools
+    :param dict phlat_options: Options specific to PHLAT
+    :return: fsIDs for the subsampled forward and reverse fastqs
+    :rtype: list(toil.fileStore.FileID)
+    """
+    work_dir = os.getcwd()
+    read_budget = phlat_options['read_budget']
+    if read_budget == 'auto':
+        read_budget = _AUTO_READ_BUDGET
+    elif not isinstance(read_budget, numbers.Integral) or read_budget <= 0:
+        raise ParameterError('read_budget must be a positive integer or auto.')
+    input_files = {
+        'input_1.fastq': fastqs[0],
+        'input_2.fastq': fastqs[1]}
+    input_files = get_files_from_filestore(job, input_files, work_dir, docker=False)
+    num_pairs = estimate_read_pairs(input_files['input_1.fastq'])
+    if num_pairs <= read_budget:
+        job.fileStore.logToMaster('Using all ~%s read pairs for phlat on %s:%s' %
+                                  (num_pairs, univ_options['patient'], sample_type))
+        return fastqs
+    output_files = [os.path.join(work_dir, sample_type + '_subsampled_' + x + '.fastq')
+                    for x in ('1', '2')]
+    kept, total = subsample_read_pairs(input_files['input_1.fastq'],
+                                       input_files['input_2.fastq'],
+                                       float(read_budget) / num_pairs,
+                                       phlat_options['subsample_seed'], output_files)
+    job.fileStore.logToMaster('Subsampled %s of %s read pairs for phlat on %s:%s' %
+                              (kept, total, univ_options['patient'], sample_type))
+    return [job.fileStore.writeGlobalFile(x) for x in output_files]
+
+
+def prefilter_hla_reads(job, fastqs, sample_type, univ_options, phlat_options):
+    """
+    Reduce a pair of input fastqs of type `sample_type` to the read pairs likely to come from the
+    HLA region before running PHLAT on them.  A pair is kept if either read shares a k-mer with the
+    HLA sequences in phlat_options['hla_fasta'].
+
+    :param list fastqs: List of input fastq files
+    :param str sample_type: Description of the sample type
+    :param dict univ_options: Dict of universal options used by almost all tools
+    :param dict phlat_options: Options specific to PHLAT
+    :return: fsIDs for the filtered forward and reverse fastqs
+    :rtype: list(toil.fileStore.FileID)
+    """
+    job.fileStore.logToMaster('Filtering HLA reads for phlat on %s:%s' % (univ_options['patient'],
+                                                                        sample_type))
+    work_dir = os.getcwd()
+    input_files = {
+        'input_1.fastq': fastqs[0],
+        'input_2.fastq': fastqs[1],
+        'hla.fa.tar.gz': phlat_options['hla_fasta']}
+    input_files = get_files_from_filestore(job, input_files, work_dir, docker=False)
+    input_files['hla.fa'] = untargz(input_files['hla.fa.tar.gz'], work_dir)
+
+    hla_kmers = build_hla_kmers(input_files['hla.fa'], phlat_options['prefilter_kmer_size'])
+    output_files = [os.path.join(work_dir, sample_type + '_hla_reads_' + x + '.fastq')
+                    for x in ('1', '2')]
+    kept, total = filter_hla_read_pairs(input_files['input_1.fastq'],
+                                        input_files['input_2.fastq'], hla_kmers,
+                                        phlat_options['prefilter_kmer_size'], output_files)
+    job.fileStore.logToMaster('Kept %s of %s read pairs for phlat on %s:%s' %
+                              (kept, total, univ_options['patient'], sample_type))
+    return [job.fileStore.writeGlobalFile(x) for x in output_files]
+
+
+def build_hla_kmers(hla_fasta, k):
+    """
+    Get the set of canonical k-mers in the HLA sequences.  The set is held as a sorted array of the
+    2-bit encoded k-mers so it can be searched for many k-mers at once.
+
+    :param str hla_fasta: Path to the fasta of HLA sequences
+    :param int k: The k-mer size (at most 32)
+    :return: The sorted unique k-mers
+    :rtype: numpy.ndarray
+    """
+    if not 0 < k <= 32:
+        raise ParameterError('prefilter_kmer_size must be between 1 and 32.')
+    kmers = []
+    with open(hla_fasta, 'rb') as fasta:
+        for is_header, lines in itertools.groupby(fasta, key=lambda x: x.startswith(b'>')):
+            if not is_header:
+                sequence_kmers, valid = _canonical_kmers(b''.join(x.strip() for x in lines), k)
+                kmers.append(np.unique(sequence_kmers[valid]))
+    if not kmers:
+        raise RuntimeError('No HLA sequences were found in %s.' % hla_fasta)
+    return np.unique(np.concatenate(kmers))
+
+
+def filter_hla_read_pairs(fastq_1, fastq_2, hla_kmers, k, output_files, batch_size=100000):
+    """
+    Stream a pair of fastqs in batches of read pairs and write the pairs where either read shares a
+    k-mer with `hla_kmers` to the output fastqs.
+
+    :param str fastq_1: Path to the forward fastq (can be gzipped)
+    :param str fastq_2: Path to the reverse fastq (can be gzipped)
+    :param numpy.ndarray hla_kmers: The sorted k-mers from build_hla_kmers
+    :param int k: The k-mer size used to build `hla_kmers`
+    :param list output_files: Paths to the filtered forward and reverse fastqs
+    :param int batch_size: The number of read pairs to test at once
+    :return: The number of read pairs kept, and the number of read pairs read
+    :rtype: tuple(int, int)
+    """
+    kept = total = 0
+    out_files = [open(x, 'wb') for x in output_files]
+    try:
+        for batches in _read_pair_batches(fastq_1, fastq_2, batch_size):
+            keep = _has_kmer_hit(batches[0][1::4], hla_kmers, k)
+            keep |= _has_kmer_hit(batches[1][1::4], hla_kmers, k)
+            _write_pair_batch(batches, keep, out_files)
+            kept += int(keep.sum())
+            total += len(keep)
+    finally:
+        for handle in out_files:
+            handle.close()
+    return kept, total
+
+
+def subsample_read_pairs(fastq_1, fastq_2, fraction, seed, output_files, batch_size=100000):
+    """
+    Stream a pair of fastqs in batches of read pairs and write a random subsample of the pairs to
+    the output fastqs.  Each pair is kept with probability `fraction`, so the same input and seed
+    always give the same subsample.
+
+    :param str fastq_1: Path to the forward fastq (can be gzipped)
+    :param str fastq_2: Path to the reverse fastq (can be gzipped)
+    :param float fraction: The fraction of read pairs to keep
+    :param int seed: The seed for the random number generator
+    :param list output_files: Paths to the subsampled forward and reverse fastqs
+    :param int batch_size: The number of read pairs to sample at once
+    :return: The number of read pairs kept, and the number of read pairs read
+    :rtype: tuple(int, int)
+    """
+    kept = total = 0
+    random_state = np.random.RandomState(seed)
+    out_files = [open(x, 'wb') for x in output_files]
+    try:
+        for batches in _read_pair_batches(fastq_1, fastq_2, batch_size):
+            keep = random_state.random_sample(len(batches[0]) // 4) < fraction
+            _write_pair_batch(batches, keep, out_files)
+            kept += int(keep.sum())
+            total += len(keep)
+    finally:
+        for handle in out_files:
+            handle.close()
+    return kept, total
+
+
+def estimate_read_pairs(fastq, sample_size=10000):
+    """
+    Estimate the number of reads in a fastq from its size on disk and the size of its first
+    `sample_size` records.
+
+    :param str fastq: Path to the fastq (can be gzipped)
+    :param int sample_size: The number of records to measure
+    :return: The estimated number of reads
+    :rtype: int
+    """
+    with open(fastq, 'rb') as raw_file:
+        in_file = gzip.GzipFile(fileobj=raw_file) if is_gzipfile(fastq) else raw_file
+        num_lines = sum(1 for _ in itertools.islice(in_file, 4 * sample_size))
+        if num_lines < 4 * sample_size:
+            # The whole file was read
+            return num_lines // 4
+        return int(os.path.getsize(fastq) * sample_size / raw_file.tell())
+
+
+def _read_pair_batches(fastq_1, fastq_2, batch_size):
+    """
+    Read a pair of fastqs in batches of read pairs.
+
+    :param str fastq_1: Path to the forward fastq (can be gzipped)
+    :param str fastq_2: Path to the reverse fastq (can be gzipped)
+    :param int batch_size: The number of read pairs per batch
+    :return: Generator of the lines of the next batch of forward and reverse reads
+    :rtype: generator(tuple(list, list))
+    """
+    in_files = [gzip.open(x) if is_gzipfile(x) else open(x, 'rb') for x in (fastq_1, fastq_2)]
+    try:
+        while True:
+            batches = [list(itertools.islice(x, 4 * batch_size)) for x in in_files]
+            if len(batches[0]) != len(batches[1]) or len(batches[0]) % 4:
+                raise RuntimeError('The fastqs %s and %s are not paired.' % (fastq_1, fastq_2))
+            if not batches[0]:
+                break
+            yield batches
+    finally:
+        for handle in in_files:
+            handle.close()
+
+
+def _write_pair_batch(batches, keep, out_files):
+    """
+    Write the kept read pairs of a batch from _read_pair_batches.
+
+    :param list batches: The lines of the forward and reverse reads in the batch
+    :param numpy.ndarray keep: Whether to keep each read pair
+    :param list out_files: Open file handles to the forward and reverse output fastqs
+    :return: None
+    """
+    for batch, out_file in zip(batches, out_files):
+        out_file.writelines(line for i, line in enumerate(batch) if keep[i // 4])
+    return None
+
+
+def _has_kmer_hit(reads, kmers, k):
+    """
+    Find the reads that contain any of the k-mers.
+
+    :param list reads: The read sequences
+    :param numpy.ndarray kmers: The sorted k-mers from build_hla_kmers
+    :param int k: The k-mer size
+    :return: Whether each read has a hit
+    :rtype: numpy.ndarray
+    """
+    # Join the reads with a separator that breaks k-mers spanning two reads
+    reads = [x.rstrip() for x in reads]
+    read_kmers, valid = _canonical_kmers(b'N'.join(reads), k)
+    positions = np.flatnonzero(valid)
+    index = np.minimum(np.searchsorted(kmers, read_kmers[positions]), len(kmers) - 1)
+    positions = positions[kmers[index] == read_kmers[positions]]
+    starts = np.cumsum([0] + [len(x) + 1 for x in reads[:-1]])
+    hits = np.zeros(len(reads), dtype=bool)
+    hits[np.searchsorted(starts, positions, side='right') - 1] = True
+    return hits
+
+
+def _canonical_kmers(sequence, k):
+    """
+    Get the 2-bit encoded canonical k-mer (the smaller of the k-mer and its reverse complement)
+    starting at each position of a sequence.
+
+    :param bytes sequence: The sequence
+    :param int k: The k-mer size (at most 32)
+    :return: The k-mers, and whether each of them is made up of only ACGT
+    :rtype: tuple(numpy.ndarray, numpy.ndarray)
+    """
+    codes = _BASE_CODES[np.frombuffer(sequence, dtype=np.uint8)]
+    num_kmers = max(len(codes) - k + 1, 0)
+    invalid = np.concatenate(([0], np.cumsum(codes == 4)))
+    valid = invalid[k:] == invalid[:num_kmers]
+    codes = np.where(codes == 4, 0, codes).astype(np.uint64)
+    forward = np.zeros(num_kmers, dtype=np.uint64)
+    reverse = np.zeros(num_kmers, dtype=np.uint64)
+    for i in range(k):
+        window = codes[i:i + num_kmers]
+        forward = (forward << np.uint64(2)) | window
+        reverse |= (np.uint64(3) - window) << np.uint64(2 * i)
+    return np.minimum(forward, reverse), valid
+
+
 def merge_phlat_calls(job, tumor_phlat, normal_phlat, rna_phlat, univ_options):
     """
     Merge tumor, normal and tumor rna Haplotypes into consensus calls.
@@ -190,3 +465,85 @@ def most_probable_alleles(allele_list):
     else:
         return sorted(all_alleles.keys(),
                       key=lambda x: (-len(all_alleles[x]), sum(all_alleles[x])))[0:2]
+
+
+def haplotype_cache_entry(haplotype_cache, patient, normal_fastqs):
+    """
+    Get the folder in the haplotype cache for the patient's germline haplotype.  Entries are keyed
+    by the patient ID and the path, size and modification time of the normal DNA fastqs, so a new
+    normal sample gets a new entry without reading the fastqs while the DAG is built.
+
+    :param str haplotype_cache: The haplotype cache
+    :param str patient: The patient ID
+    :param list normal_fastqs: Paths to the local normal DNA fastqs
+    :return: The folder for the cache entry
+    :rtype: str
+    """
+    key = hashlib.md5()
+    for fastq in normal_fastqs:
+        stat = os.stat(fastq)
+        key.update('%s\t%s\t%s\n' % (os.path.realpath(fastq), stat.st_size, int(stat.st_mtime)))
+    return os.path.join(os.path.abspath(haplotype_cache), patient, key.hexdigest())
+
+
+def get_cached_haplotype(job, cache_entry, univ_options):
+    """
+    Get the MHCI and MHCII alleles of a patient from the haplotype cache.
+
+    :param str cache_entry: The folder for the cache entry from haplotype_cache_entry
+    :param dict univ_options: Dict of universal options used by almost all tools
+    :return: Dict of fsIDs for consensus MHCI and MHCII alleles
+             output_files
+                    |- 'mhci_alleles.list': fsID
+                    +- 'mhcii_alleles.list': fsID
+    :rtype: dict
+    """
+    job.fileStore.logToMaster('Using the cached haplotype for %s from %s' %
+                              (univ_options['patient'], cache_entry))
+    output_files = defaultdict()
+    for allele_file in ['mhci_alleles.list', 'mhcii_alleles.list']:
+        output_files[allele_file] = job.fileStore.writeGlobalFile(os.path.join(cache_entry,
+                                                                               allele_file))
+        export_results(job, output_files[allele_file], allele_file, univ_options,
+                       subfolder='haplotyping')
+    return output_files
+
+
+def cache_haplotype(job, haplotype_files, cache_entry):
+    """
+    Store the MHCI and MHCII alleles of a patient in the haplotype cache, replacing any existing
+    entry.
+
+    :param dict haplotype_files: Dict of fsIDs for consensus MHCI and MHCII alleles
+    :param str cache_entry: The folder for the cache entry from haplotype_cache_entry
+    :return: None
+    """
+    staging = cache_entry + '.' + str(uuid.uuid4())
+    try:
+        os.makedirs(staging)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    for allele_file in ['mhci_alleles.list', 'mhcii_alleles.list']:
+        shutil.copy(job.fileStore.readGlobalFile(haplotype_files[allele_file]),
+                    os.path.join(staging, allele_file))
+    # Fill the entry in one rename so concurrent runs never see a partial entry.  Any existing
+    # entry is moved aside first since a folder can't be renamed over a full one.
+    retired = staging + '.old'
+    try:
+        os.rename(cache_entry, retired)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+    try:
+        os.rename(staging, cache_entry)
+    except OSError as err:
+        if err.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+            raise
+        # Another run on the same normal sample filled the entry in the meantime
+        shutil.rmtree(staging)
+        job.fileStore.logToMaster('The haplotype at %s was cached by another run' % cache_entry)
+    else:
+        job.fileStore.logToMaster('Cached the haplotype at %s' % cache_entry)
+    shutil.rmtree(retired, ignore_errors=True)
+    return None
@@ -18,8 +18,14 @@ from math import ceil
 from protect.common import (docker_call,
                             docker_path,
                             export_results,
+                            get_cached_index,
+                            get_file_digest,
                             get_files_from_filestore,
+                            merge_sharded_vcfs,
+                            split_vcf_into_shards,
                             untargz)
+import errno
+import fcntl
 import os
 
 
@@ -28,9 +34,11 @@ def snpeff_disk(snpeff_index):
     return int(6 * ceil(snpeff_index.size + 524288))
 
 
-def run_snpeff(job, merged_mutation_file, univ_options, snpeff_options):
+def wrap_snpeff(job, merged_mutation_file, univ_options, snpeff_options):
     """
-    Run snpeff on an input vcf.
+    A wrapper for run_snpeff.  If snpeff_options['shards'] is greater than 1, the input vcf is split
+    into that many shards of whole chromosomes and snpeff is run on each shard in parallel.  The
+    annotated shards are then merged with merge_snpeff_shards.
 
     :param toil.fileStore.FileID merged_mutation_file: fsID for input vcf
     :param dict univ_options: Dict of universal options used by almost all tools
@@ -38,18 +46,148 @@ def run_snpeff(job, merged_mutation_file, univ_options, snpeff_options):
     :return: fsID for the snpeffed vcf
     :rtype: toil.fileStore.FileID
     """
+    disk = snpeff_disk(snpeff_options['index'])
+    if snpeff_options.get('index_cache') and not snpeff_options.get('index_digest'):
+        # The index cache is keyed on the contents of the index.  Hash it once here instead of in
+        # every shard.
+        snpeff_options = dict(snpeff_options,
+                              index_digest=get_file_digest(job, snpeff_options['index']))
+    num_shards = int(snpeff_options['shards'])
+    if num_shards > 1:
+        work_dir = os.getcwd()
+        input_files = {
+            'merged_mutations.vcf': merged_mutation_file}
+        input_files = get_files_from_filestore(job, input_files, work_dir, docker=False)
+        shard_vcfs = split_vcf_into_shards(input_files['merged_mutations.vcf'], num_shards,
+                                           work_dir)
+    else:
+        shard_vcfs = []
+    if len(shard_vcfs) <= 1:
+        snpeff = job.wrapJobFn(run_snpeff, merged_mutation_file, univ_options, snpeff_options,
+                               disk=disk)
+        job.addChild(snpeff)
+        return snpeff.rv()
+    job.fileStore.logToMaster('Running snpeff on %s in %s shards' % (univ_options['patient'],
+                                                                     len(shard_vcfs)))
+    shards = []
+    for shard_vcf in shard_vcfs:
+        shards.append(job.wrapJobFn(run_snpeff, job.fileStore.writeGlobalFile(shard_vcf),
+                                    univ_options, snpeff_options, export=False, disk=disk))
+        job.addChild(shards[-1])
+    merge = job.wrapJobFn(merge_snpeff_shards, [shard.rv() for shard in shards], univ_options,
+                          disk='100M', memory='100M', cores=1)
+    job.addFollowOn(merge)
+    return merge.rv()
+
+
+def merge_snpeff_shards(job, shard_outputs, univ_options):
+    """
+    Merge the snpeffed vcfs from each shard into a single vcf.
+
+    :param list shard_outputs: fsIDs for the snpeffed vcf of each shard
+    :param dict univ_options: Dict of universal options used by almost all tools
+    :return: fsID for the snpeffed vcf
+    :rtype: toil.fileStore.FileID
+    """
+    job.fileStore.logToMaster('Merging snpeff shards for %s' % univ_options['patient'])
+    work_dir = os.getcwd()
+    merge_sharded_vcfs([job.fileStore.readGlobalFile(shard) for shard in shard_outputs],
+                       os.path.join(work_dir, 'mutations.vcf'))
+    output_file = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'mutations.vcf'))
+    export_results(job, output_file, os.path.join(work_dir, 'mutations.vcf'), univ_options,
+                   subfolder='mutations/snpeffed')
+    return output_file
+
+
+def run_snpeff(job, merged_mutation_file, univ_options, snpeff_options, export=True):
+    """
+    Run snpeff on an input vcf.  If snpeff_options['annotation_cache'] is provided, only the
+    variants that aren't already in the cache are annotated by snpeff, and their annotations are
+    added to the cache for future runs.
+
+    :param toil.fileStore.FileID merged_mutation_file: fsID for input vcf
+    :param dict univ_options: Dict of universal options used by almost all tools
+    :param dict snpeff_options: Options specific to snpeff
+    :param bool export: Should the results be exported?
+    :return: fsID for the snpeffed vcf
+    :rtype: toil.fileStore.FileID
+    """
     job.fileStore.logToMaster('Running snpeff on %s' % univ_options['patient'])
     work_dir = os.getcwd()
     input_files = {
-        'merged_mutations.vcf': merged_mutation_file,
-        'snpeff_index.tar.gz': snpeff_options['index']}
+        'merged_mutations.vcf': merged_mutation_file}
     input_files = get_files_from_filestore(job, input_files, work_dir, docker=False)
-    input_files['snpeff_index'] = untargz(input_files['snpeff_index.tar.gz'], work_dir)
-    input_files = {key: docker_path(path) for key, path in input_files.items()}
+    output_file = os.path.join(work_dir, 'mutations.vcf')
+    if not snpeff_options.get('annotation_cache'):
+        _snpeff(input_files['merged_mutations.vcf'], output_file, job, univ_options,
+                snpeff_options)
+    else:
+        cache_dir = os.path.join(os.path.abspath(snpeff_options['annotation_cache']),
+                                 '_'.join([univ_options['ref'], str(snpeff_options['version'])]))
+        header, records = _read_vcf(input_files['merged_mutations.vcf'])
+        cache = read_annotation_cache(cache_dir, set(r.split('\t', 1)[0] for r in records))
+        uncached = [r for r in records if _variant_key(r) not in cache['annotations']]
+        job.fileStore.logToMaster('Found %s of %s variants for %s in the snpeff annotation cache'
+                                  % (len(records) - len(uncached), len(records),
+                                     univ_options['patient']))
+        annotated = {}
+        if uncached or cache['header'] is None:
+            with open(os.path.join(work_dir, 'uncached_mutations.vcf'), 'w') as outfile:
+                outfile.writelines(header + uncached)
+            _snpeff(outfile.name, os.path.join(work_dir, 'snpeffed_uncached.vcf'), job,
+                    univ_options, snpeff_options)
+            snpeff_header, snpeff_records = _read_vcf(os.path.join(work_dir,
+                                                                   'snpeffed_uncached.vcf'))
+            annotated = {_variant_key(r): r for r in snpeff_records}
+            cache['header'] = [line for line in snpeff_header if line not in header]
+            update_annotation_cache(cache_dir, cache['header'],
+                                    {key: _get_eff(r) for key, r in annotated.items()})
+        with open(output_file, 'w') as outfile:
+            outfile.writelines(header[:-1] + cache['header'] + header[-1:])
+            for record in records:
+                key = _variant_key(record)
+                if key in annotated:
+                    outfile.write(annotated[key])
+                else:
+                    outfile.write(_add_eff(record, cache['annotations'][key]))
+    output_file = job.fileStore.writeGlobalFile(output_file)
+    if export:
+        export_results(job, output_file, os.path.join(work_dir, 'mutations.vcf'), univ_options,
+                       subfolder='mutations/snpeffed')
+    return output_file
+
+
+def _snpeff(in_vcf, out_vcf, job, univ_options, snpeff_options):
+    """
+    Run snpeff on `in_vcf` and write the annotated vcf to `out_vcf`.  If
+    snpeff_options['index_cache'] is provided, the untarred index is reused from that node-local
+    directory instead of being untarred into every job.  Cached indexes are keyed on the md5 of the
+    index tarball (snpeff_options['index_digest'] if wrap_snpeff already computed it).
 
+    :param str in_vcf: Path to the input vcf (in the working directory)
+    :param str out_vcf: Path to the output vcf
+    :param dict univ_options: Dict of universal options used by almost all tools
+    :param dict snpeff_options: Options specific to snpeff
+    """
+    work_dir = os.getcwd()
+    if snpeff_options.get('index_cache'):
+        digest = snpeff_options.get('index_digest')
+        if not digest:
+            digest = get_file_digest(job, snpeff_options['index'])
+        snpeff_index = get_cached_index(job, snpeff_options['index'],
+                                        snpeff_options['index_cache'],
+                                        '_'.join(['snpeff', univ_options['ref'],
+                                                  str(snpeff_options['version']), digest]),
+                                        work_dir)
+    else:
+        input_files = {
+            'snpeff_index.tar.gz': snpeff_options['index']}
+        input_files = get_files_from_filestore(job, input_files, work_dir, docker=False)
+        snpeff_index = untargz(input_files['snpeff_index.tar.gz'], work_dir)
+    snpeff_index = docker_path(snpeff_index)
     parameters = ['eff',
-                  '-dataDir', input_files['snpeff_index'],
-                  '-c', '/'.join([input_files['snpeff_index'],
+                  '-dataDir', snpeff_index,
+                  '-c', '/'.join([snpeff_index,
                                   'snpEff_' + univ_options['ref'] + '_gencode.config']),
                   '-no-intergenic',
                   '-no-downstream',
@@ -57,12 +195,170 @@ def run_snpeff(job, merged_mutation_file, univ_options, snpeff_options):
                   # '-canon',
                   '-noStats',
                   univ_options['ref'] + '_gencode',
-                  input_files['merged_mutations.vcf']]
+                  docker_path(in_vcf)]
     xmx = snpeff_options['java_Xmx'] if snpeff_options['java_Xmx'] else univ_options['java_Xmx']
-    with open('/'.join([work_dir, 'mutations.vcf']), 'w') as snpeff_file:
+    with open(out_vcf, 'w') as snpeff_file:
         docker_call(tool='snpeff', tool_parameters=parameters, work_dir=work_dir,
                     dockerhub=univ_options['dockerhub'], java_xmx=xmx, outfile=snpeff_file,
                     tool_version=snpeff_options['version'])
-    output_file = job.fileStore.writeGlobalFile(snpeff_file.name)
-    export_results(job, output_file, snpeff_file.name, univ_options, subfolder='mutations/snpeffed')
-    return output_file
+
+
+def _read_vcf(in_vcf):
+    """
+    Read a vcf into memory.
+
+    :param str in_vcf: Path to the vcf
+    :return: The header lines and the record lines
+    :rtype: tuple(list[str], list[str])
+    """
+    header = []
+    records = []
+    with open(in_vcf) as infile:
+        for line in infile:
+            if line.startswith('#'):
+                header.append(line)
+            else:
+                records.append(line)
+    return header, records
+
+
+def _variant_key(record):
+    """
+    Get the key used for a vcf record in the annotation cache.
+
+    :param str record: A vcf record
+    :return: (CHROM, POS, REF, ALT)
+    :rtype: tuple
+    """
+    record = record.split('\t', 5)
+    return record[0], record[1], record[3], record[4]
+
+
+def _get_eff(record):
+    """
+    Get the EFF annotation added to a vcf record by snpeff.
+
+    :param str record: A snpeffed vcf record
+    :return: The value of the EFF INFO field ('' if snpeff didn't annotate the record)
+    :rtype: str
+    """
+    for field in record.split('\t')[7].strip().split(';'):
+        if field.startswith('EFF='):
+            return field[4:]
+    return ''
+
+
+def _add_eff(record, eff):
+    """
+    Add an EFF annotation to the INFO field of a vcf record the same way snpeff would.
+
+    :param str record: A vcf record
+    :param str eff: The value of the EFF INFO field ('' if there is no annotation)
+    :return: The annotated vcf record
+    :rtype: str
+    """
+    if not eff:
+        return record
+    record = record.rstrip('\n').split('\t')
+    record[7] = 'EFF=' + eff if record[7] in ('', '.') else ';'.join([record[7], 'EFF=' + eff])
+    return '\t'.join(record) + '\n'
+
+
+def read_annotation_cache(cache_dir, chromosomes):
+    """
+    Read the annotations for the given chromosomes from a snpeff annotation cache.  The cache holds
+    one tab-separated file of POS, REF, ALT, EFF per chromosome, and the header lines snpeff adds to
+    a vcf.
+
+    :param str cache_dir: The cache directory for the genome build and snpeff version in use
+    :param set chromosomes: The chromosomes to read
+    :return: The cached annotations and header lines
+             cache:
+                 |- 'annotations':
+                 |      +- (CHROM, POS, REF, ALT): str
+                 +- 'header': list[str] or None
+    :rtype: dict
+    """
+    cache = {'annotations': {},
+             'header': None}
+    if not os.path.isdir(cache_dir):
+        return cache
+    # Read under a shared lock so we never see a write from update_annotation_cache half done
+    with open(os.path.join(cache_dir, '.lock'), 'a') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_SH)
+        try:
+            if os.path.exists(os.path.join(cache_dir, 'header.txt')):
+                with open(os.path.join(cache_dir, 'header.txt')) as infile:
+                    cache['header'] = infile.readlines()
+            for chrom in chromosomes:
+                if not os.path.exists(os.path.join(cache_dir, chrom + '.tsv')):
+                    continue
+                with open(os.path.join(cache_dir, chrom + '.tsv')) as infile:
+                    for line in infile:
+                        fields = line.rstrip('\n').split('\t')
+                        # Skip anything left over from a writer that died mid-line
+                        if not line.endswith('\n') or len(fields) != 4:
+                            continue
+                        pos, ref, alt, eff = fields
+                        cache['annotations'][chrom, pos, ref, alt] = eff
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+    return cache
+
+
+def update_annotation_cache(cache_dir, header, annotations):
+    """
+    Add annotations to a snpeff annotation cache.  Writes are made under a lock so several runs can
+    share the same cache.
+
+    :param str cache_dir: The cache directory for the genome build and snpeff version in use
+    :param list header: The header lines added to the vcf by snpeff
+    :param dict annotations: The new annotations in the form (CHROM, POS, REF, ALT): EFF
+    """
+    try:
+        os.makedirs(cache_dir)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    with open(os.path.join(cache_dir, '.lock'), 'w') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(os.path.join(cache_dir, 'header.txt')):
+                with open(os.path.join(cache_dir, 'header.txt'), 'w') as outfile:
+                    outfile.writelines(header)
+            by_chrom = {}
+            for (chrom, pos, ref, alt), eff in annotations.items():
+                by_chrom.setdefault(chrom, []).append('\t'.join([pos, ref, alt, eff]) + '\n')
+            for chrom, lines in by_chrom.items():
+                # Don't append onto a partial line left by a writer that died mid-line, since
+                # read_annotation_cache would skip the joined line
+                _trim_partial_line(os.path.join(cache_dir, chrom + '.tsv'))
+                with open(os.path.join(cache_dir, chrom + '.tsv'), 'a') as outfile:
+                    outfile.writelines(lines)
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def _trim_partial_line(path, block_size=65536):
+    """
+    Truncate a file after its last newline.
+
+    :param str path: Path to the file
+    :param int block_size: The number of bytes to search for the newline at a time
+    :return: None
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r+b') as infile:
+        infile.seek(0, os.SEEK_END)
+        end = infile.tell()
+        while end > 0:
+            start = max(end - block_size, 0)
+            infile.seek(start)
+            newline = infile.read(end - start).rfind(b'\n')
+            if newline != -1:
+                end = start + newline + 1
+                break
+            end = start
+        infile.truncate(end)
+    return None
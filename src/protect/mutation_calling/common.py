@@ -14,11 +14,33 @@
 # limitations under the License.
 from __future__ import absolute_import, print_function
 from collections import defaultdict
+from math import ceil
 
-from protect.common import chrom_sorted, export_results, get_files_from_filestore, untargz
+from protect.common import (bgzip_and_tabix_vcf,
+                            chrom_sorted,
+                            export_results,
+                            get_file_digest,
+                            get_files_from_filestore,
+                            gunzip,
+                            untargz)
 
+import errno
+import gzip
 import itertools
 import os
+import shutil
+import uuid
+
+
+# disk for creating the target regions
+def target_regions_disk(annotation_gtf):
+    return int(4 * ceil(annotation_gtf.size + 524288))
+
+
+# disk for sharding the reference vcfs
+def reference_shards_disk(tool_options):
+    return int(12 * ceil(tool_options['mutect']['dbsnp_vcf'].size + 524288) +
+               4 * ceil(tool_options['mutect']['cosmic_vcf'].size + 524288))
 
 
 def sample_chromosomes(job, genome_fai_file):
@@ -50,6 +72,270 @@ def chromosomes_from_fai(genome_fai):
     return chromosomes
 
 
+def contig_lengths_from_fai(genome_fai):
+    """
+    Read a fasta index (fai) file and parse the lengths of the input contigs.
+
+    :param str genome_fai: Path to the fai file.
+    :return: Dict of contig name: length
+    :rtype: dict
+    """
+    contig_lengths = {}
+    with open(genome_fai) as fai_file:
+        for line in fai_file:
+            line = line.strip().split()
+            contig_lengths[line[0]] = int(line[1])
+    return contig_lengths
+
+
+def batch_chromosomes(chromosomes, contig_lengths, batch_size):
+    """
+    Group chromosomes into batches spanning roughly `batch_size` bases each, preserving the input
+    order.  A chromosome longer than `batch_size` forms a batch of its own.
+
+    :param list chromosomes: The chromosomes to batch
+    :param dict contig_lengths: Dict of contig name: length
+    :param int batch_size: The target number of bases in each batch
+    :return: List of batches of chromosomes
+    :rtype: list[list[str]]
+    """
+    batches = []
+    batch = []
+    batch_length = 0
+    for chrom in chromosomes:
+        chrom_length = contig_lengths.get(chrom, 0)
+        if batch and batch_length + chrom_length > batch_size:
+            batches.append(batch)
+            batch = []
+            batch_length = 0
+        batch.append(chrom)
+        batch_length += chrom_length
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def make_target_regions(job, annotation_gtf, univ_options, target_options):
+    """
+    Create a bed file describing the coding exons in the gencode annotation (padded on either side)
+    so that mutation calling can be restricted to regions that can yield neoepitopes.
+
+    :param toil.fileStore.FileID annotation_gtf: fsID for the tar.gz'd gencode annotation gtf
+    :param dict univ_options: Dict of universal options used by almost all tools
+    :param dict target_options: Options specific to targeted mutation calling
+    :return: fsID for the bed file of target regions
+    :rtype: toil.fileStore.FileID
+    """
+    job.fileStore.logToMaster('Creating target regions for %s' % univ_options['patient'])
+    work_dir = os.getcwd()
+    input_files = {
+        'annotation.gtf.tar.gz': annotation_gtf,
+        'genome.fa.fai.tar.gz': target_options['genome_fai']}
+    input_files = get_files_from_filestore(job, input_files, work_dir, docker=False)
+    for key in ('annotation.gtf', 'genome.fa.fai'):
+        input_files[key] = untargz(input_files[key + '.tar.gz'], work_dir)
+
+    contig_lengths = contig_lengths_from_fai(input_files['genome.fa.fai'])
+    if target_options['chromosomes']:
+        contig_lengths = {c: l for c, l in contig_lengths.items()
+                          if c in target_options['chromosomes']}
+    target_bed = gtf_to_target_bed(input_files['annotation.gtf'],
+                                   os.path.join(work_dir, 'target_regions.bed'),
+                                   contig_lengths, padding=int(target_options['padding']))
+    return job.fileStore.writeGlobalFile(target_bed)
+
+
+def gtf_to_target_bed(gtf_file, bed_file, contig_lengths, padding=0):
+    """
+    Write the CDS records in a gtf file to a bed file after padding and merging overlapping
+    intervals.  Records on contigs not in `contig_lengths` are dropped, however contigs differing
+    only by the "chr" prefix (and chrM/MT) are reconciled with the names in `contig_lengths`.
+
+    :param str gtf_file: Path to the gtf file
+    :param str bed_file: Path to the output bed file
+    :param dict contig_lengths: Dict of contig name: length for the contigs to retain
+    :param int padding: Number of bases to pad each interval by on either side
+    :return: Path to the bed file
+    :rtype: str
+    """
+    contig_names = {}
+    for contig in contig_lengths:
+        contig_names[contig] = contig
+        alt_name = contig[3:] if contig.startswith('chr') else 'chr' + contig
+        contig_names.setdefault(alt_name, contig)
+        if alt_name in ('M', 'MT', 'chrM', 'chrMT'):
+            for m_name in ('M', 'MT', 'chrM', 'chrMT'):
+                contig_names.setdefault(m_name, contig)
+    intervals = defaultdict(list)
+    with open(gtf_file) as gtf:
+        for line in gtf:
+            if line.startswith('#'):
+                continue
+            line = line.split('\t')
+            if len(line) < 5 or line[2] != 'CDS' or line[0] not in contig_names:
+                continue
+            contig = contig_names[line[0]]
+            # gtf is 1-based closed, bed is 0-based half open
+            intervals[contig].append((max(0, int(line[3]) - 1 - padding),
+                                      min(contig_lengths[contig], int(line[4]) + padding)))
+    with open(bed_file, 'w') as bed:
+        for contig in chrom_sorted(intervals.keys()):
+            start, end = None, None
+            for i_start, i_end in sorted(intervals[contig]):
+                if end is not None and i_start <= end:
+                    end = max(end, i_end)
+                    continue
+                if end is not None:
+                    print(contig, start, end, sep='\t', file=bed)
+                start, end = i_start, i_end
+            if end is not None:
+                print(contig, start, end, sep='\t', file=bed)
+    return bed_file
+
+
+def prepare_reference_shards(job, tool_options, univ_options):
+    """
+    Split the genome-wide dbSNP and COSMIC vcfs used by MuTect and MuSE into per-chromosome,
+    bgzipped and tabix-indexed shards so each calling job only fetches the chromosomes it needs.
+    If `shard_cache` is provided in the indexes, shards are reused from, or saved to, that directory
+    (keyed by the md5 of the vcf) so the split is done once across runs.
+
+    :param dict tool_options: Options for the various tools
+    :param dict univ_options: Dict of universal options used by almost all tools
+    :return: `tool_options` with the shards added to the MuTect and MuSE options
+             tool_options['mutect']:
+                 |- 'dbsnp_shards':
+                 |      |- 'chr1':
+                 |      |     |- 'vcf': fsID
+                 |      |     +- 'tbi': fsID
+                 |      |
+                 |      |-...
+                 |      |
+                 |      +- 'chrM':
+                 |            |- 'vcf': fsID
+                 |            +- 'tbi': fsID
+                 +- 'cosmic_shards':
+                        |...
+    :rtype: dict
+    """
+    job.fileStore.logToMaster('Preparing per-chromosome reference shards')
+    work_dir = os.getcwd()
+    mutect_options = tool_options['mutect']
+    if mutect_options['chromosomes']:
+        chromosomes = mutect_options['chromosomes']
+    else:
+        chromosomes = sample_chromosomes(job, mutect_options['genome_fai'])
+    shards = {}
+    for ref in 'dbsnp', 'cosmic':
+        ref_vcf = mutect_options[ref + '_vcf']
+        cache_dir = None
+        if mutect_options.get('shard_cache'):
+            cache_dir = os.path.join(os.path.abspath(mutect_options['shard_cache']),
+                                     '_'.join([ref, get_file_digest(job, ref_vcf)]))
+        # Cache entries are only ever created complete, by a rename
+        if cache_dir is not None and all(os.path.exists(os.path.join(cache_dir, chrom + ext))
+                                         for chrom in chromosomes for ext in ('.vcf.gz',
+                                                                              '.vcf.gz.tbi')):
+            job.fileStore.logToMaster('Using cached %s shards from %s' % (ref, cache_dir))
+            shard_dir = cache_dir
+        else:
+            # dbsnp.vcf should be bgzipped, but cosmic should be tar.gz'd
+            if ref == 'dbsnp':
+                in_vcf = get_files_from_filestore(job, {'dbsnp.vcf.gz': ref_vcf}, work_dir)
+                in_vcf = gunzip(in_vcf['dbsnp.vcf.gz'])
+            else:
+                in_vcf = get_files_from_filestore(job, {'cosmic.vcf.tar.gz': ref_vcf}, work_dir)
+                in_vcf = untargz(in_vcf['cosmic.vcf.tar.gz'], work_dir)
+            shard_dir = os.path.join(work_dir, ref)
+            os.mkdir(shard_dir)
+            for chrom_vcf in split_vcf_by_chromosome(in_vcf, chromosomes, shard_dir).values():
+                bgzip_and_tabix_vcf(job, chrom_vcf, univ_options, mutect_options['htslib'])
+            os.remove(in_vcf)
+            if cache_dir is not None:
+                _fill_shard_cache(shard_dir, cache_dir)
+        shards[ref] = {chrom: {'vcf': job.fileStore.writeGlobalFile(
+                                   os.path.join(shard_dir, chrom + '.vcf.gz')),
+                               'tbi': job.fileStore.writeGlobalFile(
+                                   os.path.join(shard_dir, chrom + '.vcf.gz.tbi'))}
+                       for chrom in chromosomes}
+    tool_options['mutect']['dbsnp_shards'] = shards['dbsnp']
+    tool_options['mutect']['cosmic_shards'] = shards['cosmic']
+    tool_options['muse']['dbsnp_shards'] = shards['dbsnp']
+    return tool_options
+
+
+def _fill_shard_cache(shard_dir, cache_dir):
+    """
+    Copy the shards into the cache.  The shards are staged next to the cache entry and renamed
+    into place, so a crashed or concurrent run never leaves a partial entry behind.  If another run
+    filled the entry first, its copy is kept.
+
+    :param str shard_dir: The directory holding the shards
+    :param str cache_dir: The cache entry for the shards
+    :return: None
+    """
+    staging = cache_dir + '.' + str(uuid.uuid4())
+    shutil.copytree(shard_dir, staging)
+    try:
+        os.rename(staging, cache_dir)
+    except OSError as err:
+        if err.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+            raise
+        shutil.rmtree(staging)
+    return None
+
+
+def split_vcf_by_chromosome(in_vcf, chromosomes, out_dir):
+    """
+    Split a vcf into one vcf per chromosome.  Every output vcf carries the full header, even if
+    there were no records on that chromosome, and records on other chromosomes are dropped.
+
+    :param str in_vcf: Path to the vcf
+    :param list chromosomes: The chromosomes to write vcfs for
+    :param str out_dir: Directory to write the per-chromosome vcfs into
+    :return: Dict of paths to the vcf for each chromosome
+    :rtype: dict
+    """
+    header = []
+    outfiles = {}
+    with open(in_vcf, 'r') as infile:
+        line = infile.readline()
+        while line.startswith('#'):
+            header.append(line)
+            line = infile.readline()
+        for chrom in chromosomes:
+            outfiles[chrom] = open(os.path.join(out_dir, chrom + '.vcf'), 'w')
+            outfiles[chrom].writelines(header)
+        while line:
+            chrom = line.split('\t', 1)[0]
+            if chrom in outfiles:
+                outfiles[chrom].write(line)
+            line = infile.readline()
+    for outfile in outfiles.values():
+        outfile.close()
+    return {chrom: outfile.name for chrom, outfile in outfiles.items()}
+
+
+def merge_vcf_shards(vcf_shards, out_vcf):
+    """
+    Concatenate bgzipped per-chromosome vcf shards into a single uncompressed vcf with the header
+    of the first shard.
+
+    :param list vcf_shards: Paths to the bgzipped shards
+    :param str out_vcf: Path to the output vcf
+    :return: Path to the output vcf
+    :rtype: str
+    """
+    with open(out_vcf, 'w') as outfile:
+        for i, shard in enumerate(vcf_shards):
+            with gzip.open(shard) as infile:
+                for line in infile:
+                    if line.startswith('#') and i > 0:
+                        continue
+                    outfile.write(line)
+    return out_vcf
+
+
 def run_mutation_aggregator(job, mutation_results, univ_options):
     """
     Aggregate all the called mutations.
@@ -173,54 +459,3 @@ def merge_perchrom_vcfs(job, perchrom_vcfs, tool_name, univ_options):
     output_file = job.fileStore.writeGlobalFile(outvcf.name)
     export_results(job, output_file, outvcf.name, univ_options, subfolder='mutations/' + tool_name)
     return output_file
-
-
-def unmerge(job, input_vcf, tool_name, chromosomes, tool_options, univ_options):
-    """
-    Un-merge a vcf file into per-chromosome vcfs.
-
-    :param str input_vcf: Input vcf
-    :param str tool_name: The name of the mutation caller
-    :param list chromosomes: List of chromosomes to retain
-    :param dict tool_options: Options specific to the mutation caller
-    :param dict univ_options: Dict of universal options used by almost all tools
-    :return: dict of fsIDs, one for each chromosomal vcf
-    :rtype: dict
-    """
-    work_dir = os.getcwd()
-    input_files = {
-        'input.vcf': input_vcf,
-        'genome.fa.fai.tar.gz': tool_options['genome_fai']}
-    input_files = get_files_from_filestore(job, input_files, work_dir, docker=False)
-
-    input_files['genome.fa.fai'] = untargz(input_files['genome.fa.fai.tar.gz'], work_dir)
-
-    read_chromosomes = defaultdict()
-    with open(input_files['input.vcf'], 'r') as in_vcf:
-        header = []
-        for line in in_vcf:
-            if line.startswith('#'):
-                header.append(line)
-                continue
-            line = line.strip()
-            chrom = line.split()[0]
-            if chrom in read_chromosomes:
-                print(line, file=read_chromosomes[chrom])
-            else:
-                read_chromosomes[chrom] = open(os.path.join(os.getcwd(), chrom + '.vcf'), 'w')
-                print(''.join(header), file=read_chromosomes[chrom], end='')
-                print(line, file=read_chromosomes[chrom])
-    # Process chromosomes that had no mutations
-    for chrom in set(chromosomes).difference(set(read_chromosomes.keys())):
-        read_chromosomes[chrom] = open(os.path.join(os.getcwd(), chrom + '.vcf'), 'w')
-        print(''.join(header), file=read_chromosomes[chrom], end='')
-    outdict = {}
-    chroms = set(chromosomes).intersection(set(read_chromosomes.keys()))
-    for chrom, chromvcf in read_chromosomes.items():
-        chromvcf.close()
-        if chrom not in chroms:
-            continue
-        outdict[chrom] = job.fileStore.writeGlobalFile(chromvcf.name)
-        export_results(job, outdict[chrom], chromvcf.name, univ_options,
-                       subfolder='mutations/' + tool_name)
-    return outdict
@@ -84,6 +84,10 @@ def run_muse(job, tumor_bam, normal_bam, univ_options, muse_options):
         chromosomes = sample_chromosomes(job, muse_options['genome_fai'])
     perchrom_muse = defaultdict()
     for chrom in chromosomes:
+        if muse_options.get('dbsnp_shards'):
+            dbsnp = muse_options['dbsnp_shards'][chrom]['vcf']
+        else:
+            dbsnp = muse_options['dbsnp_vcf']
         call = job.addChildJobFn(run_muse_perchrom, tumor_bam, normal_bam, univ_options,
                                  muse_options, chrom, disk=PromisedRequirement(
                                      muse_disk,
@@ -93,8 +97,7 @@ def run_muse(job, tumor_bam, normal_bam, univ_options, muse_options):
                                  memory='6G')
         sump = call.addChildJobFn(run_muse_sump_perchrom, call.rv(), univ_options, muse_options,
                                   chrom,
-                                  disk=PromisedRequirement(muse_sump_disk,
-                                                           muse_options['dbsnp_vcf']),
+                                  disk=PromisedRequirement(muse_sump_disk, dbsnp),
                                   memory='6G')
         perchrom_muse[chrom] = sump.rv()
     return perchrom_muse
@@ -121,17 +124,30 @@ def run_muse_perchrom(job, tumor_bam, normal_bam, univ_options, muse_options, ch
         'normal.bam.bai': normal_bam['normal_dna_fix_pg_sorted.bam.bai'],
         'genome.fa.tar.gz': muse_options['genome_fasta'],
         'genome.fa.fai.tar.gz': muse_options['genome_fai']}
+    if muse_options.get('target_bed'):
+        input_files['targets.bed'] = muse_options['target_bed']
     input_files = get_files_from_filestore(job, input_files, work_dir, docker=False)
 
     for key in ('genome.fa', 'genome.fa.fai'):
         input_files[key] = untargz(input_files[key + '.tar.gz'], work_dir)
+    region_flag, region = '-r', chrom
+    if 'targets.bed' in input_files:
+        # MuSE can take either a single region or a bed of regions so restrict the targets to the
+        # chromosome being processed.
+        with open(input_files['targets.bed']) as in_bed, \
+                open(os.path.join(work_dir, chrom + '_targets.bed'), 'w') as out_bed:
+            for line in in_bed:
+                if line.split('\t')[0] == chrom:
+                    out_bed.write(line)
+        if os.path.getsize(out_bed.name) > 0:
+            region_flag, region = '-l', docker_path(out_bed.name)
     input_files = {key: docker_path(path) for key, path in input_files.items()}
 
     output_prefix = os.path.join(work_dir, chrom)
 
     parameters = ['call',
                   '-f', input_files['genome.fa'],
-                  '-r', chrom,
+                  region_flag, region,
                   '-O', docker_path(output_prefix),
                   input_files['tumor.bam'],
                   input_files['normal.bam']]
@@ -154,10 +170,16 @@ def run_muse_sump_perchrom(job, muse_output, univ_options, muse_options, chrom):
     """
     job.fileStore.logToMaster('Running MuSE sump on %s:%s' % (univ_options['patient'], chrom))
     work_dir = os.getcwd()
+    if muse_options.get('dbsnp_shards'):
+        # Only fetch the dbsnp shard for this chromosome
+        dbsnp = muse_options['dbsnp_shards'][chrom]
+    else:
+        dbsnp = {'vcf': muse_options['dbsnp_vcf'],
+                 'tbi': muse_options['dbsnp_tbi']}
     input_files = {
         'MuSE.txt': muse_output,
-        'dbsnp_coding.vcf.gz': muse_options['dbsnp_vcf'],
-        'dbsnp_coding.vcf.gz.tbi.tmp': muse_options['dbsnp_tbi']}
+        'dbsnp_coding.vcf.gz': dbsnp['vcf'],
+        'dbsnp_coding.vcf.gz.tbi.tmp': dbsnp['tbi']}
     input_files = get_files_from_filestore(job, input_files, work_dir, docker=False)
     tbi = os.path.splitext(input_files['dbsnp_coding.vcf.gz.tbi.tmp'])[0]
     time.sleep(2)
@@ -22,7 +22,11 @@ from protect.common import (docker_call,
                             get_files_from_filestore,
                             gunzip,
                             untargz)
-from protect.mutation_calling.common import sample_chromosomes, merge_perchrom_vcfs
+from protect.mutation_calling.common import (batch_chromosomes,
+                                             chromosomes_from_fai,
+                                             contig_lengths_from_fai,
+                                             merge_perchrom_vcfs,
+                                             merge_vcf_shards)
 from toil.job import PromisedRequirement
 
 import os
@@ -58,7 +62,8 @@ def run_mutect_with_merge(job, tumor_bam, normal_bam, univ_options, mutect_optio
 
 def run_mutect(job, tumor_bam, normal_bam, univ_options, mutect_options):
     """
-    Spawn a MuTect job for each chromosome on the DNA bams.
+    Spawn MuTect jobs over batches of chromosomes on the DNA bams.  The batches span roughly
+    `mutect_options['batch_size']` bases each.
 
     :param dict tumor_bam: Dict of bam and bai for tumor DNA-Seq
     :param dict normal_bam: Dict of bam and bai for normal DNA-Seq
@@ -75,36 +80,52 @@ def run_mutect(job, tumor_bam, normal_bam, univ_options, mutect_options):
     :rtype: dict
     """
     # Get a list of chromosomes to handle
+    work_dir = os.getcwd()
+    genome_fai = untargz(job.fileStore.readGlobalFile(mutect_options['genome_fai']), work_dir)
     if mutect_options['chromosomes']:
         chromosomes = mutect_options['chromosomes']
     else:
-        chromosomes = sample_chromosomes(job, mutect_options['genome_fai'])
+        chromosomes = chromosomes_from_fai(genome_fai)
+    # Each MuTect run pays a fixed cost for starting the JVM and loading the references so run
+    # groups of chromosomes at a time and split the results back out per chromosome.
+    batches = batch_chromosomes(chromosomes, contig_lengths_from_fai(genome_fai),
+                                int(mutect_options['batch_size']))
     perchrom_mutect = defaultdict()
-    for chrom in chromosomes:
-        perchrom_mutect[chrom] = job.addChildJobFn(
-            run_mutect_perchrom, tumor_bam, normal_bam, univ_options, mutect_options, chrom,
+    for batch in batches:
+        mutect_batch = job.addChildJobFn(
+            run_mutect_perbatch, tumor_bam, normal_bam, univ_options, mutect_options, batch,
             memory='6G', disk=PromisedRequirement(mutect_disk,
                                                   tumor_bam['tumor_dna_fix_pg_sorted.bam'],
                                                   normal_bam['normal_dna_fix_pg_sorted.bam'],
                                                   mutect_options['genome_fasta'],
                                                   mutect_options['dbsnp_vcf'],
-                                                  mutect_options['cosmic_vcf'])).rv()
+                                                  mutect_options['cosmic_vcf']))
+        for chrom in batch:
+            perchrom_mutect[chrom] = mutect_batch.rv(chrom)
     return perchrom_mutect
 
 
-def run_mutect_perchrom(job, tumor_bam, normal_bam, univ_options, mutect_options, chrom):
+def run_mutect_perbatch(job, tumor_bam, normal_bam, univ_options, mutect_options, chromosomes):
     """
-    Run MuTect call on a single chromosome in the input bams.
+    Run MuTect call on a batch of chromosomes in the input bams in a single MuTect run, and split
+    the calls into one vcf per chromosome.
 
     :param dict tumor_bam: Dict of bam and bai for tumor DNA-Seq
     :param dict normal_bam: Dict of bam and bai for normal DNA-Seq
     :param dict univ_options: Dict of universal options used by almost all tools
     :param dict mutect_options: Options specific to MuTect
-    :param str chrom: Chromosome to process
-    :return: fsID for the chromsome vcf
-    :rtype: toil.fileStore.FileID
+    :param list chromosomes: Chromosomes to process
+    :return: Dict of fsIDs for the vcf of each chromosome in the batch
+             perchrom_mutect:
+                 |- <chromosomes[0]>: fsID
+                 |
+                 |-...
+                 |
+                 +- <chromosomes[-1]>: fsID
+    :rtype: dict
     """
-    job.fileStore.logToMaster('Running MuTect on %s:%s' % (univ_options['patient'], chrom))
+    job.fileStore.logToMaster('Running MuTect on %s:%s' % (univ_options['patient'],
+                                                           ','.join(chromosomes)))
     work_dir = os.getcwd()
     input_files = {
         'tumor.bam': tumor_bam['tumor_dna_fix_pg_sorted.bam'],
@@ -113,21 +134,52 @@ def run_mutect_perchrom(job, tumor_bam, normal_bam, univ_options, mutect_options
         'normal.bam.bai': normal_bam['normal_dna_fix_pg_sorted.bam.bai'],
         'genome.fa.tar.gz': mutect_options['genome_fasta'],
         'genome.fa.fai.tar.gz': mutect_options['genome_fai'],
-        'genome.dict.tar.gz': mutect_options['genome_dict'],
-        'cosmic.vcf.tar.gz': mutect_options['cosmic_vcf'],
-        'cosmic.vcf.idx.tar.gz': mutect_options['cosmic_idx'],
-        'dbsnp.vcf.gz': mutect_options['dbsnp_vcf'],
-        'dbsnp.vcf.idx.tar.gz': mutect_options['dbsnp_idx']}
+        'genome.dict.tar.gz': mutect_options['genome_dict']}
+    if mutect_options.get('dbsnp_shards'):
+        # Only fetch the reference shards for the chromosomes in this batch.  MuTect will index the
+        # merged shards on the fly.
+        for ref in 'dbsnp', 'cosmic':
+            for chrom in chromosomes:
+                input_files['_'.join([ref, chrom, 'shard.vcf.gz'])] = \
+                    mutect_options[ref + '_shards'][chrom]['vcf']
+    else:
+        input_files.update({
+            'cosmic.vcf.tar.gz': mutect_options['cosmic_vcf'],
+            'cosmic.vcf.idx.tar.gz': mutect_options['cosmic_idx'],
+            'dbsnp.vcf.gz': mutect_options['dbsnp_vcf'],
+            'dbsnp.vcf.idx.tar.gz': mutect_options['dbsnp_idx']})
+    if mutect_options.get('target_bed'):
+        input_files['targets.bed'] = mutect_options['target_bed']
     input_files = get_files_from_filestore(job, input_files, work_dir, docker=False)
-    # dbsnp.vcf should be bgzipped, but all others should be tar.gz'd
-    input_files['dbsnp.vcf'] = gunzip(input_files['dbsnp.vcf.gz'])
-    for key in ('genome.fa', 'genome.fa.fai', 'genome.dict', 'cosmic.vcf', 'cosmic.vcf.idx',
-                'dbsnp.vcf.idx'):
+    for key in ('genome.fa', 'genome.fa.fai', 'genome.dict'):
         input_files[key] = untargz(input_files[key + '.tar.gz'], work_dir)
+    if mutect_options.get('dbsnp_shards'):
+        for ref in 'dbsnp', 'cosmic':
+            input_files[ref + '.vcf'] = merge_vcf_shards(
+                [input_files['_'.join([ref, chrom, 'shard.vcf.gz'])] for chrom in chromosomes],
+                os.path.join(work_dir, ref + '.vcf'))
+    else:
+        # dbsnp.vcf should be bgzipped, but all others should be tar.gz'd
+        input_files['dbsnp.vcf'] = gunzip(input_files['dbsnp.vcf.gz'])
+        for key in ('cosmic.vcf', 'cosmic.vcf.idx', 'dbsnp.vcf.idx'):
+            input_files[key] = untargz(input_files[key + '.tar.gz'], work_dir)
+    intervals = []
+    for chrom in chromosomes:
+        intervals.extend(['-L', chrom])
+    if 'targets.bed' in input_files:
+        # Only call within the target regions on the chromosomes in this batch.  Multiple -L
+        # arguments are combined by union so the bed has to be restricted to the batch.
+        with open(input_files['targets.bed']) as in_bed, \
+                open(os.path.join(work_dir, 'batch_targets.bed'), 'w') as out_bed:
+            for line in in_bed:
+                if line.split('\t')[0] in chromosomes:
+                    out_bed.write(line)
+        if os.path.getsize(out_bed.name) > 0:
+            intervals = ['-L', docker_path(out_bed.name)]
     input_files = {key: docker_path(path) for key, path in input_files.items()}
 
-    mutout = ''.join([work_dir, '/', chrom, '.out'])
-    mutvcf = ''.join([work_dir, '/', chrom, '.vcf'])
+    mutout = ''.join([work_dir, '/batch.out'])
+    mutvcf = ''.join([work_dir, '/batch.vcf'])
     parameters = ['-R', input_files['genome.fa'],
                   '--cosmic', input_files['cosmic.vcf'],
                   '--dbsnp', input_files['dbsnp.vcf'],
@@ -135,18 +187,48 @@ def run_mutect_perchrom(job, tumor_bam, normal_bam, univ_options, mutect_options
                   '--input_file:tumor', input_files['tumor.bam'],
                   # '--tumor_lod', str(10),
                   # '--initial_tumor_lod', str(4.0),
-                  '-L', chrom,
                   '--out', docker_path(mutout),
                   '--vcf', docker_path(mutvcf)
-                  ]
+                  ] + intervals
     java_xmx = mutect_options['java_Xmx'] if mutect_options['java_Xmx'] \
         else univ_options['java_Xmx']
     docker_call(tool='mutect', tool_parameters=parameters, work_dir=work_dir,
                 dockerhub=univ_options['dockerhub'], java_xmx=java_xmx,
                 tool_version=mutect_options['version'])
-    output_file = job.fileStore.writeGlobalFile(mutvcf)
-    export_results(job, output_file, mutvcf, univ_options, subfolder='mutations/mutect')
-    return output_file
+    output_files = defaultdict()
+    for chrom, chromvcf in split_mutect_vcf(mutvcf, chromosomes, work_dir).items():
+        output_files[chrom] = job.fileStore.writeGlobalFile(chromvcf)
+        export_results(job, output_files[chrom], chromvcf, univ_options,
+                       subfolder='mutations/mutect')
+    return dict(output_files)
+
+
+def split_mutect_vcf(mutect_vcf, chromosomes, work_dir):
+    """
+    Split a MuTect vcf spanning several chromosomes into one vcf per chromosome.  Every output vcf
+    carries the full header, even if there were no calls on that chromosome.
+
+    :param str mutect_vcf: Path to the MuTect vcf
+    :param list chromosomes: The chromosomes to write vcfs for
+    :param str work_dir: Directory to write the per-chromosome vcfs into
+    :return: Dict of paths to the vcf for each chromosome
+    :rtype: dict
+    """
+    header = []
+    records = defaultdict(list)
+    with open(mutect_vcf, 'r') as infile:
+        for line in infile:
+            if line.startswith('#'):
+                header.append(line)
+            else:
+                records[line.split('\t', 1)[0]].append(line)
+    chromvcfs = {}
+    for chrom in chromosomes:
+        chromvcfs[chrom] = ''.join([work_dir, '/', chrom, '.vcf'])
+        with open(chromvcfs[chrom], 'w') as outfile:
+            outfile.writelines(header)
+            outfile.writelines(records[chrom])
+    return chromvcfs
 
 
 def process_mutect_vcf(job, mutect_vcf, work_dir, univ_options):
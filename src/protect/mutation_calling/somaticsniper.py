@@ -16,12 +16,14 @@ from __future__ import print_function
 from collections import defaultdict
 from math import ceil
 
+from protect.alignment.common import delete_split_bams, split_bam_by_chromosome
 from protect.common import (docker_path,
                             docker_call,
+                            export_results,
                             get_files_from_filestore,
                             untargz)
-from protect.mutation_calling.common import (sample_chromosomes,
-                                             unmerge)
+from protect.mutation_calling.common import (merge_perchrom_vcfs,
+                                             sample_chromosomes)
 from toil.job import PromisedRequirement
 
 import os
@@ -29,13 +31,13 @@ import os
 
 # disk for somatic sniper, and for filtering
 def sniper_disk(tumor_bam, normal_bam, fasta):
-    return int(ceil(tumor_bam.size) +
-               ceil(normal_bam.size) +
+    return int(2 * ceil(tumor_bam.size) +
+               2 * ceil(normal_bam.size) +
                5 * ceil(fasta.size))
 
 
 def pileup_disk(tumor_bam, fasta):
-    return int(ceil(tumor_bam.size) +
+    return int(2 * ceil(tumor_bam.size) +
                5 * ceil(fasta.size))
 
 
@@ -44,8 +46,6 @@ def sniper_filter_disk(tumor_bam, fasta):
                5 * ceil(fasta.size))
 
 
-# Somatic Sniper is a different tool from the other callers because it is run in full.  Certain
-# redundant modules in this file are kept to maintain a similar naming schema to other callers.
 def run_somaticsniper_with_merge(job, tumor_bam, normal_bam, univ_options, somaticsniper_options):
     """
     A wrapper for the the entire SomaticSniper sub-graph.
@@ -65,14 +65,14 @@ def run_somaticsniper_with_merge(job, tumor_bam, normal_bam, univ_options, somat
 
 def run_somaticsniper(job, tumor_bam, normal_bam, univ_options, somaticsniper_options, split=True):
     """
-    Run the SomaticSniper subgraph on the DNA bams.  Optionally split the results into
-    per-chromosome vcfs.
+    Run the SomaticSniper subgraph on every chromosome in the DNA bams.  Optionally merge the
+    results into a genome-level vcf.
 
     :param dict tumor_bam: Dict of bam and bai for tumor DNA-Seq
     :param dict normal_bam: Dict of bam and bai for normal DNA-Seq
     :param dict univ_options: Dict of universal options used by almost all tools
     :param dict somaticsniper_options: Options specific to SomaticSniper
-    :param bool split: Should the results be split into perchrom vcfs?
+    :param bool split: Should the results be left as perchrom vcfs?
     :return: Either the fsID to the genome-level vcf or a dict of results from running SomaticSniper
              on every chromosome
              perchrom_somaticsniper:
@@ -89,51 +89,90 @@ def run_somaticsniper(job, tumor_bam, normal_bam, univ_options, somaticsniper_op
         chromosomes = somaticsniper_options['chromosomes']
     else:
         chromosomes = sample_chromosomes(job, somaticsniper_options['genome_fai'])
+    # SomaticSniper and the pileup can't be restricted to a region so split the bams by chromosome
+    # once, and run them on each split.
+    split_bams = {}
+    for sample_type, bams in (('tumor_dna', tumor_bam), ('normal_dna', normal_bam)):
+        split_bams[sample_type] = job.addChildJobFn(split_bam_by_chromosome, bams, sample_type,
+                                                    chromosomes, univ_options,
+                                                    somaticsniper_options['samtools'],
+                                                    sample_info='fix_pg_sorted',
+                                                    disk='100M', memory='100M')
+    spawn = job.wrapJobFn(spawn_somaticsniper_perchrom, split_bams['tumor_dna'].rv(),
+                          split_bams['normal_dna'].rv(), univ_options, somaticsniper_options,
+                          split)
+    for sample_type in split_bams:
+        split_bams[sample_type].addChild(spawn)
+        spawn.addFollowOnJobFn(delete_split_bams, split_bams[sample_type].rv(),
+                               univ_options['patient'], disk='100M', memory='100M')
+    return spawn.rv()
+
+
+def spawn_somaticsniper_perchrom(job, tumor_bams, normal_bams, univ_options,
+                                 somaticsniper_options, split=True):
+    """
+    Spawn SomaticSniper, the pileup and the filters on every chromosome in the split DNA bams.
+    Optionally merge the results into a genome-level vcf.  The split bams may be shared with other
+    callers so they are left for the caller of this function to delete.
+
+    :param dict tumor_bams: Dict of bam and bai for tumor DNA-Seq for each chromosome
+    :param dict normal_bams: Dict of bam and bai for normal DNA-Seq for each chromosome
+    :param dict univ_options: Dict of universal options used by almost all tools
+    :param dict somaticsniper_options: Options specific to SomaticSniper
+    :param bool split: Should the results be left as perchrom vcfs?
+    :return: See run_somaticsniper
+    :rtype: toil.fileStore.FileID|dict
+    """
     perchrom_somaticsniper = defaultdict()
-    snipe = job.wrapJobFn(run_somaticsniper_full, tumor_bam, normal_bam, univ_options,
-                          somaticsniper_options,
-                          disk=PromisedRequirement(sniper_disk,
-                                                   tumor_bam['tumor_dna_fix_pg_sorted.bam'],
-                                                   normal_bam['normal_dna_fix_pg_sorted.bam'],
-                                                   somaticsniper_options['genome_fasta']),
-                          memory='6G')
-    pileup = job.wrapJobFn(run_pileup, tumor_bam, univ_options, somaticsniper_options,
-                           disk=PromisedRequirement(pileup_disk,
-                                                    tumor_bam['tumor_dna_fix_pg_sorted.bam'],
-                                                    somaticsniper_options['genome_fasta']),
-                           memory='6G')
-    filtersnipes = job.wrapJobFn(filter_somaticsniper, tumor_bam, snipe.rv(), pileup.rv(),
-                                 univ_options, somaticsniper_options,
-                                 disk=PromisedRequirement(sniper_filter_disk,
-                                                          tumor_bam['tumor_dna_fix_pg_sorted.bam'],
-                                                          somaticsniper_options['genome_fasta']),
-                                 memory='6G')
-
-    job.addChild(snipe)
-    job.addChild(pileup)
-    snipe.addChild(filtersnipes)
-    pileup.addChild(filtersnipes)
+    for chrom in tumor_bams:
+        tumor_bam = tumor_bams[chrom]
+        snipe = job.wrapJobFn(run_somaticsniper_perchrom, tumor_bam, normal_bams[chrom],
+                              univ_options, somaticsniper_options, chrom,
+                              disk=PromisedRequirement(
+                                  sniper_disk,
+                                  tumor_bam['tumor_dna_fix_pg_sorted.bam'],
+                                  normal_bams[chrom]['normal_dna_fix_pg_sorted.bam'],
+                                  somaticsniper_options['genome_fasta']),
+                              memory='6G')
+        pileup = job.wrapJobFn(run_pileup, tumor_bam, univ_options, somaticsniper_options, chrom,
+                               disk=PromisedRequirement(pileup_disk,
+                                                        tumor_bam['tumor_dna_fix_pg_sorted.bam'],
+                                                        somaticsniper_options['genome_fasta']),
+                               memory='6G')
+        filtersnipes = job.wrapJobFn(filter_somaticsniper, tumor_bam, snipe.rv(), pileup.rv(),
+                                     univ_options, somaticsniper_options, chrom,
+                                     disk=PromisedRequirement(
+                                         sniper_filter_disk,
+                                         tumor_bam['tumor_dna_fix_pg_sorted.bam'],
+                                         somaticsniper_options['genome_fasta']),
+                                     memory='6G')
+        job.addChild(snipe)
+        job.addChild(pileup)
+        snipe.addChild(filtersnipes)
+        pileup.addChild(filtersnipes)
+        perchrom_somaticsniper[chrom] = filtersnipes.rv()
     if split:
-        unmerge_snipes = job.wrapJobFn(unmerge, filtersnipes.rv(), 'somaticsniper', chromosomes,
-                                       somaticsniper_options, univ_options)
-        filtersnipes.addChild(unmerge_snipes)
-        return unmerge_snipes.rv()
+        return perchrom_somaticsniper
     else:
-        return filtersnipes.rv()
+        merge = job.addFollowOnJobFn(merge_perchrom_vcfs, perchrom_somaticsniper, 'somaticsniper',
+                                     univ_options)
+        return merge.rv()
 
 
-def run_somaticsniper_full(job, tumor_bam, normal_bam, univ_options, somaticsniper_options):
+def run_somaticsniper_perchrom(job, tumor_bam, normal_bam, univ_options, somaticsniper_options,
+                               chrom):
     """
-    Run SomaticSniper on the DNA bams.
+    Run SomaticSniper on a single chromosome in the DNA bams.
 
-    :param dict tumor_bam: Dict of bam and bai for tumor DNA-Seq
-    :param dict normal_bam: Dict of bam and bai for normal DNA-Seq
+    :param dict tumor_bam: Dict of bam and bai for tumor DNA-Seq on the chromosome
+    :param dict normal_bam: Dict of bam and bai for normal DNA-Seq on the chromosome
     :param dict univ_options: Dict of universal options used by almost all tools
     :param dict somaticsniper_options: Options specific to SomaticSniper
-    :return: fsID to the genome-level vcf
+    :param str chrom: Chromosome to process
+    :return: fsID to the chromosome vcf
     :rtype: toil.fileStore.FileID
     """
-    job.fileStore.logToMaster('Running SomaticSniper on %s' % univ_options['patient'])
+    job.fileStore.logToMaster('Running SomaticSniper on %s:%s' % (univ_options['patient'], chrom))
     work_dir = os.getcwd()
     input_files = {
         'tumor.bam': tumor_bam['tumor_dna_fix_pg_sorted.bam'],
@@ -148,7 +187,7 @@ def run_somaticsniper_full(job, tumor_bam, normal_bam, univ_options, somaticsnip
         input_files[key] = untargz(input_files[key + '.tar.gz'], work_dir)
     input_files = {key: docker_path(path) for key, path in input_files.items()}
 
-    output_file = os.path.join(work_dir, 'somatic-sniper_full.vcf')
+    output_file = os.path.join(work_dir, chrom + '_somatic-sniper.vcf')
     parameters = ['-f', input_files['genome.fa'],
                   '-F', 'vcf',
                   '-G',
@@ -165,19 +204,21 @@ def run_somaticsniper_full(job, tumor_bam, normal_bam, univ_options, somaticsnip
 
 
 def filter_somaticsniper(job, tumor_bam, somaticsniper_output, tumor_pileup, univ_options,
-                         somaticsniper_options):
+                         somaticsniper_options, chrom):
     """
-    Filter SomaticSniper calls.
+    Filter SomaticSniper calls on a single chromosome.
 
-    :param dict tumor_bam: Dict of bam and bai for tumor DNA-Seq
+    :param dict tumor_bam: Dict of bam and bai for tumor DNA-Seq on the chromosome
     :param toil.fileStore.FileID somaticsniper_output: SomaticSniper output vcf
     :param toil.fileStore.FileID tumor_pileup: Pileup generated for the tumor bam
     :param dict univ_options: Dict of universal options used by almost all tools
     :param dict somaticsniper_options: Options specific to SomaticSniper
-    :returns: fsID for the filtered genome-level vcf
+    :param str chrom: Chromosome to process
+    :returns: fsID for the filtered chromosome vcf
     :rtype: toil.fileStore.FileID
     """
-    job.fileStore.logToMaster('Filtering SomaticSniper for %s' % univ_options['patient'])
+    job.fileStore.logToMaster('Filtering SomaticSniper for %s:%s' % (univ_options['patient'],
+                                                                     chrom))
     work_dir = os.getcwd()
     input_files = {
         'tumor.bam': tumor_bam['tumor_dna_fix_pg_sorted.bam'],
@@ -192,6 +233,9 @@ def filter_somaticsniper(job, tumor_bam, somaticsniper_output, tumor_pileup, uni
         input_files[key] = untargz(input_files[key + '.tar.gz'], work_dir)
     input_files = {key: docker_path(path) for key, path in input_files.items()}
 
+    # Each step is its own container since docker_call runs a single script through the image
+    # entrypoint, and the addon scripts write to files named after their inputs instead of stdout
+    # so they can't be piped into each other.
     # Run snpfilter.pl
     parameters = ['snpfilter.pl',
                   '--snp-file', input_files['input.vcf'],
@@ -236,8 +280,10 @@ def filter_somaticsniper(job, tumor_bam, somaticsniper_output, tumor_pileup, uni
     docker_call(tool='somaticsniper-addons', tool_parameters=parameters, work_dir=work_dir,
                 dockerhub=univ_options['dockerhub'], tool_version=somaticsniper_options['version'])
 
-    outfile = job.fileStore.writeGlobalFile(os.path.join(os.getcwd(),
-                                                         'input.vcf.SNPfilter.fp_pass.hc'))
+    output_file = os.path.join(work_dir, chrom + '.vcf')
+    os.rename(os.path.join(work_dir, 'input.vcf.SNPfilter.fp_pass.hc'), output_file)
+    outfile = job.fileStore.writeGlobalFile(output_file)
+    export_results(job, outfile, output_file, univ_options, subfolder='mutations/somaticsniper')
     return outfile
 
 
@@ -256,18 +302,19 @@ def process_somaticsniper_vcf(job, somaticsniper_vcf, work_dir, univ_options):
     return job.fileStore.readGlobalFile(somaticsniper_vcf)
 
 
-def run_pileup(job, tumor_bam, univ_options, somaticsniper_options):
+def run_pileup(job, tumor_bam, univ_options, somaticsniper_options, chrom):
     """
-    Runs a samtools pileup on the tumor bam.
+    Runs a samtools pileup on a single chromosome in the tumor bam.
 
-    :param dict tumor_bam: Dict of bam and bai for tumor DNA-Seq
+    :param dict tumor_bam: Dict of bam and bai for tumor DNA-Seq on the chromosome
     :param dict univ_options: Dict of universal options used by almost all tools
     :param dict somaticsniper_options: Options specific to SomaticSniper
+    :param str chrom: Chromosome to process
     :return: fsID for the pileup file
     :rtype: toil.fileStore.FileID
     """
     job.fileStore.logToMaster(
-        'Running samtools pileup on %s' % univ_options['patient'])
+        'Running samtools pileup on %s:%s' % (univ_options['patient'], chrom))
     work_dir = os.getcwd()
     input_files = {
         'tumor.bam': tumor_bam['tumor_dna_fix_pg_sorted.bam'],
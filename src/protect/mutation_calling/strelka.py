@@ -15,12 +15,14 @@
 from __future__ import print_function
 from math import ceil
 
+from protect.alignment.common import delete_split_bams, split_bam_by_chromosome
 from protect.common import (docker_call,
                             docker_path,
+                            export_results,
                             get_files_from_filestore,
                             untargz)
-from protect.mutation_calling.common import (sample_chromosomes,
-                                             unmerge)
+from protect.mutation_calling.common import (merge_perchrom_vcfs,
+                                             sample_chromosomes)
 from toil.job import PromisedRequirement
 
 import os
@@ -28,13 +30,11 @@ import os
 
 # disk for strelka.
 def strelka_disk(tumor_bam, normal_bam, fasta):
-    return int(ceil(tumor_bam.size) +
-               ceil(normal_bam.size) +
+    return int(2 * ceil(tumor_bam.size) +
+               2 * ceil(normal_bam.size) +
                6 * ceil(fasta.size))
 
 
-# Strelka is a different tool from the other callers because it is run in full.  Certain
-# redundant modules in this file are kept to maintain a similar naming schema to other callers.
 def run_strelka_with_merge(job, tumor_bam, normal_bam, univ_options, strelka_options):
     """
     A wrapper for the the entire strelka sub-graph.
@@ -54,68 +54,103 @@ def run_strelka_with_merge(job, tumor_bam, normal_bam, univ_options, strelka_opt
 
 def run_strelka(job, tumor_bam, normal_bam, univ_options, strelka_options, split=True):
     """
-    Run the strelka subgraph on the DNA bams.  Optionally split the results into per-chromosome
-    vcfs.
+    Run the strelka subgraph on every chromosome in the DNA bams.  Optionally merge the results
+    into genome-level vcfs.
 
     :param dict tumor_bam: Dict of bam and bai for tumor DNA-Seq
     :param dict normal_bam: Dict of bam and bai for normal DNA-Seq
     :param dict univ_options: Dict of universal options used by almost all tools
     :param dict strelka_options: Options specific to strelka
-    :param bool split: Should the results be split into perchrom vcfs?
-    :return: Either the fsID to the genome-level vcf or a dict of results from running strelka
+    :param bool split: Should the results be left as perchrom vcfs?
+    :return: Either the fsIDs to the genome-level vcfs or a dict of results from running strelka
              on every chromosome
              perchrom_strelka:
-                 |- 'chr1':
-                 |      |-'snvs': fsID
-                 |      +-'indels': fsID
-                 |- 'chr2':
-                 |      |-'snvs': fsID
-                 |      +-'indels': fsID
-                 |-...
-                 |
-                 +- 'chrM':
-                        |-'snvs': fsID
-                        +-'indels': fsID
-    :rtype: toil.fileStore.FileID|dict
+                 |- 'snvs':
+                 |      |- 'chr1': fsID
+                 |      |- 'chr2': fsID
+                 |      |- ...
+                 |      +- 'chrM': fsID
+                 +- 'indels':
+                        |- 'chr1': fsID
+                        |- 'chr2': fsID
+                        |- ...
+                        +- 'chrM': fsID
+    :rtype: dict
     """
     if strelka_options['chromosomes']:
         chromosomes = strelka_options['chromosomes']
     else:
         chromosomes = sample_chromosomes(job, strelka_options['genome_fai'])
-    num_cores = min(len(chromosomes), univ_options['max_cores'])
-    strelka = job.wrapJobFn(run_strelka_full, tumor_bam, normal_bam, univ_options,
-                            strelka_options,
-                            disk=PromisedRequirement(strelka_disk,
-                                                     tumor_bam['tumor_dna_fix_pg_sorted.bam'],
-                                                     normal_bam['normal_dna_fix_pg_sorted.bam'],
-                                                     strelka_options['genome_fasta']),
-                            memory='6G',
-                            cores=num_cores)
-    job.addChild(strelka)
+    # Strelka can't be restricted to a region so split the bams by chromosome once, and run strelka
+    # on each split.
+    split_bams = {}
+    for sample_type, bams in (('tumor_dna', tumor_bam), ('normal_dna', normal_bam)):
+        split_bams[sample_type] = job.addChildJobFn(split_bam_by_chromosome, bams, sample_type,
+                                                    chromosomes, univ_options,
+                                                    strelka_options['samtools'],
+                                                    sample_info='fix_pg_sorted',
+                                                    disk='100M', memory='100M')
+    spawn = job.wrapJobFn(spawn_strelka_perchrom, split_bams['tumor_dna'].rv(),
+                          split_bams['normal_dna'].rv(), univ_options, strelka_options, split)
+    for sample_type in split_bams:
+        split_bams[sample_type].addChild(spawn)
+        spawn.addFollowOnJobFn(delete_split_bams, split_bams[sample_type].rv(),
+                               univ_options['patient'], disk='100M', memory='100M')
+    return spawn.rv()
+
+
+def spawn_strelka_perchrom(job, tumor_bams, normal_bams, univ_options, strelka_options,
+                           split=True):
+    """
+    Spawn strelka on every chromosome in the split DNA bams.  Optionally merge the results into
+    genome-level vcfs.  The split bams may be shared with other callers so they are left for the
+    caller of this function to delete.
+
+    :param dict tumor_bams: Dict of bam and bai for tumor DNA-Seq for each chromosome
+    :param dict normal_bams: Dict of bam and bai for normal DNA-Seq for each chromosome
+    :param dict univ_options: Dict of universal options used by almost all tools
+    :param dict strelka_options: Options specific to strelka
+    :param bool split: Should the results be left as perchrom vcfs?
+    :return: See run_strelka
+    :rtype: dict
+    """
+    perchrom_strelka = {'snvs': {}, 'indels': {}}
+    for chrom in tumor_bams:
+        strelka = job.addChildJobFn(run_strelka_perchrom, tumor_bams[chrom], normal_bams[chrom],
+                                    univ_options, strelka_options, chrom,
+                                    disk=PromisedRequirement(
+                                        strelka_disk,
+                                        tumor_bams[chrom]['tumor_dna_fix_pg_sorted.bam'],
+                                        normal_bams[chrom]['normal_dna_fix_pg_sorted.bam'],
+                                        strelka_options['genome_fasta']),
+                                    memory='6G')
+        for mutation_type in ('snvs', 'indels'):
+            perchrom_strelka[mutation_type][chrom] = strelka.rv(mutation_type)
     if split:
-        unmerge_strelka = job.wrapJobFn(wrap_unmerge, strelka.rv(), chromosomes, strelka_options,
-                                        univ_options).encapsulate()
-        strelka.addChild(unmerge_strelka)
-        return unmerge_strelka.rv()
+        return perchrom_strelka
     else:
-        return strelka.rv()
+        return {'snvs': job.addFollowOnJobFn(merge_perchrom_vcfs, perchrom_strelka['snvs'],
+                                             'strelka/snv', univ_options).rv(),
+                'indels': job.addFollowOnJobFn(merge_perchrom_vcfs, perchrom_strelka['indels'],
+                                               'strelka/indel', univ_options).rv()}
 
 
-def run_strelka_full(job, tumor_bam, normal_bam, univ_options, strelka_options):
+def run_strelka_perchrom(job, tumor_bam, normal_bam, univ_options, strelka_options, chrom):
     """
-    Run strelka on the DNA bams.
+    Run strelka on a single chromosome in the DNA bams.
 
-    :param dict tumor_bam: Dict of bam and bai for tumor DNA-Seq
-    :param dict normal_bam: Dict of bam and bai for normal DNA-Seq
+    :param dict tumor_bam: Dict of bam and bai for tumor DNA-Seq on the chromosome
+    :param dict normal_bam: Dict of bam and bai for normal DNA-Seq on the chromosome
     :param dict univ_options: Dict of universal options used by almost all tools
     :param dict strelka_options: Options specific to strelka
-    :return: Dict of fsIDs snv and indel prediction files
+    :param str chrom: Chromosome to process
+    :return: Dict of fsIDs snv and indel prediction files for the chromosome
              output_dict:
                  |-'snvs': fsID
                  +-'indels': fsID
     :rtype: dict
     """
-    job.fileStore.logToMaster('Running strelka on %s' % univ_options['patient'])
+    job.fileStore.logToMaster('Running strelka on %s:%s' % (univ_options['patient'], chrom))
     work_dir = os.getcwd()
     input_files = {
         'tumor.bam': tumor_bam['tumor_dna_fix_pg_sorted.bam'],
@@ -141,9 +176,14 @@ def run_strelka_full(job, tumor_bam, normal_bam, univ_options, strelka_options):
     docker_call(tool='strelka', tool_parameters=parameters, work_dir=work_dir,
                 dockerhub=univ_options['dockerhub'], tool_version=strelka_options['version'])
     output_dict = {}
-    for mutation_type in ['snvs', 'indels']:
-        output_dict[mutation_type] = job.fileStore.writeGlobalFile(os.path.join(
-            work_dir, 'strelka_out', 'results', 'passed.somatic.' + mutation_type + '.vcf'))
+    for mutation_type, subfolder in (('snvs', 'snv'), ('indels', 'indel')):
+        os.mkdir(os.path.join(work_dir, mutation_type))
+        output_file = os.path.join(work_dir, mutation_type, chrom + '.vcf')
+        os.rename(os.path.join(work_dir, 'strelka_out', 'results',
+                               'passed.somatic.' + mutation_type + '.vcf'), output_file)
+        output_dict[mutation_type] = job.fileStore.writeGlobalFile(output_file)
+        export_results(job, output_dict[mutation_type], output_file, univ_options,
+                       subfolder='mutations/strelka/' + subfolder)
     return output_dict
 
 
@@ -159,31 +199,3 @@ def process_strelka_vcf(job, strelka_vcf, work_dir, univ_options):
     :rtype: str
     """
     return job.fileStore.readGlobalFile(strelka_vcf)
-
-
-def wrap_unmerge(job, strelka_out, chromosomes, strelka_options, univ_options):
-    """
-    A wwrapper to unmerge the strelka snvs and indels
-
-    :param dict strelka_out: Results from run_strelka
-    :param list chromosomes: List of chromosomes to retain
-    :param dict strelka_options: Options specific to strelka
-    :param dict univ_options: Dict of universal options used by almost all tools
-    :return: Dict of dicts containing the fsIDs for the per-chromosome snv and indel calls
-             output:
-               |- 'snvs':
-               |      |- 'chr1': fsID
-               |      |- 'chr2': fsID
-               |      |- ...
-               |      +- 'chrM': fsID
-               +- 'indels':
-                      |- 'chr1': fsID
-                      |- 'chr2': fsID
-                      |- ...
-                      +- 'chrM': fsID
-    :rtype: dict
-    """
-    return {'snvs': job.addChildJobFn(unmerge, strelka_out['snvs'], 'strelka/snv', chromosomes,
-                                      strelka_options, univ_options).rv(),
-            'indels': job.addChildJobFn(unmerge, strelka_out['indels'], 'strelka/indel',
-                                        chromosomes, strelka_options, univ_options).rv()}
@@ -19,10 +19,26 @@ from math import ceil
 from protect.common import (docker_call,
                             get_files_from_filestore,
                             export_results,
+                            IndexedFasta,
+                            merge_sharded_vcfs,
+                            split_vcf_into_shards,
                             untargz,
                             docker_path)
 
+import json
+import logging
+import multiprocessing
 import os
+import re
+
+# The peptide lengths generated for each IAR
+PEPTIDE_LENGTHS = (9, 10, 15)
+# The peptide lengths predicted for MHCI.  The MHCI calls of all lengths are named after the IARs,
+# so the IARs for each of these lengths must be the same.
+MHCI_PEPTIDE_LENGTHS = (9, 10)
+# Transgene phases the neighbouring mutations in a peptide using the reads within (length - 1)
+# codons of the mutation, so the variant regions must be padded by at least this much.
+TRANSGENE_READ_WINDOW = 3 * (max(PEPTIDE_LENGTHS) - 1)
 
 
 def transgene_disk(rna_bamfiles, tdna_bam=None):
@@ -31,19 +47,166 @@ def transgene_disk(rna_bamfiles, tdna_bam=None):
                104857600)
 
 
-def run_transgene(job, snpeffed_file, rna_bam, univ_options, transgene_options, tumor_dna_bam=None, fusion_calls=None):
+def make_variant_regions(job, snpeffed_file, univ_options, transgene_options):
+    """
+    Create a bed file spanning each variant in the snpeffed vcf (padded on either side by
+    transgene_options['variant_padding'] bases) so that only the reads required by transgene need
+    to be extracted from the bams.  The padding is never less than the window transgene reads
+    around a variant.
+
+    :param toil.fileStore.FileID snpeffed_file: fsID for snpeffed vcf
+    :param dict univ_options: Dict of universal options used by almost all tools
+    :param dict transgene_options: Options specific to Transgene
+    :return: fsID for the bed file of variant regions
+    :rtype: toil.fileStore.FileID
     """
-    Run transgene on an input snpeffed vcf file and return the peptides for MHC prediction.
+    job.fileStore.logToMaster('Creating variant regions for %s' % univ_options['patient'])
+    padding = int(transgene_options['variant_padding'])
+    if padding < TRANSGENE_READ_WINDOW:
+        job.fileStore.logToMaster('variant_padding (%s) is smaller than the window transgene reads '
+                                  'around a variant. Using %s instead.' %
+                                  (padding, TRANSGENE_READ_WINDOW))
+        padding = TRANSGENE_READ_WINDOW
+    work_dir = os.getcwd()
+    input_files = {
+        'snpeffed_muts.vcf': snpeffed_file}
+    input_files = get_files_from_filestore(job, input_files, work_dir, docker=False)
+    with open(input_files['snpeffed_muts.vcf']) as vcf, \
+            open(os.path.join(work_dir, 'variant_regions.bed'), 'w') as bed:
+        for line in vcf:
+            if line.startswith('#'):
+                continue
+            line = line.split('\t')
+            # vcf is 1-based, bed is 0-based half open
+            start = int(line[1]) - 1
+            print(line[0], max(0, start - padding), start + len(line[3]) + padding, sep='\t',
+                  file=bed)
+    return job.fileStore.writeGlobalFile(bed.name)
+
 
+def wrap_transgene(job, snpeffed_file, rna_bam, univ_options, transgene_options, tumor_dna_bam=None,
+                   fusion_calls=None):
+    """
+    A wrapper for run_transgene.  If transgene_options['shards'] is greater than 1, the snpeffed vcf
+    is split into that many shards of whole chromosomes (balanced by the number of variants in each)
+    and transgene is run on each shard in parallel.  Every variant in an IAR is on the same
+    chromosome so transgene sees the same set of neighbouring mutations in a shard as it would in
+    the full vcf.  The per-shard peptide fastas and .map files are then merged with
+    merge_transgene_shards.
 
     :param toil.fileStore.FileID snpeffed_file: fsID for snpeffed vcf
     :param dict rna_bam: The dict of bams returned by running star
     :param dict univ_options: Dict of universal options used by almost all tools
     :param dict transgene_options: Options specific to Transgene
     :param dict tumor_dna_bam: The dict of bams returned by running bwa
-    :return: A dictionary of 9 files (9-, 10-, and 15-mer peptides each for Tumor and Normal and the
-             corresponding .map files for the 3 Tumor fastas)
+    :param toil.fileStore.FileID fusion_calls: fsID for the transgene bedpe of fusion calls
+    :return: The output of run_transgene (or merge_transgene_shards)
+    :rtype: dict
+    """
+    disk = transgene_disk(rna_bam, tumor_dna_bam)
+    num_shards = int(transgene_options['shards'])
+    if num_shards > 1:
+        work_dir = os.getcwd()
+        input_files = {
+            'snpeffed_muts.vcf': snpeffed_file}
+        input_files = get_files_from_filestore(job, input_files, work_dir, docker=False)
+        shard_vcfs = split_vcf_into_shards(input_files['snpeffed_muts.vcf'], num_shards, work_dir)
+    else:
+        shard_vcfs = []
+    if len(shard_vcfs) <= 1:
+        transgene = job.wrapJobFn(run_transgene, snpeffed_file, rna_bam, univ_options,
+                                  transgene_options, tumor_dna_bam=tumor_dna_bam,
+                                  fusion_calls=fusion_calls, disk=disk, memory='100M',
+                                  cores=transgene_options['n'])
+        job.addChild(transgene)
+        return transgene.rv()
+    job.fileStore.logToMaster('Running transgene on %s in %s shards' % (univ_options['patient'],
+                                                                        len(shard_vcfs)))
+    shards = []
+    for shard, shard_vcf in enumerate(shard_vcfs):
+        # Fusions are independent of the snvs so they are only translated in the first shard.
+        shards.append(job.wrapJobFn(run_transgene, job.fileStore.writeGlobalFile(shard_vcf),
+                                    rna_bam, univ_options, transgene_options,
+                                    tumor_dna_bam=tumor_dna_bam,
+                                    fusion_calls=fusion_calls if shard == 0 else None,
+                                    export=False, disk=disk, memory='100M',
+                                    cores=transgene_options['n']))
+        job.addChild(shards[-1])
+    merge = job.wrapJobFn(merge_transgene_shards, [shard.rv() for shard in shards], univ_options,
+                          disk='100M', memory='100M', cores=1)
+    job.addFollowOn(merge)
+    return merge.rv()
+
+
+def merge_transgene_shards(job, shard_outputs, univ_options):
+    """
+    Merge the outputs of running transgene on each shard of the snpeffed vcf.  Peptide names are
+    kept as is unless they were already seen in an earlier shard, in which case they are suffixed
+    with the shard number in the tumor and normal fastas, and the .map file for that peptide length.
+    The transgened vcfs are merged in chromosome order.
+
+    :param list shard_outputs: The return values of run_transgene on each shard
+    :param dict univ_options: Dict of universal options used by almost all tools
+    :return: A dictionary of the merged files in the same form as that returned by run_transgene
+    :rtype: dict
+    """
+    job.fileStore.logToMaster('Merging transgene shards for %s' % univ_options['patient'])
+    work_dir = os.getcwd()
+    output_files = defaultdict()
+    for peplen in ['9', '10', '15']:
+        tumor_file = '_'.join(['transgened_tumor', peplen, 'mer_snpeffed.faa'])
+        normal_file = '_'.join(['transgened_normal', peplen, 'mer_snpeffed.faa'])
+        map_file = tumor_file + '.map'
+        pepmap = {}
+        with open(os.path.join(work_dir, tumor_file), 'w') as t_f, \
+                open(os.path.join(work_dir, normal_file), 'w') as n_f:
+            for shard, shard_output in enumerate(shard_outputs):
+                with open(job.fileStore.readGlobalFile(shard_output[map_file])) as m_f:
+                    shard_map = json.load(m_f)
+                names = {}
+                for name in shard_map:
+                    names[name] = name if name not in pepmap else '_'.join([name, str(shard)])
+                    pepmap[names[name]] = shard_map[name]
+                for in_file, out_file in ((tumor_file, t_f), (normal_file, n_f)):
+                    with open(job.fileStore.readGlobalFile(shard_output[in_file])) as in_f:
+                        for line in in_f:
+                            if line.startswith('>'):
+                                name = line.strip().lstrip('>')
+                                line = '>%s\n' % names.get(name, name)
+                            out_file.write(line)
+        with open(os.path.join(work_dir, map_file), 'w') as m_f:
+            json.dump(pepmap, m_f)
+        for pepfile in tumor_file, normal_file, map_file:
+            output_files[pepfile] = job.fileStore.writeGlobalFile(os.path.join(work_dir, pepfile))
+            export_results(job, output_files[pepfile], pepfile, univ_options, subfolder='peptides')
+    merge_sharded_vcfs([job.fileStore.readGlobalFile(shard_output['mutations.vcf'])
+                        for shard_output in shard_outputs],
+                       os.path.join(work_dir, 'mutations.vcf'))
+    output_files['mutations.vcf'] = job.fileStore.writeGlobalFile('mutations.vcf')
+    export_results(job, output_files['mutations.vcf'], 'mutations.vcf', univ_options,
+                   subfolder='mutations/transgened')
+    return output_files
+
+
+def run_transgene(job, snpeffed_file, rna_bam, univ_options, transgene_options, tumor_dna_bam=None,
+                  fusion_calls=None, export=True):
+    """
+    Run transgene on an input snpeffed vcf file and return the peptides for MHC prediction.  If
+    transgene_options['native'] is set, the peptides are generated in-process by
+    translate_snpeffed_vcf instead of the transgene container.
+
+
+    :param toil.fileStore.FileID snpeffed_file: fsID for snpeffed vcf
+    :param dict rna_bam: The dict of bams returned by running star
+    :param dict univ_options: Dict of universal options used by almost all tools
+    :param dict transgene_options: Options specific to Transgene
+    :param dict tumor_dna_bam: The dict of bams returned by running bwa
+    :param toil.fileStore.FileID fusion_calls: fsID for the transgene bedpe of fusion calls
+    :param bool export: Should the results be exported?
+    :return: A dictionary of 10 files (9-, 10-, and 15-mer peptides each for Tumor and Normal, the
+             corresponding .map files for the 3 Tumor fastas, and the transgened vcf)
              output_files:
+                 |- 'mutations.vcf': fsID
                  |- 'transgened_normal_10_mer_snpeffed.faa': fsID
                  |- 'transgened_normal_15_mer_snpeffed.faa': fsID
                  |- 'transgened_normal_9_mer_snpeffed.faa': fsID
@@ -57,62 +220,240 @@ def run_transgene(job, snpeffed_file, rna_bam, univ_options, transgene_options,
     """
     job.fileStore.logToMaster('Running transgene on %s' % univ_options['patient'])
     work_dir = os.getcwd()
-    input_files = {
-        'snpeffed_muts.vcf': snpeffed_file,
-        'rna.bam': rna_bam['rna_genome']['rna_genome_sorted.bam'],
-        'rna.bam.bai': rna_bam['rna_genome']['rna_genome_sorted.bam.bai'],
-        'pepts.fa.tar.gz': transgene_options['gencode_peptide_fasta']}
-    if tumor_dna_bam is not None:
-        input_files.update({
-            'tumor_dna.bam': tumor_dna_bam['tumor_dna_fix_pg_sorted.bam'],
-            'tumor_dna.bam.bai': tumor_dna_bam['tumor_dna_fix_pg_sorted.bam.bai'],
-        })
-    input_files = get_files_from_filestore(job, input_files, work_dir, docker=False)
-    input_files['pepts.fa'] = untargz(input_files['pepts.fa.tar.gz'], work_dir)
-    input_files = {key: docker_path(path) for key, path in input_files.items()}
-
-    parameters = ['--peptides', input_files['pepts.fa'],
-                  '--snpeff', input_files['snpeffed_muts.vcf'],
-                  '--rna_file', input_files['rna.bam'],
-                  '--prefix', 'transgened',
-                  '--pep_lens', '9,10,15',
-                  '--cores', str(transgene_options['n'])]
-
-    if tumor_dna_bam is not None:
-        parameters.extend(['--dna_file', input_files['tumor_dna.bam']])
-
-    if fusion_calls:
-        fusion_files = {'fusion_calls': fusion_calls,
-                        'transcripts.fa.tar.gz': transgene_options['gencode_transcript_fasta'],
-                        'annotation.gtf.tar.gz': transgene_options['gencode_annotation_gtf'],
-                        'genome.fa.tar.gz': transgene_options['genome_fasta']}
-
-        fusion_files = get_files_from_filestore(job, fusion_files, work_dir, docker=False)
-        fusion_files['transcripts.fa'] = untargz(fusion_files['transcripts.fa.tar.gz'], work_dir)
-        fusion_files['genome.fa'] = untargz(fusion_files['genome.fa.tar.gz'], work_dir)
-        fusion_files['annotation.gtf'] = untargz(fusion_files['annotation.gtf.tar.gz'], work_dir)
-        fusion_files = {key: docker_path(path) for key, path in fusion_files.items()}
-        parameters += ['--transcripts', fusion_files['transcripts.fa'],
-                       '--fusions', fusion_files['fusion_calls'],
-                       '--genome', fusion_files['genome.fa'],
-                       '--annotation', fusion_files['annotation.gtf']]
-
-    docker_call(tool='transgene',
-                tool_parameters=parameters,
-                work_dir=work_dir,
-                dockerhub=univ_options['dockerhub'],
-                tool_version=transgene_options['version'])
+    native = transgene_options['native']
+    if native and (fusion_calls or tumor_dna_bam is not None):
+        job.fileStore.logToMaster('The native transgene engine does not translate fusions or '
+                                  'filter for OxoG artifacts. Running the transgene container on '
+                                  '%s instead.' % univ_options['patient'], level=logging.WARNING)
+        native = False
+    if native:
+        input_files = {
+            'snpeffed_muts.vcf': snpeffed_file,
+            'pepts.fa.tar.gz': transgene_options['gencode_peptide_fasta']}
+        input_files = get_files_from_filestore(job, input_files, work_dir, docker=False)
+        input_files['pepts.fa'] = untargz(input_files['pepts.fa.tar.gz'], work_dir)
+        translate_snpeffed_vcf(input_files['snpeffed_muts.vcf'], input_files['pepts.fa'],
+                               'transgened', PEPTIDE_LENGTHS, max(MHCI_PEPTIDE_LENGTHS), work_dir,
+                               cores=transgene_options['n'])
+    else:
+        input_files = {
+            'snpeffed_muts.vcf': snpeffed_file,
+            'rna.bam': rna_bam['rna_genome']['rna_genome_sorted.bam'],
+            'rna.bam.bai': rna_bam['rna_genome']['rna_genome_sorted.bam.bai'],
+            'pepts.fa.tar.gz': transgene_options['gencode_peptide_fasta']}
+        if tumor_dna_bam is not None:
+            input_files.update({
+                'tumor_dna.bam': tumor_dna_bam['tumor_dna_fix_pg_sorted.bam'],
+                'tumor_dna.bam.bai': tumor_dna_bam['tumor_dna_fix_pg_sorted.bam.bai'],
+            })
+        input_files = get_files_from_filestore(job, input_files, work_dir, docker=False)
+        input_files['pepts.fa'] = untargz(input_files['pepts.fa.tar.gz'], work_dir)
+        input_files = {key: docker_path(path) for key, path in input_files.items()}
+
+        parameters = ['--peptides', input_files['pepts.fa'],
+                      '--snpeff', input_files['snpeffed_muts.vcf'],
+                      '--rna_file', input_files['rna.bam'],
+                      '--prefix', 'transgened',
+                      '--pep_lens', ','.join(str(x) for x in PEPTIDE_LENGTHS),
+                      '--cores', str(transgene_options['n'])]
+
+        if tumor_dna_bam is not None:
+            parameters.extend(['--dna_file', input_files['tumor_dna.bam']])
+
+        if fusion_calls:
+            fusion_files = {'fusion_calls': fusion_calls,
+                            'transcripts.fa.tar.gz': transgene_options['gencode_transcript_fasta'],
+                            'annotation.gtf.tar.gz': transgene_options['gencode_annotation_gtf'],
+                            'genome.fa.tar.gz': transgene_options['genome_fasta']}
+
+            fusion_files = get_files_from_filestore(job, fusion_files, work_dir, docker=False)
+            fusion_files['transcripts.fa'] = untargz(fusion_files['transcripts.fa.tar.gz'],
+                                                     work_dir)
+            fusion_files['genome.fa'] = untargz(fusion_files['genome.fa.tar.gz'], work_dir)
+            fusion_files['annotation.gtf'] = untargz(fusion_files['annotation.gtf.tar.gz'],
+                                                     work_dir)
+            fusion_files = {key: docker_path(path) for key, path in fusion_files.items()}
+            parameters += ['--transcripts', fusion_files['transcripts.fa'],
+                           '--fusions', fusion_files['fusion_calls'],
+                           '--genome', fusion_files['genome.fa'],
+                           '--annotation', fusion_files['annotation.gtf']]
+
+        docker_call(tool='transgene',
+                    tool_parameters=parameters,
+                    work_dir=work_dir,
+                    dockerhub=univ_options['dockerhub'],
+                    tool_version=transgene_options['version'])
 
     output_files = defaultdict()
     for peplen in ['9', '10', '15']:
         for tissue_type in ['tumor', 'normal']:
             pepfile = '_'.join(['transgened', tissue_type,  peplen, 'mer_snpeffed.faa'])
             output_files[pepfile] = job.fileStore.writeGlobalFile(os.path.join(work_dir, pepfile))
-            export_results(job, output_files[pepfile], pepfile, univ_options, subfolder='peptides')
+            if export:
+                export_results(job, output_files[pepfile], pepfile, univ_options,
+                               subfolder='peptides')
         mapfile = '_'.join(['transgened_tumor', peplen, 'mer_snpeffed.faa.map'])
         output_files[mapfile] = job.fileStore.writeGlobalFile(os.path.join(work_dir, mapfile))
-        export_results(job, output_files[mapfile], mapfile, univ_options, subfolder='peptides')
+        if export:
+            export_results(job, output_files[mapfile], mapfile, univ_options, subfolder='peptides')
     os.rename('transgened_transgened.vcf', 'mutations.vcf')
-    export_results(job, job.fileStore.writeGlobalFile('mutations.vcf'), 'mutations.vcf',
-                   univ_options, subfolder='mutations/transgened')
+    output_files['mutations.vcf'] = job.fileStore.writeGlobalFile('mutations.vcf')
+    if export:
+        export_results(job, output_files['mutations.vcf'], 'mutations.vcf', univ_options,
+                       subfolder='mutations/transgened')
     return output_files
+
+
+# The snpeff effects that translate to a substitution of one or more amino acids
+_NATIVE_EFFECTS = ('NON_SYNONYMOUS_CODING', 'CODON_CHANGE')
+_AA_CHANGE = re.compile(r'^([ACDEFGHIKLMNPQRSTVWY]+)(\d+)([ACDEFGHIKLMNPQRSTVWY]+)$')
+_EFF = re.compile(r'(\w+)\(([^)]*)\)')
+# The peptide store used by the worker processes of translate_snpeffed_vcf
+_PEPTIDES = None
+
+
+def translate_snpeffed_vcf(snpeffed_vcf, peptide_fasta, prefix, peplens, cluster_len, work_dir,
+                           cores=1):
+    """
+    Generate the tumor and normal peptide fastas, and the tumor .map files, for the amino acid
+    substitutions (SNVs and MNVs) in a snpeffed vcf without running the transgene container.  The
+    output files are named the same as those written by transgene.  Substitutions on the same
+    transcript that are close enough to fall in the same `cluster_len`-mer are placed in the same
+    IAR (Immunogenic Amino acid Region), named <gene>_<transcript>_<mutations>.  The IARs are the
+    same for every n-mer length, so an IAR has the same name in each output fasta.  The map holds
+    the gene, transcript, HUGO name and mutations for every IAR.  Unlike the container, reads are
+    not checked for RNA evidence of the mutation.
+
+    :param str snpeffed_vcf: Path to the snpeffed vcf
+    :param str peptide_fasta: Path to the gencode peptide fasta
+    :param str prefix: The prefix for the output files
+    :param list peplens: The lengths of the n-mers to generate IARs for
+    :param int cluster_len: The n-mer length used to group substitutions into IARs.  This must be
+           at most one more than the shortest of `peplens` so every n-mer in an IAR has a
+           substitution.
+    :param str work_dir: The directory to write the output files into
+    :param int cores: The number of processes to translate transcripts in
+    :return: None
+    """
+    mutations = defaultdict(set)
+    mutation_records = defaultdict(list)
+    with IndexedFasta(peptide_fasta) as peptides, open(snpeffed_vcf) as infile, \
+            open(os.path.join(work_dir, prefix + '_transgened.vcf'), 'w') as outvcf:
+        # Gencode peptide records are named ENSP|ENST|ENSG|OTTHUMG|OTTHUMT|<isoform>|<HUGO>|<length>
+        transcripts = {}
+        for record in peptides:
+            fields = record.split('|')
+            if len(fields) > 6:
+                transcripts[fields[1]] = transcripts[fields[1].split('.')[0]] = record
+        for line in infile:
+            if line.startswith('#'):
+                outvcf.write(line)
+                continue
+            for info in line.split('\t')[7].strip().split(';'):
+                if not info.startswith('EFF='):
+                    continue
+                for effect, fields in _EFF.findall(info[4:]):
+                    fields = fields.split('|')
+                    if effect not in _NATIVE_EFFECTS or len(fields) < 9:
+                        continue
+                    aa_change = _AA_CHANGE.match(fields[3])
+                    transcript = transcripts.get(fields[8],
+                                                 transcripts.get(fields[8].split('.')[0]))
+                    if aa_change is None or transcript is None:
+                        continue
+                    ref, pos, alt = aa_change.groups()
+                    if len(ref) != len(alt):
+                        continue
+                    mutations[transcript].add((int(pos) - 1, ref, alt))
+                    mutation_records[transcript, int(pos) - 1, ref, alt].append(line)
+        tasks = [(transcript, sorted(mutations[transcript]), peplens, cluster_len)
+                 for transcript in sorted(mutations)]
+        if cores > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(cores, _init_peptide_store,
+                                        (peptide_fasta, peptides.index))
+            try:
+                results = pool.map(_translate_transcript, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            _init_peptide_store(peptide_fasta, peptides.index)
+            with _PEPTIDES:
+                results = [_translate_transcript(task) for task in tasks]
+        # Write the vcf records that were translated, once each, in the order they were read
+        translated = set()
+        for (transcript, _, _), (iars, used) in zip(tasks, results):
+            for mutation in used:
+                translated.update(mutation_records[(transcript,) + mutation])
+        with open(snpeffed_vcf) as infile:
+            for line in infile:
+                if line in translated:
+                    outvcf.write(line)
+                    translated.remove(line)
+    for peplen in peplens:
+        pepmap = {}
+        filename = '_'.join([prefix, '%s', str(peplen), 'mer_snpeffed.faa'])
+        with open(os.path.join(work_dir, filename % 'tumor'), 'w') as t_f, \
+                open(os.path.join(work_dir, filename % 'normal'), 'w') as n_f:
+            for iars, _ in results:
+                for name, tumor, normal, mapping in iars[peplen]:
+                    print('>' + name, tumor, sep='\n', file=t_f)
+                    print('>' + name, normal, sep='\n', file=n_f)
+                    pepmap[name] = mapping
+        with open(os.path.join(work_dir, filename % 'tumor') + '.map', 'w') as m_f:
+            json.dump(pepmap, m_f)
+
+
+def _init_peptide_store(peptide_fasta, index):
+    """
+    Open the peptide store used by _translate_transcript in this process.
+
+    :param str peptide_fasta: Path to the gencode peptide fasta
+    :param dict index: The index of the fasta
+    """
+    global _PEPTIDES
+    _PEPTIDES = IndexedFasta(peptide_fasta, index=index)
+
+
+def _translate_transcript(task):
+    """
+    Generate the IARs for the substitutions on one transcript.
+
+    :param tuple task: The gencode peptide record for the transcript, the sorted substitutions on it
+           as (0-based position, reference amino acids, alternate amino acids), the n-mer lengths,
+           and the n-mer length used to group the substitutions into IARs
+    :return: The IARs for each n-mer length as (name, tumor sequence, normal sequence, map entry),
+             and the substitutions that matched the reference protein
+    :rtype: tuple(dict, list)
+    """
+    transcript, mutations, peplens, cluster_len = task
+    normal = _PEPTIDES[transcript]
+    fields = transcript.split('|')
+    # Substitutions that don't match the reference protein are from a different annotation
+    mutations = [m for m in mutations if normal[m[0]:m[0] + len(m[1])] == m[1]]
+    tumor = list(normal)
+    for pos, ref, alt in mutations:
+        tumor[pos:pos + len(alt)] = alt
+    tumor = ''.join(tumor)
+    # Mutations that can appear in the same n-mer go in the same IAR.  The IARs are built once so
+    # the IARs for a mutation have the same name for every n-mer length.
+    clusters = []
+    for mutation in mutations:
+        if clusters and mutation[0] < clusters[-1][-1][0] + len(clusters[-1][-1][1]) + \
+                cluster_len - 1:
+            clusters[-1].append(mutation)
+        else:
+            clusters.append([mutation])
+    iars = {}
+    for peplen in peplens:
+        iars[peplen] = []
+        for cluster in clusters:
+            start = max(0, cluster[0][0] - peplen + 1)
+            end = min(len(normal), cluster[-1][0] + len(cluster[-1][1]) + peplen - 1)
+            if end - start < peplen:
+                continue
+            muts = ['%s%s%s' % (ref, pos + 1, alt) for pos, ref, alt in cluster]
+            iars[peplen].append(('_'.join([fields[2], fields[1], '+'.join(muts)]),
+                                 tumor[start:end], normal[start:end],
+                                 '\t'.join([fields[2], fields[1], fields[6], ','.join(muts)])))
+    return iars, mutations
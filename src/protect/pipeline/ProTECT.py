@@ -24,9 +24,15 @@ from __future__ import print_function
 from collections import defaultdict
 from multiprocessing import cpu_count
 
-from protect.addons.assess_car_t_validity import run_car_t_validity_assessment
-from protect.addons.assess_immunotherapy_resistance import run_itx_resistance_assessment
-from protect.addons.assess_mhc_pathway import run_mhc_gene_assessment
+from protect.addons.cohort import (find_patient_expression,
+                                  read_report_inputs,
+                                  update_cohort,
+                                  write_cohort_reports)
+from protect.addons.reports import run_reports
+from protect.alignment.common import (delete_split_bams,
+                                     slice_bamfile,
+                                     slice_disk,
+                                     split_bam_by_chromosome)
 from protect.alignment.dna import align_dna
 from protect.alignment.rna import align_rna
 from protect.binding_prediction.common import merge_mhc_peptide_calls, spawn_antigen_predictors
@@ -42,19 +48,31 @@ from protect.common import (delete_bams,
                             is_gzipfile,
                             gunzip)
 from protect.expression_profiling.rsem import wrap_rsem
-from protect.haplotyping.phlat import merge_phlat_calls, phlat_disk, run_phlat
-from protect.mutation_annotation.snpeff import run_snpeff, snpeff_disk
-from protect.mutation_calling.common import run_mutation_aggregator
+from protect.haplotyping.phlat import (cache_haplotype,
+                                      get_cached_haplotype,
+                                      haplotype_cache_entry,
+                                      merge_phlat_calls,
+                                      phlat_disk,
+                                      prefilter_hla_reads,
+                                      run_phlat,
+                                      subsample_phlat_reads)
+from protect.mutation_annotation.snpeff import wrap_snpeff
+from protect.mutation_calling.common import (make_target_regions,
+                                             prepare_reference_shards,
+                                             reference_shards_disk,
+                                             run_mutation_aggregator,
+                                             sample_chromosomes,
+                                             target_regions_disk)
 from protect.mutation_calling.fusion import wrap_fusion
 from protect.mutation_calling.indel import run_indel_caller
 from protect.mutation_calling.muse import run_muse
 from protect.mutation_calling.mutect import run_mutect
 from protect.mutation_calling.radia import run_radia
-from protect.mutation_calling.somaticsniper import run_somaticsniper
-from protect.mutation_calling.strelka import run_strelka
-from protect.mutation_translation import run_transgene, transgene_disk
+from protect.mutation_calling.somaticsniper import spawn_somaticsniper_perchrom
+from protect.mutation_calling.strelka import spawn_strelka_perchrom
+from protect.mutation_translation import make_variant_regions, wrap_transgene
 from protect.qc.rna import cutadapt_disk, run_cutadapt
-from protect.rankboost import wrap_rankboost
+from protect.rankboost import rerank_patient, wrap_rankboost
 from toil.job import Job, PromisedRequirement
 
 import argparse
@@ -63,6 +81,7 @@ import pkg_resources
 import re
 import shutil
 import sys
+import tempfile
 import yaml
 
 
@@ -394,6 +413,11 @@ def _parse_config_file(job, config_file, max_cores=None):
     # netmhciipan needs to be handled separately
     tool_options['mhcii']['netmhciipan'] = tool_options['netmhciipan']
     tool_options.pop('netmhciipan')
+    # Targeted mutation calling derives its regions from the transgene annotation
+    if tool_options['target_regions']['run'] and \
+            not tool_options['transgene'].get('gencode_annotation_gtf'):
+        raise ParameterError('Targeted mutation calling requires `gencode_annotation_gtf` to be '
+                             'provided to transgene.')
     # Check for encryption related issues before we download files.
     if ssec_encrypted:
         assert univ_options['sse_key'] is not None, 'Cannot read ssec encrypted data without a key.'
@@ -405,7 +429,14 @@ def _parse_config_file(job, config_file, max_cores=None):
     process_tool_inputs = job.addChildJobFn(get_all_tool_inputs, tool_options,
                                             mutation_caller_list=mutation_caller_list)
     job.fileStore.logToMaster('Obtained tool inputs')
-    return sample_set, univ_options, process_tool_inputs.rv()
+    # MuTect and MuSE only run for patients that don't provide a mutation vcf
+    if all('mutation_vcf' in sample_set[patient] for patient in sample_set):
+        return sample_set, univ_options, process_tool_inputs.rv()
+    # Split dbSNP and COSMIC per chromosome once for all patients
+    shard_references = process_tool_inputs.addFollowOnJobFn(
+        prepare_reference_shards, process_tool_inputs.rv(), univ_options,
+        disk=PromisedRequirement(reference_shards_disk, process_tool_inputs.rv()))
+    return sample_set, univ_options, shard_references.rv()
 
 
 def parse_config_file(job, config_file, max_cores=None):
@@ -484,18 +515,47 @@ def launch_protect(job, patient_data, univ_options, tool_options):
             sample_prep.addChild(bam_files[sample_type])
 
     # define the haplotyping subgraph of the DAG
+    cache_entry = None
+    if 'hla_haplotype_files' not in patient_data and tool_options['phlat']['haplotype_cache']:
+        normal_fastqs = [patient_data.get('normal_dna_fastq_' + x) for x in ('1', '2')]
+        if all(x is not None and os.path.exists(x) for x in normal_fastqs):
+            cache_entry = haplotype_cache_entry(tool_options['phlat']['haplotype_cache'],
+                                                univ_options['patient'], normal_fastqs)
+        else:
+            job.fileStore.logToMaster('The haplotype cache can only be used with local normal DNA '
+                                      'fastqs. Haplotyping %s from scratch.'
+                                      % univ_options['patient'])
     if 'hla_haplotype_files' in patient_data:
         haplotype_patient = job.wrapJobFn(get_patient_mhc_haplotype, sample_prep.rv())
         sample_prep.addChild(haplotype_patient)
+    elif (cache_entry is not None and os.path.exists(cache_entry) and
+            not tool_options['phlat']['invalidate_haplotype_cache']):
+        # Germline HLA doesn't change between runs on the same normal sample
+        haplotype_patient = job.wrapJobFn(get_cached_haplotype, cache_entry, univ_options,
+                                          disk='100M', memory='100M', cores=1)
+        sample_prep.addChild(haplotype_patient)
     else:
         assert None not in fastq_files.values()
         # We are guaranteed to have fastqs here
         for sample_type in 'tumor_dna', 'normal_dna', 'tumor_rna':
+            phlat_fastqs = fastq_files[sample_type]
+            # Subsample deep samples, then only run PHLAT on the reads that look like they came
+            # from the HLA region
+            for option, read_selector in (('read_budget', subsample_phlat_reads),
+                                          ('hla_fasta', prefilter_hla_reads)):
+                if tool_options['phlat'][option] is None:
+                    continue
+                selected_fastqs = job.wrapJobFn(
+                    read_selector, phlat_fastqs.rv(), sample_type, univ_options,
+                    tool_options['phlat'], disk=PromisedRequirement(phlat_disk, phlat_fastqs.rv()))
+                phlat_fastqs.addChild(selected_fastqs)
+                selected_fastqs.addChild(fastq_deletion_1)
+                phlat_fastqs = selected_fastqs
             phlat_files[sample_type] = job.wrapJobFn(
-                run_phlat, fastq_files[sample_type].rv(), sample_type, univ_options,
+                run_phlat, phlat_fastqs.rv(), sample_type, univ_options,
                 tool_options['phlat'], cores=tool_options['phlat']['n'],
-                disk=PromisedRequirement(phlat_disk, fastq_files[sample_type].rv()))
-            fastq_files[sample_type].addChild(phlat_files[sample_type])
+                disk=PromisedRequirement(phlat_disk, phlat_fastqs.rv()))
+            phlat_fastqs.addChild(phlat_files[sample_type])
             phlat_files[sample_type].addChild(fastq_deletion_1)
         haplotype_patient = job.wrapJobFn(merge_phlat_calls,
                                           phlat_files['tumor_dna'].rv(),
@@ -505,6 +565,10 @@ def launch_protect(job, patient_data, univ_options, tool_options):
         phlat_files['tumor_dna'].addChild(haplotype_patient)
         phlat_files['normal_dna'].addChild(haplotype_patient)
         phlat_files['tumor_rna'].addChild(haplotype_patient)
+        if cache_entry is not None:
+            haplotype_patient.addChild(job.wrapJobFn(cache_haplotype, haplotype_patient.rv(),
+                                                     cache_entry, disk='100M', memory='100M',
+                                                     cores=1))
 
     # Define the RNA-Seq Alignment subgraph if needed
     if bam_files['tumor_rna'] is None:
@@ -559,26 +623,13 @@ def launch_protect(job, patient_data, univ_options, tool_options):
     if fusions:
         fusions.addChild(delete_bam_files['tumor_rna'])
     # Define the reporting leaves
+    reports = job.wrapJobFn(run_reports, rsem.rv(),
+                            phlat_files['tumor_rna'].rv() if phlat_files['tumor_rna'] is not None
+                            else None, univ_options, tool_options['reports'], disk='100M',
+                            memory='100M', cores=1)
+    rsem.addChild(reports)
     if phlat_files['tumor_rna'] is not None:
-        mhc_pathway_assessment = job.wrapJobFn(run_mhc_gene_assessment, rsem.rv(),
-                                               phlat_files['tumor_rna'].rv(), univ_options,
-                                               tool_options['reports'], disk='100M',
-                                               memory='100M', cores=1)
-        rsem.addChild(mhc_pathway_assessment)
-        phlat_files['tumor_rna'].addChild(mhc_pathway_assessment)
-    else:
-        mhc_pathway_assessment = job.wrapJobFn(run_mhc_gene_assessment, rsem.rv(), None,
-                                               univ_options, tool_options['reports'],
-                                               disk='100M', memory='100M', cores=1)
-        rsem.addChild(mhc_pathway_assessment)
-    itx_resistance_assessment = job.wrapJobFn(run_itx_resistance_assessment, rsem.rv(),
-                                              univ_options, tool_options['reports'],
-                                              disk='100M', memory='100M', cores=1)
-    rsem.addChild(itx_resistance_assessment)
-    car_t_validity_assessment = job.wrapJobFn(run_car_t_validity_assessment, rsem.rv(),
-                                              univ_options, tool_options['reports'],
-                                              disk='100M', memory='100M', cores=1)
-    rsem.addChild(car_t_validity_assessment)
+        phlat_files['tumor_rna'].addChild(reports)
     # Define the DNA-Seq alignment and mutation calling subgraphs if necessary
     if 'mutation_vcf' in patient_data:
         get_mutations = job.wrapJobFn(get_patient_vcf, sample_prep.rv())
@@ -602,37 +653,94 @@ def launch_protect(job, patient_data, univ_options, tool_options):
                                                           univ_options['patient'], disk='100M',
                                                           memory='100M')
             bam_files[sample_type].addChild(delete_bam_files[sample_type])
+        # If requested, restrict mutation calling to the padded coding exons.  The bed is passed to
+        # the callers that can use it directly, and all callers are handed bams sliced down to the
+        # target regions.
+        calling_bams = bam_files
+        if tool_options['target_regions']['run']:
+            target_regions = job.wrapJobFn(make_target_regions,
+                                           tool_options['transgene']['gencode_annotation_gtf'],
+                                           univ_options, tool_options['target_regions'],
+                                           disk=PromisedRequirement(
+                                               target_regions_disk,
+                                               tool_options['transgene']['gencode_annotation_gtf']),
+                                           memory='1G', cores=1)
+            job.addChild(target_regions)
+            for caller in 'mutect', 'muse':
+                tool_options[caller]['target_bed'] = target_regions.rv()
+            calling_bams = {}
+            for sample_type, bams, prefix, sample_info in (
+                    ('tumor_dna', bam_files['tumor_dna'].rv(), 'tumor_dna', 'fix_pg_sorted'),
+                    ('normal_dna', bam_files['normal_dna'].rv(), 'normal_dna', 'fix_pg_sorted'),
+                    ('tumor_rna', bam_files['tumor_rna'].rv('rna_genome'), 'rna', 'genome_sorted')):
+                calling_bams[sample_type] = job.wrapJobFn(slice_bamfile, bams, target_regions.rv(),
+                                                          prefix, univ_options,
+                                                          tool_options['bwa']['samtools'],
+                                                          sample_info=sample_info,
+                                                          disk=PromisedRequirement(slice_disk,
+                                                                                   bams))
+                bam_files[sample_type].addChild(calling_bams[sample_type])
+                target_regions.addChild(calling_bams[sample_type])
+        # Strelka and SomaticSniper can't be restricted to a region so they run on per-chromosome
+        # bams.  Split each DNA bam once and hand the same splits to both callers.
+        if tool_options['strelka']['chromosomes']:
+            chromosomes = tool_options['strelka']['chromosomes']
+        else:
+            chromosomes = sample_chromosomes(job, tool_options['strelka']['genome_fai'])
+        split_bams = {}
+        for sample_type in 'tumor_dna', 'normal_dna':
+            split_bams[sample_type] = job.wrapJobFn(split_bam_by_chromosome,
+                                                    calling_bams[sample_type].rv(), sample_type,
+                                                    chromosomes, univ_options,
+                                                    tool_options['strelka']['samtools'],
+                                                    sample_info='fix_pg_sorted', disk='100M',
+                                                    memory='100M')
+            calling_bams[sample_type].addChild(split_bams[sample_type])
         # Time to call mutations
         mutations = {
-            'radia': job.wrapJobFn(run_radia, bam_files['tumor_rna'].rv(),
-                                   bam_files['tumor_dna'].rv(), bam_files['normal_dna'].rv(),
+            'radia': job.wrapJobFn(run_radia, calling_bams['tumor_rna'].rv(),
+                                   calling_bams['tumor_dna'].rv(), calling_bams['normal_dna'].rv(),
                                    univ_options, tool_options['radia'],
                                    disk='100M').encapsulate(),
-            'mutect': job.wrapJobFn(run_mutect, bam_files['tumor_dna'].rv(),
-                                    bam_files['normal_dna'].rv(), univ_options,
+            'mutect': job.wrapJobFn(run_mutect, calling_bams['tumor_dna'].rv(),
+                                    calling_bams['normal_dna'].rv(), univ_options,
                                     tool_options['mutect'], disk='100M').encapsulate(),
-            'muse': job.wrapJobFn(run_muse, bam_files['tumor_dna'].rv(),
-                                  bam_files['normal_dna'].rv(), univ_options,
+            'muse': job.wrapJobFn(run_muse, calling_bams['tumor_dna'].rv(),
+                                  calling_bams['normal_dna'].rv(), univ_options,
                                   tool_options['muse']).encapsulate(),
-            'somaticsniper': job.wrapJobFn(run_somaticsniper, bam_files['tumor_dna'].rv(),
-                                           bam_files['normal_dna'].rv(), univ_options,
+            'somaticsniper': job.wrapJobFn(spawn_somaticsniper_perchrom,
+                                           split_bams['tumor_dna'].rv(),
+                                           split_bams['normal_dna'].rv(), univ_options,
                                            tool_options['somaticsniper']).encapsulate(),
-            'strelka': job.wrapJobFn(run_strelka, bam_files['tumor_dna'].rv(),
-                                     bam_files['normal_dna'].rv(), univ_options,
+            'strelka': job.wrapJobFn(spawn_strelka_perchrom, split_bams['tumor_dna'].rv(),
+                                     split_bams['normal_dna'].rv(), univ_options,
                                      tool_options['strelka']).encapsulate(),
-            'indels': job.wrapJobFn(run_indel_caller, bam_files['tumor_dna'].rv(),
-                                    bam_files['normal_dna'].rv(), univ_options, 'indel_options',
+            'indels': job.wrapJobFn(run_indel_caller, calling_bams['tumor_dna'].rv(),
+                                    calling_bams['normal_dna'].rv(), univ_options, 'indel_options',
                                     disk='100M', memory='100M', cores=1)}
         for sample_type in 'tumor_dna', 'normal_dna':
             for caller in mutations:
-                bam_files[sample_type].addChild(mutations[caller])
-        bam_files['tumor_rna'].addChild(mutations['radia'])
+                if caller in ('somaticsniper', 'strelka'):
+                    split_bams[sample_type].addChild(mutations[caller])
+                else:
+                    calling_bams[sample_type].addChild(mutations[caller])
+        calling_bams['tumor_rna'].addChild(mutations['radia'])
         get_mutations = job.wrapJobFn(run_mutation_aggregator,
                                       {caller: cjob.rv() for caller, cjob in mutations.items()},
                                       univ_options, disk='100M', memory='100M',
                                       cores=1).encapsulate()
         for caller in mutations:
             mutations[caller].addChild(get_mutations)
+        for sample_type in split_bams:
+            get_mutations.addChild(job.wrapJobFn(delete_split_bams, split_bams[sample_type].rv(),
+                                                 univ_options['patient'], disk='100M',
+                                                 memory='100M'))
+        if tool_options['target_regions']['run']:
+            # The sliced bams are only used for mutation calling
+            for sample_type in calling_bams:
+                delete_sliced = job.wrapJobFn(delete_bams, calling_bams[sample_type].rv(),
+                                              univ_options['patient'], disk='100M', memory='100M')
+                get_mutations.addChild(delete_sliced)
         # We don't need the normal dna bam any more
         get_mutations.addChild(delete_bam_files['normal_dna'])
         # We may need the tumor one depending on OxoG
@@ -640,23 +748,40 @@ def launch_protect(job, patient_data, univ_options, tool_options):
             get_mutations.addChild(delete_bam_files['tumor_dna'])
 
     # The rest of the subgraph should be unchanged
-    snpeff = job.wrapJobFn(run_snpeff, get_mutations.rv(), univ_options, tool_options['snpeff'],
-                           disk=PromisedRequirement(snpeff_disk,
-                                                    tool_options['snpeff']['index']))
+    snpeff = job.wrapJobFn(wrap_snpeff, get_mutations.rv(), univ_options, tool_options['snpeff'],
+                           disk='100M', memory='100M', cores=1).encapsulate()
     get_mutations.addChild(snpeff)
-    tumor_dna_bam = bam_files['tumor_dna'].rv() if patient_data['filter_for_OxoG'] else None
+    # Transgene only needs the reads around the variants so extract them into small bams instead of
+    # sending the full bams to transgene.
+    variant_regions = job.wrapJobFn(make_variant_regions, snpeff.rv(), univ_options,
+                                    tool_options['transgene'], disk='100M', memory='100M', cores=1)
+    snpeff.addChild(variant_regions)
+    variant_bams = {}
+    slice_inputs = [('tumor_rna', bam_files['tumor_rna'].rv('rna_genome'), 'rna', 'genome_sorted')]
+    if patient_data['filter_for_OxoG']:
+        slice_inputs.append(('tumor_dna', bam_files['tumor_dna'].rv(), 'tumor_dna',
+                             'fix_pg_sorted'))
+    for sample_type, bams, prefix, sample_info in slice_inputs:
+        variant_bams[sample_type] = job.wrapJobFn(slice_bamfile, bams, variant_regions.rv(),
+                                                  prefix, univ_options,
+                                                  tool_options['bwa']['samtools'],
+                                                  sample_info=sample_info,
+                                                  disk=PromisedRequirement(slice_disk, bams))
+        variant_regions.addChild(variant_bams[sample_type])
+        bam_files[sample_type].addChild(variant_bams[sample_type])
+        variant_bams[sample_type].addChild(delete_bam_files[sample_type])
+    transgene_rna_bam = {'rna_genome': variant_bams['tumor_rna'].rv()}
+    tumor_dna_bam = variant_bams['tumor_dna'].rv() if 'tumor_dna' in variant_bams else None
     fusion_calls = fusions.rv() if fusions else None
-    transgene = job.wrapJobFn(run_transgene, snpeff.rv(), bam_files['tumor_rna'].rv(), univ_options,
-                              tool_options['transgene'],
-                              disk=PromisedRequirement(transgene_disk, bam_files['tumor_rna'].rv()),
-                              memory='100M', cores=1, tumor_dna_bam=tumor_dna_bam,
-                              fusion_calls=fusion_calls)
+    transgene = job.wrapJobFn(wrap_transgene, snpeff.rv(), transgene_rna_bam, univ_options,
+                              tool_options['transgene'], disk='100M', memory='100M', cores=1,
+                              tumor_dna_bam=tumor_dna_bam,
+                              fusion_calls=fusion_calls).encapsulate()
     snpeff.addChild(transgene)
-    bam_files['tumor_rna'].addChild(transgene)
-    transgene.addChild(delete_bam_files['tumor_rna'])
-    if patient_data['filter_for_OxoG']:
-        bam_files['tumor_dna'].addChild(transgene)
-        transgene.addChild(delete_bam_files['tumor_dna'])
+    for sample_type in variant_bams:
+        variant_bams[sample_type].addChild(transgene)
+        transgene.addChild(job.wrapJobFn(delete_bams, variant_bams[sample_type].rv(),
+                                         univ_options['patient'], disk='100M', memory='100M'))
     if fusions:
         fusions.addChild(transgene)
 
@@ -701,8 +826,10 @@ def get_all_tool_inputs(job, tools, outer_key='', mutation_caller_list=None):
             else:
                 # If a file is of the type file, vcf, tar or fasta, it needs to be downloaded from
                 # S3 if reqd, then written to job store.
+                # Optional inputs that haven't been provided are left as is.
                 if option.split('_')[-1] in ['file', 'vcf', 'index', 'fasta', 'fai', 'idx', 'dict',
-                                             'tbi', 'beds', 'gtf', 'config']:
+                                             'tbi', 'beds', 'gtf', 'config'] and \
+                        tools[tool][option] is not None:
                     tools[tool][option] = job.addChildJobFn(
                         get_pipeline_inputs, ':'.join([outer_key, tool, option]).lstrip(':'),
                         tools[tool][option]).rv()
@@ -713,9 +840,13 @@ def get_all_tool_inputs(job, tools, outer_key='', mutation_caller_list=None):
         indexes = tools.pop('indexes')
         indexes['chromosomes'] = parse_chromosome_string(job, indexes['chromosomes'])
         for mutation_caller in mutation_caller_list:
-            if mutation_caller == 'indexes':
+            if mutation_caller in ('indexes', 'target_regions'):
                 continue
             tools[mutation_caller].update(indexes)
+        # Targeted calling isn't a caller and only needs the contigs to build its regions on
+        if 'target_regions' in tools:
+            tools['target_regions'].update({key: indexes[key]
+                                            for key in ('genome_fai', 'chromosomes')})
     return tools
 
 
@@ -889,6 +1020,73 @@ def generate_config_file():
                 os.path.join(os.getcwd(), 'ProTECT_config.yaml'))
 
 
+def rerank_run(patient_folder, ratio_file=None, out_folder=None, processes=None):
+    """
+    Re-rank the IARs of a finished ProTECT run with new rankboost ratios without starting Toil.
+    The ratio file is a yaml file with a prediction_ranking:rankboost style block of mhci_args and
+    mhcii_args, or a dict of <set name>: block to sweep several sets of ratios at once.  The
+    default ratios are used if no file is given.
+
+    :param str patient_folder: The output folder of the patient (<output_folder>/<patient>)
+    :param str ratio_file: Path to the yaml file of ratios
+    :param str out_folder: Where to write the reports.  See rerank_patient.
+    :param int processes: The number of sets of ratios to rank at once
+    :return: None
+    """
+    if ratio_file is None:
+        protect_defaults_file = pkg_resources.resource_filename(__name__, "defaults.yaml")
+        with open(protect_defaults_file) as pdf:
+            ratio_sets = {'default': yaml.load(pdf.read())['prediction_ranking']['rankboost']}
+    else:
+        with open(ratio_file) as rf:
+            ratio_sets = yaml.load(rf.read())
+        if 'mhci_args' in ratio_sets or 'mhcii_args' in ratio_sets:
+            ratio_sets = {os.path.splitext(os.path.basename(ratio_file))[0]: ratio_sets}
+    results = rerank_patient(os.path.abspath(patient_folder), ratio_sets, out_folder,
+                             processes or cpu_count())
+    for name in sorted(results):
+        for report in sorted(results[name].values()):
+            print(report)
+    return None
+
+
+def cohort_run(config_file, cohort_folder=None):
+    """
+    Add the patients in a ProTECT config whose runs have finished to the cohort expression matrix,
+    and write the cohort level reports for all patients in it without starting Toil.  Only runs
+    with a Local storage_location are supported.
+
+    :param str config_file: Path to the config file used for the runs
+    :param str cohort_folder: Where to keep the cohort.  Defaults to <output_folder>/cohort.
+    :return: None
+    """
+    with open(config_file) as conf:
+        input_config = yaml.load(conf.read())
+    univ_options = input_config['Universal_Options']
+    if univ_options['storage_location'] not in ('Local', 'local'):
+        raise ParameterError('Cohort reports can only be generated for runs with a Local '
+                             'storage_location.')
+    cohort_folder = os.path.abspath(cohort_folder or
+                                    os.path.join(univ_options['output_folder'], 'cohort'))
+    patients = find_patient_expression(
+        univ_options['output_folder'],
+        {str(patient): options.get('tumor_type')
+         for patient, options in input_config['patients'].items()})
+    added = update_cohort(cohort_folder, patients)
+    print('Added %s patient(s) to the cohort at %s' % (len(added), cohort_folder))
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        reports = write_cohort_reports(cohort_folder,
+                                       *read_report_inputs(input_config['reports'], work_dir),
+                                       out_folder=os.path.join(cohort_folder, 'reports'))
+    finally:
+        shutil.rmtree(work_dir)
+    for report in sorted(reports.values()):
+        print(report)
+    return None
+
+
 def main():
     """
     This is the main function for ProTECT.
@@ -903,6 +1101,24 @@ def main():
     inputs.add_argument('--generate_config', dest='generate_config', help='Generate a config file '
                         'in the current directory that is pre-filled with references and flags for '
                         'an hg19 run.', action='store_true', default=False)
+    inputs.add_argument('--rerank', dest='rerank', help='Re-rank the predictions in the output '
+                        'folder of a finished run for a patient (<output_folder>/<patient>) '
+                        'without running the pipeline.', type=str, default=None)
+    inputs.add_argument('--cohort', dest='cohort', help='Update the cohort expression matrix with '
+                        'the finished runs for the patients in the given config file and write the '
+                        'cohort reports without running the pipeline. The archives in the reports '
+                        'section of the config must be local paths. S3 and http URLs (as in the '
+                        'generated config) are not fetched.', type=str, default=None)
+    parser.add_argument('--ratios', dest='ratio_file', help='Used with --rerank. A yaml file with '
+                        'mhci_args and mhcii_args for rankboost, or a dict of named sets of them '
+                        'to rank in parallel.', type=str, required=False, default=None)
+    parser.add_argument('--rerank_output_folder', dest='rerank_output_folder', help='Used with '
+                        '--rerank. Where to write the reports. Defaults to '
+                        '<patient folder>/rankboost/reranked.', type=str, required=False,
+                        default=None)
+    parser.add_argument('--cohort_folder', dest='cohort_folder', help='Used with --cohort. Where '
+                        'to keep the cohort matrix and reports. Defaults to '
+                        '<output_folder>/cohort.', type=str, required=False, default=None)
     parser.add_argument('--max-cores-per-job', dest='max_cores', help='Maximum cores to use per '
                         'job. Aligners and Haplotypers ask for cores dependent on the machine that '
                         'the launchpad gets assigned to -- In a heterogeneous cluster, this can '
@@ -916,6 +1132,11 @@ def main():
     params, others = parser.parse_known_args()
     if params.generate_config:
         generate_config_file()
+    elif params.rerank:
+        rerank_run(params.rerank, params.ratio_file, params.rerank_output_folder,
+                   params.max_cores)
+    elif params.cohort:
+        cohort_run(os.path.abspath(params.cohort), params.cohort_folder)
     else:
         Job.Runner.addToilOptions(parser)
         params = parser.parse_args()
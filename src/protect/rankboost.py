@@ -12,9 +12,19 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from protect.common import docker_call, get_files_from_filestore, export_results
+from __future__ import absolute_import, print_function
+from protect.common import (docker_call,
+                            export_results,
+                            get_files_from_filestore,
+                            ParameterError,
+                            read_peptide_file)
+from protect.expression_profiling.rsem import load_isoform_expression
 
+import multiprocessing
+import numpy as np
 import os
+import pandas
+import re
 
 
 def wrap_rankboost(job, rsem_files, merged_mhc_calls, transgene_out, univ_options,
@@ -27,7 +37,9 @@ def wrap_rankboost(job, rsem_files, merged_mhc_calls, transgene_out, univ_option
     :param dict transgene_out: Dict of results from running Transgene
     :param dict univ_options: Dict of universal options used by almost all tools
     :param dict rankboost_options: Options specific to rankboost
-    :return: Dict of concise and detailed results for mhci and mhcii
+    :return: Dict of concise and detailed results for mhci and mhcii.  The names carry a
+             '_native' infix ('mhci_native_rankboost_concise_results.tsv', ...) if rankboost is run
+             natively.
              output_files:
                 |- 'mhcii_rankboost_concise_results.tsv': fsID
                 |- 'mhcii_rankboost_detailed_results.txt': fsID
@@ -35,8 +47,12 @@ def wrap_rankboost(job, rsem_files, merged_mhc_calls, transgene_out, univ_option
                 +- 'mhci_rankboost_detailed_results.txt': fsID
     :rtype: dict
     """
-    rankboost = job.addChildJobFn(boost_ranks, rsem_files['rsem.isoforms.results'],
-                                  merged_mhc_calls, transgene_out, univ_options, rankboost_options)
+    if rankboost_options.get('native') and 'rsem.expression.npz' in rsem_files:
+        isoform_expression = rsem_files['rsem.expression.npz']
+    else:
+        isoform_expression = rsem_files['rsem.isoforms.results']
+    rankboost = job.addChildJobFn(boost_ranks, isoform_expression, merged_mhc_calls, transgene_out,
+                                  univ_options, rankboost_options)
 
     return rankboost.rv()
 
@@ -44,19 +60,17 @@ def wrap_rankboost(job, rsem_files, merged_mhc_calls, transgene_out, univ_option
 def boost_ranks(job, isoform_expression, merged_mhc_calls, transgene_out, univ_options,
                 rankboost_options):
     """
-    Boost the ranks of the predicted peptides:MHC combinations.
+    Boost the ranks of the predicted peptides:MHC combinations.  If rankboost_options['native'] is
+    set, both rankings are computed in-process by run_native_rankboost instead of the rankboost
+    container, and the reports are named as in write_rankboost_results.
 
-    :param toil.fileStore.FileID isoform_expression: fsID of rsem isoform expression file
+    :param toil.fileStore.FileID isoform_expression: fsID of rsem isoform expression file, or of
+           the expression table from make_expression_table if rankboost is run natively
     :param dict merged_mhc_calls: Dict of results from merging mhc peptide binding predictions
     :param dict transgene_out: Dict of results from running Transgene
     :param dict univ_options: Dict of universal options used by almost all tools
     :param dict rankboost_options: Options specific to rankboost
-    :return: Dict of concise and detailed results for mhci and mhcii
-             output_files:
-                |- 'mhcii_rankboost_concise_results.tsv': fsID
-                |- 'mhcii_rankboost_detailed_results.txt': fsID
-                |- 'mhci_rankboost_concise_results.tsv': fsID
-                +- 'mhci_rankboost_detailed_results.txt': fsID
+    :return: Dict of concise and detailed results for mhci and mhcii.  See wrap_rankboost.
     :rtype: dict
     """
     job.fileStore.logToMaster('Running boost_ranks on %s' % univ_options['patient'])
@@ -67,21 +81,31 @@ def boost_ranks(job, isoform_expression, merged_mhc_calls, transgene_out, univ_o
         'mhcii_merged_files.tsv': merged_mhc_calls['mhcii_merged_files.list'],
         'mhci_peptides.faa': transgene_out['transgened_tumor_10_mer_snpeffed.faa'],
         'mhcii_peptides.faa': transgene_out['transgened_tumor_15_mer_snpeffed.faa']}
-    input_files = get_files_from_filestore(job, input_files, work_dir, docker=True)
+    if rankboost_options.get('native'):
+        input_files = get_files_from_filestore(job, input_files, work_dir)
+        run_native_rankboost(input_files['rsem_quant.tsv'],
+                             {mhc: input_files[mhc + '_merged_files.tsv']
+                              for mhc in ('mhci', 'mhcii')},
+                             {mhc: input_files[mhc + '_peptides.faa'] for mhc in ('mhci', 'mhcii')},
+                             rankboost_options, work_dir)
+    else:
+        input_files = get_files_from_filestore(job, input_files, work_dir, docker=True)
     output_files = {}
     for mhc in ('mhci', 'mhcii'):
-        import re
-        ratios = re.sub("'", '', repr(rankboost_options[''.join([mhc, '_args'])]))
-        parameters = ['--' + mhc,
-                      '--predictions', input_files[''.join([mhc, '_merged_files.tsv'])],
-                      '--expression', input_files['rsem_quant.tsv'],
-                      '--peptides', input_files[''.join([mhc, '_peptides.faa'])],
-                      '--ratios', ratios
-                      ]
-        docker_call(tool='rankboost', tool_parameters=parameters, work_dir=work_dir,
-                    dockerhub=univ_options['dockerhub'], tool_version=rankboost_options['version'])
-        mhc_concise = ''.join([work_dir, '/', mhc, '_rankboost_concise_results.tsv'])
-        mhc_detailed = ''.join([work_dir, '/', mhc, '_rankboost_detailed_results.txt'])
+        if not rankboost_options.get('native'):
+            ratios = re.sub("'", '', repr(rankboost_options[''.join([mhc, '_args'])]))
+            parameters = ['--' + mhc,
+                          '--predictions', input_files[''.join([mhc, '_merged_files.tsv'])],
+                          '--expression', input_files['rsem_quant.tsv'],
+                          '--peptides', input_files[''.join([mhc, '_peptides.faa'])],
+                          '--ratios', ratios
+                          ]
+            docker_call(tool='rankboost', tool_parameters=parameters, work_dir=work_dir,
+                        dockerhub=univ_options['dockerhub'],
+                        tool_version=rankboost_options['version'])
+        report = mhc + ('_native' if rankboost_options.get('native') else '') + '_rankboost'
+        mhc_concise = ''.join([work_dir, '/', report, '_concise_results.tsv'])
+        mhc_detailed = ''.join([work_dir, '/', report, '_detailed_results.txt'])
         output_files[mhc] = {}
         if os.path.exists(mhc_concise):
             output_files[os.path.basename(mhc_concise)] = job.fileStore.writeGlobalFile(mhc_concise)
@@ -97,3 +121,301 @@ def boost_ranks(job, isoform_expression, merged_mhc_calls, transgene_out, univ_o
         else:
             output_files[os.path.basename(mhc_detailed)] = None
     return output_files
+
+
+# The IAR features that can be weighted in mhci_args and mhcii_args
+RANKBOOST_FEATURES = ('npa', 'nph', 'nMHC', 'TPM', 'overlap', 'tndelta')
+MERGED_CALL_COLUMNS = ['allele', 'pept', 'normal_pept', 'pname', 'core', 'dummy', 'tumor_pred',
+                       'normal_pred', 'gene_id', 'transcript_id', 'gene_name', 'mutations']
+
+
+def run_native_rankboost(isoform_expression, merged_calls, peptide_files, rankboost_options,
+                         work_dir):
+    """
+    Rank the IARs in the merged MHCI and MHCII calls and write the concise and detailed reports
+    for each.  The expression is read once and shared between the two rankings.
+
+    :param str isoform_expression: Path to the expression table or the rsem isoform expression file
+    :param dict merged_calls: Dict of 'mhci' and 'mhcii' paths to the merged mhc peptide calls
+    :param dict peptide_files: Dict of 'mhci' and 'mhcii' paths to the tumor IARs the calls were
+           made on (10-mers for mhci and 15-mers for mhcii)
+    :param dict rankboost_options: Options specific to rankboost
+    :param str work_dir: The directory to write the reports into
+    :return: Dict of the paths to the reports that were written.  Nothing is written for an mhc
+             without any calls.
+    :rtype: dict
+    """
+    expression = read_isoform_expression(isoform_expression)
+    output_files = {}
+    for mhc in ('mhci', 'mhcii'):
+        calls = read_merged_calls(merged_calls[mhc])
+        if calls.empty:
+            continue
+        with read_peptide_file(peptide_files[mhc]) as peptides:
+            ranked = rank_iars(calls, peptides, expression, rankboost_options[mhc + '_args'])
+        output_files.update(write_rankboost_results(ranked, calls, mhc, work_dir))
+    return output_files
+
+
+def read_isoform_expression(isoform_expression):
+    """
+    Read the TPM of each transcript.  Transcript versions are dropped so the ids match those in the
+    peptide map.
+
+    :param str isoform_expression: Path to the expression table from make_expression_table, or to
+           the rsem isoform expression file
+    :return: TPM indexed by transcript id
+    :rtype: pandas.Series
+    """
+    return load_isoform_expression(isoform_expression)['TPM']
+
+
+def read_merged_calls(merged_calls):
+    """
+    Read a file of merged mhc peptide calls written by merge_mhc_peptide_calls.
+
+    :param str merged_calls: Path to the merged calls
+    :return: The calls with numeric predictions.  Fusions have a NaN normal prediction.
+    :rtype: pandas.DataFrame
+    """
+    if os.path.getsize(merged_calls) == 0:
+        return pandas.DataFrame(columns=MERGED_CALL_COLUMNS)
+    calls = pandas.read_table(merged_calls, header=None, names=MERGED_CALL_COLUMNS,
+                              dtype={'pname': str, 'mutations': str})
+    calls['tumor_pred'] = pandas.to_numeric(calls['tumor_pred'])
+    calls['normal_pred'] = pandas.to_numeric(calls['normal_pred'], errors='coerce')
+    calls['transcript_id'] = calls['transcript_id'].str.split('.').str[0]
+    return calls
+
+
+def _count_overlaps(starts, ends):
+    """
+    Count the pairs of peptide spans that overlap in an IAR.
+
+    :param numpy.ndarray starts: The start of each unique span, sorted
+    :param numpy.ndarray ends: The end (exclusive) of each span
+    :return: The number of overlapping pairs
+    :rtype: int
+    """
+    # Every span starting before the end of span i (and after it in the sorted order) overlaps it
+    following = np.searchsorted(starts, ends, side='left') - np.arange(1, len(starts) + 1)
+    return int(np.maximum(following, 0).sum())
+
+
+def rank_iars(calls, peptides, expression, ratios):
+    """
+    Rank the IARs in the calls.  See compute_iar_features and boost_iar_ranks.
+
+    :param pandas.DataFrame calls: The calls returned by read_merged_calls
+    :param IndexedFasta peptides: The tumor IARs the calls were made on
+    :param pandas.Series expression: The expression returned by read_isoform_expression
+    :param dict ratios: The weight of each feature
+    :return: The IARs with their features, score and rank, sorted by rank
+    :rtype: pandas.DataFrame
+    """
+    return boost_iar_ranks(compute_iar_features(calls, peptides, expression), ratios)
+
+
+def compute_iar_features(calls, peptides, expression):
+    """
+    Compute the features used to boost the rank of each IAR in the calls.
+
+        best_pred: The best (lowest) binding percentile of any call in the IAR
+        npa: The number of distinct peptides called in the IAR
+        nph: The number of distinct "good" (top 1%) peptides in the IAR
+        nMHC: The number of MHCs bound by the IAR
+        TPM: The expression of the transcript containing the IAR
+        overlap: The number of pairs of called peptides that overlap in the IAR
+        tndelta: The number of calls that bind at least 1.5% better than their normal counterpart,
+                 or have no normal counterpart
+
+    :param pandas.DataFrame calls: The calls returned by read_merged_calls
+    :param IndexedFasta peptides: The tumor IARs the calls were made on
+    :param pandas.Series expression: The expression returned by read_isoform_expression
+    :return: The features of each IAR
+    :rtype: pandas.DataFrame
+    """
+    grouped = calls.groupby('pname')
+    iars = grouped[['gene_id', 'transcript_id', 'gene_name', 'mutations']].first()
+    iars['best_pred'] = grouped['tumor_pred'].min()
+    iars['npa'] = grouped['pept'].nunique()
+    iars['nph'] = calls[calls['tumor_pred'] < 1.0].groupby('pname')['pept'].nunique()
+    iars['nMHC'] = grouped['allele'].nunique()
+    iars['TPM'] = expression.reindex(iars['transcript_id']).values
+    altered = calls['normal_pred'].isnull() | (calls['normal_pred'] - calls['tumor_pred'] > 1.5)
+    iars['tndelta'] = calls[altered].groupby('pname').size()
+    spans = calls[['pname', 'pept']].drop_duplicates()
+    spans['start'] = [peptides[pname].find(pept) for pname, pept in zip(spans['pname'],
+                                                                        spans['pept'])]
+    spans['end'] = spans['start'] + spans['pept'].str.len()
+    spans = spans.drop_duplicates(['pname', 'start', 'end']).sort_values(['pname', 'start'])
+    iars['overlap'] = spans.groupby('pname').apply(
+        lambda x: _count_overlaps(x['start'].values, x['end'].values))
+    iars[list(RANKBOOST_FEATURES)] = iars[list(RANKBOOST_FEATURES)].fillna(0)
+    return iars.reset_index()
+
+
+def boost_iar_ranks(features, ratios):
+    """
+    Rank IARs by their features.  Each IAR starts at the rank of its best binding percentile.  Each
+    feature then ranks the IARs from highest to lowest, and the IAR is moved towards its rank for
+    every feature by the weight given to the feature in `ratios`:
+
+        score = base_rank + sum(ratio[feature] * (feature_rank - base_rank))
+
+    :param pandas.DataFrame features: The features returned by compute_iar_features
+    :param dict ratios: The weight of each feature
+    :return: The IARs with their features, score and rank, sorted by rank
+    :rtype: pandas.DataFrame
+    """
+    unknown = set(ratios) - set(RANKBOOST_FEATURES)
+    if unknown:
+        raise ParameterError('Unknown rankboost features: %s. Allowed features are %s.' %
+                             (','.join(sorted(unknown)), ','.join(RANKBOOST_FEATURES)))
+    iars = features.copy()
+    base_rank = iars['best_pred'].rank(method='min')
+    iars['score'] = base_rank
+    for feature, ratio in ratios.items():
+        if ratio:
+            feature_rank = iars[feature].rank(method='min', ascending=False)
+            iars['score'] += float(ratio) * (feature_rank - base_rank)
+    iars['base_rank'] = base_rank
+    iars = iars.sort_values(['score', 'base_rank', 'pname'])
+    iars['rank'] = np.arange(1, len(iars) + 1)
+    return iars
+
+
+def write_rankboost_results(ranked, calls, mhc, work_dir):
+    """
+    Write the concise (one line per IAR) and detailed (every call in each IAR) rankboost reports.
+    The reports don't use the format of the rankboost container's reports so they are named
+    <mhc>_native_rankboost_*_results instead, keeping scripts that parse the container's reports
+    from reading them.  The concise report is a tsv with a header line and a column for each
+    feature.  In the detailed report the calls for each IAR follow a
+    '#rank<TAB>name<TAB>gene<TAB>...' line and a '# feature=value, ...' line.
+
+    :param pandas.DataFrame ranked: The ranked IARs returned by rank_iars
+    :param pandas.DataFrame calls: The calls returned by read_merged_calls
+    :param str mhc: 'mhci' or 'mhcii'
+    :param str work_dir: The directory to write the reports into
+    :return: Dict of report name: path
+    :rtype: dict
+    """
+    concise = os.path.join(work_dir, mhc + '_native_rankboost_concise_results.tsv')
+    detailed = os.path.join(work_dir, mhc + '_native_rankboost_detailed_results.txt')
+    columns = ['rank', 'pname', 'gene_name', 'gene_id', 'transcript_id', 'mutations', 'best_pred',
+               'score'] + list(RANKBOOST_FEATURES)
+    ranked.to_csv(concise, sep='\t', columns=columns, index=False, float_format='%.3f')
+    calls = calls.sort_values(['pname', 'tumor_pred'])
+    grouped = dict(list(calls.groupby('pname')))
+    with open(detailed, 'w') as outfile:
+        for iar in ranked.itertuples():
+            print('#%s\t%s\t%s\t%s\t%s\t%s' % (iar.rank, iar.pname, iar.gene_name, iar.gene_id,
+                                               iar.transcript_id, iar.mutations), file=outfile)
+            print('#', ', '.join('%s=%g' % (feature, getattr(iar, feature))
+                                 for feature in RANKBOOST_FEATURES + ('score',)), file=outfile)
+            grouped[iar.pname].to_csv(outfile, sep='\t', index=False, header=False, na_rep='NA',
+                                      columns=['allele', 'pept', 'normal_pept', 'core',
+                                               'tumor_pred', 'normal_pred'])
+    return {os.path.basename(concise): concise,
+            os.path.basename(detailed): detailed}
+
+
+def rerank_patient(patient_folder, ratio_sets, out_folder=None, processes=1):
+    """
+    Re-rank the IARs of a finished ProTECT run with new rankboost ratios, outside of Toil.  The
+    features of the IARs are computed from the exported merged binding predictions, rsem isoform
+    expression and transgened peptides and cached in `out_folder`, so only the boosting has to be
+    re-run for each new set of ratios.  The sets of ratios are ranked in parallel and the reports
+    for each are written to `out_folder`/<set name>.
+
+    :param str patient_folder: The output folder of the patient (<output_folder>/<patient>)
+    :param dict ratio_sets: Dict of <set name>: {'mhci_args': dict, 'mhcii_args': dict}.  A set
+           without the args for an mhc does not rank that mhc.
+    :param str out_folder: Where to write the features and reports.  Defaults to
+           `patient_folder`/rankboost/reranked
+    :param int processes: The number of sets of ratios to rank at once
+    :return: Dict of <set name>: dict of report name: path
+    :rtype: dict
+    """
+    if out_folder is None:
+        out_folder = os.path.join(patient_folder, 'rankboost', 'reranked')
+    inputs = {'expression': os.path.join(patient_folder, 'expression', 'rsem.isoforms.results')}
+    for mhc, peplen in (('mhci', '10'), ('mhcii', '15')):
+        inputs[mhc] = os.path.join(patient_folder, 'binding_predictions',
+                                   mhc + '_merged_files.list')
+        inputs[mhc + '_peptides'] = os.path.join(patient_folder, 'peptides',
+                                                 'transgened_tumor_%s_mer_snpeffed.faa' % peplen)
+    missing = [path for path in inputs.values() if not os.path.exists(path)]
+    if missing:
+        raise ParameterError('Cannot re-rank %s since these outputs are missing: %s' %
+                             (patient_folder, ', '.join(sorted(missing))))
+    if not os.path.exists(out_folder):
+        os.makedirs(out_folder)
+    expression = None
+    cached = {}
+    for mhc in ('mhci', 'mhcii'):
+        features_file = os.path.join(out_folder, mhc + '_rankboost_features.tsv')
+        newest_input = max(os.path.getmtime(inputs[x])
+                           for x in ('expression', mhc, mhc + '_peptides'))
+        if not os.path.exists(features_file) or os.path.getmtime(features_file) < newest_input:
+            calls = read_merged_calls(inputs[mhc])
+            if calls.empty:
+                continue
+            if expression is None:
+                expression = read_isoform_expression(inputs['expression'])
+            with read_peptide_file(inputs[mhc + '_peptides']) as peptides:
+                compute_iar_features(calls, peptides, expression).to_csv(features_file, sep='\t',
+                                                                         index=False)
+        cached[mhc] = (features_file, inputs[mhc])
+    tasks = [(name, ratio_sets[name], os.path.join(out_folder, name))
+             for name in sorted(ratio_sets)]
+    if processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(processes, len(tasks)), _init_rerank, (cached,))
+        try:
+            results = pool.map(_rerank_ratio_set, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_rerank(cached)
+        results = [_rerank_ratio_set(task) for task in tasks]
+    return dict(zip([name for name, _, _ in tasks], results))
+
+
+_RERANK_INPUTS = None
+
+
+def _init_rerank(cached):
+    """
+    Read the cached features and the merged calls used by _rerank_ratio_set in this process.
+
+    :param dict cached: Dict of mhc: (path to the features, path to the merged calls)
+    """
+    global _RERANK_INPUTS
+    _RERANK_INPUTS = {}
+    for mhc, (features_file, calls_file) in cached.items():
+        _RERANK_INPUTS[mhc] = (pandas.read_table(features_file, dtype={'pname': str,
+                                                                       'mutations': str}),
+                               read_merged_calls(calls_file))
+
+
+def _rerank_ratio_set(task):
+    """
+    Rank the IARs with one set of ratios and write the reports.
+
+    :param tuple task: The name of the set, the set of ratios and the folder to write to
+    :return: Dict of report name: path
+    :rtype: dict
+    """
+    name, ratios, out_folder = task
+    if not os.path.exists(out_folder):
+        os.makedirs(out_folder)
+    output_files = {}
+    for mhc, (features, calls) in _RERANK_INPUTS.items():
+        if ratios.get(mhc + '_args') is None:
+            continue
+        output_files.update(write_rankboost_results(boost_iar_ranks(features,
+                                                                    ratios[mhc + '_args']),
+                                                    calls, mhc, out_folder))
+    return output_files
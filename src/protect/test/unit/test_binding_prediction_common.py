@@ -0,0 +1,351 @@
+#!/usr/bin/env python2.7
+# Copyright 2016 Arjun Arkal Rao
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Author : Arjun Arkal Rao
+Affiliation : UCSC BME, UCSC Genomics Institute
+File : protect/test/test_binding_prediction_common.py
+"""
+from __future__ import print_function
+
+from protect.binding_prediction.common import (_prefilter_peptides,
+                                               build_peptide_table,
+                                               join_normal_predictions,
+                                               load_pssms,
+                                               merge_prediction_chunks,
+                                               mhcii_predictor_routes,
+                                               read_fastas,
+                                               read_peptide_table,
+                                               score_peptides,
+                                               write_mhc_peptides)
+from protect.binding_prediction.mhcii import _read_mhcii_predictor
+from protect.test import ProtectTest
+from toil.job import Job
+
+import json
+import numpy as np
+import os
+import pandas
+import StringIO
+
+
+def _export_files(job, fsids, out_dir):
+    """
+    Copy files from the jobstore to a local folder.
+
+    :param dict fsids: The fsID of each file, keyed by the name to save it under
+    :param str out_dir: The folder to save the files in
+    """
+    for name, fsid in fsids.items():
+        with job.fileStore.readGlobalFileStream(fsid) as in_file, \
+                open(os.path.join(out_dir, name), 'w') as out_file:
+            out_file.write(in_file.read())
+
+
+def _import_chunks(job, chunks):
+    """
+    Write the predictions for each chunk to the jobstore.
+
+    :param list chunks: The path to the predictions for each chunk, or tuples of the path and the
+           predictor used
+    :return: The chunk predictions in the form returned by the prediction functions
+    :rtype: list
+    """
+    return [job.fileStore.writeGlobalFile(chunk) if isinstance(chunk, str) else
+            (job.fileStore.writeGlobalFile(chunk[0]), chunk[1]) for chunk in chunks]
+
+
+def _merge_chunks(job, chunk_predictions, out_dir):
+    """
+    Run merge_prediction_chunks and save the merged predictions and the predictor to a local
+    folder.
+    """
+    merged = merge_prediction_chunks(job, chunk_predictions)
+    predictor = None
+    if isinstance(merged, tuple):
+        merged, predictor = merged
+    _export_files(job, {'predictions.tsv': merged}, out_dir)
+    with open(os.path.join(out_dir, 'predictor.json'), 'w') as predictor_file:
+        json.dump(predictor, predictor_file)
+
+
+def _run_prefilter(job, peptides, pssms, mhc_options, univ_options, out_dir):
+    """
+    Run _prefilter_peptides and save the peptide file, the audit file and the filter statistics
+    to a local folder.
+    """
+    peptide_file, stats = _prefilter_peptides(job, peptides, 'HLA-A*01:01', '9', pssms,
+                                              mhc_options, univ_options)
+    _export_files(job, {'prefiltered.faa': peptide_file, 'audit': stats['audit']}, out_dir)
+    with open(os.path.join(out_dir, 'stats.json'), 'w') as stats_file:
+        json.dump({key: value for key, value in stats.items() if key != 'audit'}, stats_file)
+
+
+class TestBindingPredictionCommon(ProtectTest):
+    def setUp(self):
+        super(TestBindingPredictionCommon, self).setUp()
+        self.test_dir = self._createTempDir()
+        self.options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+        self.options.logLevel = 'INFO'
+        self.options.workDir = self.test_dir
+        self.options.clean = 'always'
+
+    def _write_pssms(self, matrices):
+        pssm_file = os.path.join(self.test_dir, 'pssms.json')
+        with open(pssm_file, 'w') as out_file:
+            json.dump(matrices, out_file)
+        return load_pssms(pssm_file)
+
+    @staticmethod
+    def _read(path):
+        with open(path) as in_file:
+            return in_file.read().split()
+
+    def test_score_peptides(self):
+        """
+        Test that score_peptides sums the matrix over the peptide, ignores residues outside the
+        alphabet and gives a peptide the best score of its cores when the matrix is shorter.
+        """
+        pssms = self._write_pssms({'alphabet': 'ACD',
+                                   'HLA-A*01:01': {'3': [[1, 2, 3], [10, 20, 30], [100, 200, 300]],
+                                                   '5': [[1, 2, 3], [10, 20, 30]]}})
+        self.assertEqual(pssms['alphabet'], 'ACD')
+        matrices = pssms['matrices']['HLA-A*01:01']
+        self.assertEqual(score_peptides(['ACD', 'DCA', 'AXA', 'XXX'], matrices['3'],
+                                        'ACD').tolist(),
+                         [321.0, 123.0, 101.0, 0.0])
+        # The best 2-mer core, wherever it is in the peptide
+        self.assertEqual(score_peptides(['AAAAA', 'ADAAA', 'AAAXD'], matrices['5'],
+                                        'ACD').tolist(),
+                         [11.0, 31.0, 30.0])
+        self.assertRaises(AssertionError, self._write_pssms,
+                          {'alphabet': 'ACD', 'HLA-A*01:01': {'3': [[1, 2], [1, 2], [1, 2]]}})
+
+    def test_prefilter_peptides(self):
+        """
+        Test that _prefilter_peptides forwards the best scoring fraction of the peptides along with
+        a reproducible audit sample of the rest.
+        """
+        # Peptide i scores i, so the best scoring peptides are the last ones
+        peptides = ['A' * (8 - i // 8) + 'C' * (i // 8) + 'ACDEFGHI'[i % 8] for i in range(40)]
+        matrix = np.zeros((9, 20))
+        matrix[:8, 1] = 8
+        matrix[8, :8] = range(8)
+        pssms = {'alphabet': 'ACDEFGHIKLMNPQRSTVWY',
+                 'matrices': {'HLA-A*01:01': {'9': np.hstack([matrix, np.zeros((9, 1))])}}}
+        self.assertEqual(score_peptides(peptides, pssms['matrices']['HLA-A*01:01']['9'],
+                                        pssms['alphabet']).tolist(), range(40))
+        mhc_options = {'pssm_fraction': 0.25, 'pssm_audit_fraction': 0.1}
+        univ_options = self._getTestUnivOptions()
+        runs = []
+        for run in range(2):
+            out_dir = self._createTempDir('run%s' % run)
+            self.options.jobStore = self._getTestJobStorePath()
+            Job.Runner.startToil(Job.wrapJobFn(_run_prefilter, peptides, pssms, mhc_options,
+                                               univ_options, out_dir), self.options)
+            with open(os.path.join(out_dir, 'stats.json')) as stats_file:
+                stats = json.load(stats_file)
+            runs.append((self._read(os.path.join(out_dir, 'prefiltered.faa')),
+                         self._read(os.path.join(out_dir, 'audit')), stats))
+        fasta, audit, stats = runs[0]
+        # The best 10 peptides and 3 of the other 30, named by their index in the input
+        self.assertEqual(stats, {'peptides': 40, 'forwarded': 13, 'audit_fraction': 0.1})
+        self.assertEqual(len(audit), 3)
+        self.assertEqual(len(set(audit)), 3)
+        self.assertTrue(all(peptides.index(x) < 30 for x in audit))
+        forwarded = sorted(range(30, 40) + [peptides.index(x) for x in audit])
+        self.assertEqual(fasta, [x for i in forwarded for x in ('>%s' % i, peptides[i])])
+        self.assertEqual(runs[1], runs[0])
+
+        out_dir = self._createTempDir('empty')
+        self.options.jobStore = self._getTestJobStorePath()
+        Job.Runner.startToil(Job.wrapJobFn(_run_prefilter, [], pssms, mhc_options, univ_options,
+                                           out_dir), self.options)
+        self.assertEqual(self._read(os.path.join(out_dir, 'prefiltered.faa')), [])
+        self.assertEqual(self._read(os.path.join(out_dir, 'audit')), [])
+        with open(os.path.join(out_dir, 'stats.json')) as stats_file:
+            self.assertEqual(json.load(stats_file), {'peptides': 0, 'forwarded': 0,
+                                                     'audit_fraction': 0.0})
+
+    def test_mhcii_predictor_routes(self):
+        """
+        Test that mhcii_predictor_routes follows the IEDB_recommended fallback order through the
+        per-method allele lists, and leaves alleles it can't be sure of to be detected.
+        """
+        restrictions = {'IEDB_recommended': ['HLA-DRB1*01:01', 'HLA-DRB1*03:01', 'HLA-DRB1*04:01',
+                                             'HLA-DRB1*05:01'],
+                        'consensus3': ['HLA-DRB1*01:01'],
+                        'Sturniolo': ['HLA-DRB1*01:01', 'HLA-DRB1*03:01']}
+        options = {'pred': 'IEDB_recommended'}
+        self.assertEqual(mhcii_predictor_routes(restrictions, options),
+                         {'HLA-DRB1*01:01': 'Consensus',
+                          'HLA-DRB1*03:01': 'Sturniolo'})
+        self.assertEqual(mhcii_predictor_routes(restrictions, options,
+                                                netmhciipan_alleles={'HLA-DRB1*04:01'}),
+                         {'HLA-DRB1*01:01': 'Consensus',
+                          'HLA-DRB1*03:01': 'Sturniolo',
+                          'HLA-DRB1*04:01': 'netMHCIIpan'})
+        # Without the consensus list nothing can be decided
+        del restrictions['consensus3']
+        self.assertEqual(mhcii_predictor_routes(restrictions, options,
+                                                netmhciipan_alleles={'HLA-DRB1*04:01'}), {})
+        restrictions['consensus'] = ['HLA-DRB1*01:01']
+        self.assertEqual(mhcii_predictor_routes(restrictions, options),
+                         {'HLA-DRB1*01:01': 'Consensus',
+                          'HLA-DRB1*03:01': 'Sturniolo'})
+        # Only IEDB_recommended falls back through the predictors
+        restrictions['consensus3'] = restrictions['consensus']
+        self.assertEqual(mhcii_predictor_routes(restrictions, {'pred': 'consensus3'}), {})
+
+    def test_read_mhcii_predictor(self):
+        """
+        Test that the predictor IEDB used is read from the method column of the predictions.
+        """
+        header = '\t'.join(['allele', 'seq_num', 'start', 'end', 'length', 'method', 'peptide'])
+        for method, predictor in (('Consensus (comb.lib./smm/nn)', 'Consensus'),
+                                  ('Sturniolo', 'Sturniolo'),
+                                  ('NetMHCIIpan', 'netMHCIIpan')):
+            predfile = os.path.join(self.test_dir, 'predictions.tsv')
+            with open(predfile, 'w') as out_file:
+                print(header, file=out_file)
+                print('\t'.join(['HLA-DRB1*01:01', '1', '1', '15', '15', method,
+                                 'AAAAAAAAAAAAAAA']), file=out_file)
+            self.assertEqual(_read_mhcii_predictor(predfile), predictor)
+        # No predictions
+        with open(predfile, 'w') as out_file:
+            print(header, file=out_file)
+        self.assertEqual(_read_mhcii_predictor(predfile), 'netMHCIIpan')
+
+    def _merge_chunks(self, chunks):
+        """
+        Merge the predictions for each chunk with merge_prediction_chunks.
+
+        :param list chunks: The lines in the predictions for each chunk, or tuples of the lines and
+               the predictor used
+        :return: The merged lines and the predictor
+        :rtype: tuple(list, str)
+        """
+        out_dir = self._createTempDir('merged')
+        paths = []
+        for i, chunk in enumerate(chunks):
+            lines, predictor = chunk if isinstance(chunk, tuple) else (chunk, None)
+            path = os.path.join(out_dir, 'chunk_%s.tsv' % i)
+            with open(path, 'w') as out_file:
+                out_file.writelines(line + '\n' for line in lines)
+            paths.append(path if predictor is None else (path, predictor))
+        self.options.jobStore = self._getTestJobStorePath()
+        a = Job.wrapJobFn(_import_chunks, paths)
+        b = Job.wrapJobFn(_merge_chunks, a.rv(), out_dir)
+        a.addChild(b)
+        Job.Runner.startToil(a, self.options)
+        with open(os.path.join(out_dir, 'predictions.tsv')) as in_file, \
+                open(os.path.join(out_dir, 'predictor.json')) as predictor_file:
+            return in_file.read().splitlines(), json.load(predictor_file)
+
+    def test_merge_prediction_chunks(self):
+        """
+        Test that merge_prediction_chunks concatenates the chunks, skips chunks without predictions
+        and keeps a single netMHCIIpan header.
+        """
+        # mhci returns bare fsIDs
+        self.assertEqual(self._merge_chunks([['allele\tpeptide', 'HLA-A*01:01\tAAA'],
+                                             ['allele\tpeptide', 'HLA-A*01:01\tCCC']]),
+                         (['allele\tpeptide', 'HLA-A*01:01\tAAA',
+                           'allele\tpeptide', 'HLA-A*01:01\tCCC'], None))
+        self.assertEqual(self._merge_chunks([(['allele\tpeptide', 'HLA-DRB1*01:01\tAAA'],
+                                              'Sturniolo'),
+                                             ([], 'None'),
+                                             (['allele\tpeptide', 'HLA-DRB1*01:01\tCCC'],
+                                              'Sturniolo')]),
+                         (['allele\tpeptide', 'HLA-DRB1*01:01\tAAA',
+                           'allele\tpeptide', 'HLA-DRB1*01:01\tCCC'], 'Sturniolo'))
+        self.assertEqual(self._merge_chunks([([], 'None'),
+                                             (['\tDRB1_0101', 'Pos\tPeptide', '0\tAAA'],
+                                              'netMHCIIpan'),
+                                             (['\tDRB1_0101', 'Pos\tPeptide', '0\tCCC'],
+                                              'netMHCIIpan')]),
+                         (['\tDRB1_0101', 'Pos\tPeptide', '0\tAAA', '0\tCCC'], 'netMHCIIpan'))
+        self.assertEqual(self._merge_chunks([([], 'None'), ([], 'None')]), ([], 'None'))
+
+    def test_build_peptide_table(self):
+        """
+        Test that build_peptide_table lists every unique tumor peptide once with its normal
+        counterpart and all the IARs holding it, and that the IAR names are used to name the
+        predictions in write_mhc_peptides.
+        """
+        input_files = {}
+        for name, records in (('T_3_mer.faa', [('IAR1', 'AAACCCD'), ('IAR2', 'CCCDE'),
+                                               ('IAR3', 'AAACC')]),
+                              ('N_3_mer.faa', [('IAR1', 'AAAGGGD'), ('IAR3', 'AAATT')])):
+            input_files[name] = os.path.join(self.test_dir, name)
+            with open(input_files[name], 'w') as out_file:
+                for iar, seq in records:
+                    print('>%s\n%s' % (iar, seq), file=out_file)
+        iars = read_fastas(input_files)
+        with iars['tumor'], iars['normal']:
+            peptides, unique_file, table_file = build_peptide_table(iars, '3', self.test_dir)
+        self.assertEqual(peptides, ['AAA', 'AAC', 'ACC', 'CCC', 'CCD', 'CDE'])
+        self.assertEqual(self._read(unique_file), ['>0', 'AAA', '>1', 'AAC', '>2', 'ACC',
+                                                   '>3', 'CCC', '>4', 'CCD', '>5', 'CDE'])
+        # IAR2 is a fusion, so CDE has no normal counterpart
+        table = {'AAA': ('AAA', ['IAR1', 'IAR3']),
+                 'AAC': ('AAG', ['IAR1', 'IAR3']),
+                 'ACC': ('AGG', ['IAR1', 'IAR3']),
+                 'CCC': ('GGG', ['IAR1', 'IAR2']),
+                 'CCD': ('GGD', ['IAR1', 'IAR2']),
+                 'CDE': ('NNN', ['IAR2'])}
+        self.assertEqual(read_peptide_table(table_file), table)
+
+        merged_df = pandas.DataFrame({'allele': ['HLA-A*01:01'] * 2,
+                                      'pept': ['CCC', 'CDE'],
+                                      'normal_pept': ['GGG', 'NA'],
+                                      'core': ['CCC', 'CDE'],
+                                      'tumor_pred': [0.5, 1.5],
+                                      'normal_pred': [20.0, 'NA'],
+                                      'iars': [','.join(table[x][1]) for x in ('CCC', 'CDE')]})
+        outfile = StringIO.StringIO()
+        write_mhc_peptides(merged_df, {'IAR1': 'ENST1:A1B', 'IAR2': 'ENST2:C2D'}, outfile,
+                           buffer_lines=1)
+        self.assertEqual(outfile.getvalue().splitlines(), [
+            'HLA-A*01:01\tCCC\tGGG\tIAR1\tCCC\t0\t0.5\t20.0\tENST1:A1B',
+            'HLA-A*01:01\tCCC\tGGG\tIAR2\tCCC\t0\t0.5\t20.0\tENST2:C2D',
+            'HLA-A*01:01\tCDE\tNA\tIAR2\tCDE\t0\t1.5\tNA\tENST2:C2D'])
+        # IARs missing from the map
+        self.assertRaises(RuntimeError, write_mhc_peptides, merged_df, {'IAR1': 'ENST1:A1B'},
+                          StringIO.StringIO())
+
+    def test_join_normal_predictions(self):
+        """
+        Test that join_normal_predictions adds the prediction for the normal counterpart of each
+        tumor peptide, and marks fusion peptides with NA.
+        """
+        tumor_df = pandas.DataFrame({'allele': ['HLA-A*01:01'] * 4,
+                                     'pept': ['AAC', 'CCC', 'CCD', 'CDE'],
+                                     'normal_pept': ['AAG', 'GGG', 'AAG', 'NNN'],
+                                     'tumor_pred': [0.1, 0.2, 0.3, 0.4],
+                                     'core': ['AAC', 'CCC', 'CCD', 'CDE']},
+                                    columns=['allele', 'pept', 'normal_pept', 'tumor_pred', 'core'])
+        # The normal predictions are named by peptide, and may be repeated
+        normal_df = pandas.DataFrame({'allele': ['HLA-A*01:01'] * 3,
+                                      'pept': ['GGG', 'AAG', 'GGG'],
+                                      'tumor_pred': [20.0, 30.0, 20.0],
+                                      'core': ['GGG', 'AAG', 'GGG']},
+                                     columns=['allele', 'pept', 'tumor_pred', 'core'])
+        merged = join_normal_predictions(tumor_df, normal_df)
+        self.assertEqual(list(merged.columns), ['allele', 'pept', 'normal_pept', 'tumor_pred',
+                                                'core', 'normal_pred'])
+        self.assertEqual(list(merged['pept']), ['AAC', 'CCC', 'CCD', 'CDE'])
+        self.assertEqual(list(merged['normal_pept']), ['AAG', 'GGG', 'AAG', 'NA'])
+        self.assertEqual(list(merged['normal_pred']), [30.0, 20.0, 30.0, 'NA'])
@@ -0,0 +1,122 @@
+#!/usr/bin/env python2.7
+# Copyright 2016 Arjun Arkal Rao
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Author : Arjun Arkal Rao
+Affiliation : UCSC BME, UCSC Genomics Institute
+File : protect/test/test_cohort.py
+"""
+from __future__ import print_function
+
+from protect.addons.cohort import (cohort_expression,
+                                   find_patient_expression,
+                                   read_cohort,
+                                   update_cohort)
+from protect.test import ProtectTest
+
+import numpy as np
+import os
+
+
+class TestCohort(ProtectTest):
+    def setUp(self):
+        super(TestCohort, self).setUp()
+        self.test_dir = self._createTempDir()
+        self.cohort_folder = os.path.join(self.test_dir, 'cohort')
+
+    def _write_expression(self, patient, tpms):
+        """
+        Write the rsem gene results for a patient into its ProTECT output folder.
+
+        :param str patient: The patient
+        :param dict tpms: The TPM of each gene
+        :return: Path to the rsem gene results
+        :rtype: str
+        """
+        expression_dir = os.path.join(self.test_dir, 'output', patient, 'expression')
+        os.makedirs(expression_dir)
+        expression_file = os.path.join(expression_dir, 'rsem.genes.results')
+        with open(expression_file, 'w') as out_file:
+            print('gene_id', 'transcript_id(s)', 'length', 'effective_length', 'expected_count',
+                  'TPM', 'FPKM', sep='\t', file=out_file)
+            for gene in sorted(tpms):
+                print(gene + '.1', 'ENST1', '100', '90', '10.00', tpms[gene], '1.00', sep='\t',
+                      file=out_file)
+        return expression_file
+
+    def _assert_tpms(self, genes, patients, expected):
+        tpm, tumor_types = cohort_expression(self.cohort_folder, genes)
+        self.assertEqual(list(tpm.columns), [x for x, _ in patients])
+        self.assertEqual(list(tumor_types.index), [x for x, _ in patients])
+        self.assertEqual(list(tumor_types), [x for _, x in patients])
+        np.testing.assert_array_equal(tpm.values, np.array(expected, dtype=float))
+
+    def test_update_cohort(self):
+        """
+        Test that update_cohort only appends the new patients to the matrix, fixes the genes with
+        the first patient added, and recovers from an interrupted update.  Test that
+        cohort_expression reads any requested genes back.
+        """
+        # An empty cohort
+        self.assertEqual(update_cohort(self.cohort_folder, {}), [])
+        self.assertFalse(os.path.exists(self.cohort_folder))
+        tpm, tumor_types = cohort_expression(self.cohort_folder, ['ENSG1'])
+        self.assertEqual(tpm.shape, (1, 0))
+        self.assertTrue(tumor_types.empty)
+
+        patients = {
+            'P1': (self._write_expression('P1', {'ENSG1': 1.0, 'ENSG2': 2.0, 'ENSG3': 3.0}),
+                   'STAD'),
+            # ENSG2 is missing and ENSG4 isn't a cohort gene
+            'P2': (self._write_expression('P2', {'ENSG1': 4.0, 'ENSG3': 6.0, 'ENSG4': 7.0}),
+                   'BRCA')}
+        self.assertEqual(update_cohort(self.cohort_folder, patients), ['P1', 'P2'])
+        genes, cohort, matrix = read_cohort(self.cohort_folder)
+        self.assertEqual(list(genes), ['ENSG1', 'ENSG2', 'ENSG3'])
+        self.assertEqual(cohort, [('P1', 'STAD'), ('P2', 'BRCA')])
+        self.assertEqual(matrix.shape, (2, 3))
+        # Only the requested genes, in the requested order, once each
+        self._assert_tpms(['ENSG3', 'ENSG1', 'ENSG4', 'ENSG3'], cohort,
+                          [[3.0, 6.0], [1.0, 4.0], [np.nan, np.nan]])
+        self._assert_tpms(['ENSG2'], cohort, [[2.0, np.nan]])
+
+        # Patients already in the cohort are skipped
+        patients['P3'] = self._write_expression('P3', {'ENSG1': 8.0, 'ENSG2': 9.0}), 'STAD'
+        self.assertEqual(update_cohort(self.cohort_folder, patients), ['P3'])
+        self.assertEqual(update_cohort(self.cohort_folder, patients), [])
+
+        # A partial row left by an interrupted update is dropped
+        with open(os.path.join(self.cohort_folder, 'tpm.matrix'), 'ab') as m_f:
+            m_f.write('\xff' * 12)
+        patients = {'P4': (self._write_expression('P4', {'ENSG1': 10.0, 'ENSG2': 11.0,
+                                                         'ENSG3': 12.0}), 'LUAD')}
+        self.assertEqual(update_cohort(self.cohort_folder, patients), ['P4'])
+        self.assertEqual(os.path.getsize(os.path.join(self.cohort_folder, 'tpm.matrix')),
+                         4 * 3 * 8)
+        self._assert_tpms(['ENSG1', 'ENSG2', 'ENSG3'],
+                          [('P1', 'STAD'), ('P2', 'BRCA'), ('P3', 'STAD'), ('P4', 'LUAD')],
+                          [[1.0, 4.0, 8.0, 10.0],
+                           [2.0, np.nan, 9.0, 11.0],
+                           [3.0, 6.0, np.nan, 12.0]])
+
+    def test_find_patient_expression(self):
+        """
+        Test that find_patient_expression skips patients without results or a tumor type.
+        """
+        expression_file = self._write_expression('P1', {'ENSG1': 1.0})
+        self._write_expression('P2', {'ENSG1': 1.0})
+        self.assertEqual(find_patient_expression(os.path.join(self.test_dir, 'output'),
+                                                 {'P1': 'STAD', 'P2': None, 'P3': 'STAD'}),
+                         {'P1': (expression_file, 'STAD')})
@@ -0,0 +1,111 @@
+#!/usr/bin/env python2.7
+# Copyright 2016 Arjun Arkal Rao
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Author : Arjun Arkal Rao
+Affiliation : UCSC BME, UCSC Genomics Institute
+File : protect/test/test_common.py
+"""
+from __future__ import print_function
+
+import os
+
+from protect.common import (IndexedFasta,
+                            merge_sharded_vcfs,
+                            split_vcf_into_shards)
+from protect.test import ProtectTest
+
+
+class TestCommon(ProtectTest):
+    def setUp(self):
+        super(TestCommon, self).setUp()
+        self.test_dir = self._createTempDir()
+
+    def test_split_and_merge_sharded_vcfs(self):
+        """
+        Test that split_vcf_into_shards balances whole chromosomes across the shards, and that
+        merge_sharded_vcfs puts them back together in chromosome order.
+        """
+        header = ['##fileformat=VCFv4.1\n',
+                  '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n']
+        counts = {'chr1': 5, 'chr2': 4, 'chr10': 3, 'chrX': 2, 'chrM': 1}
+        records = ['\t'.join([chrom, str(pos), '.', 'A', 'T', '.', 'PASS', '.']) + '\n'
+                   for chrom in ('chr1', 'chr2', 'chr10', 'chrX', 'chrM')
+                   for pos in range(1, counts[chrom] + 1)]
+        vcf = os.path.join(self.test_dir, 'mutations.vcf')
+        with open(vcf, 'w') as out_file:
+            out_file.writelines(header + records)
+        shard_dir = self._createTempDir('shards')
+        shards = split_vcf_into_shards(vcf, 2, shard_dir)
+        self.assertEqual(shards, [os.path.join(shard_dir, 'mutations_shard0.vcf'),
+                                  os.path.join(shard_dir, 'mutations_shard1.vcf')])
+        shard_chroms = []
+        for shard in shards:
+            with open(shard) as in_file:
+                lines = in_file.readlines()
+            self.assertEqual(lines[:2], header)
+            shard_chroms.append([x.split('\t')[0] for x in lines[2:]])
+        # Largest first onto the smallest shard: chr1, chr2, chr10 (onto chr2), chrX (onto chr1),
+        # chrM (onto either, ties go to the first)
+        self.assertEqual(shard_chroms, [['chr1'] * 5 + ['chrX'] * 2 + ['chrM'],
+                                        ['chr2'] * 4 + ['chr10'] * 3])
+        # More shards than chromosomes
+        self.assertEqual(len(split_vcf_into_shards(vcf, 10, self._createTempDir('more'))), 5)
+
+        merged = merge_sharded_vcfs(shards, os.path.join(self.test_dir, 'merged.vcf'))
+        with open(merged) as in_file:
+            self.assertEqual(in_file.readlines(), header + records)
+
+        # A vcf without records has no shards
+        empty = os.path.join(self.test_dir, 'empty.vcf')
+        with open(empty, 'w') as out_file:
+            out_file.writelines(header)
+        self.assertEqual(split_vcf_into_shards(empty, 2, self._createTempDir('empty')), [])
+
+    def _write_fasta(self, name, records, width=None):
+        fasta = os.path.join(self.test_dir, name)
+        with open(fasta, 'w') as out_file:
+            for header, seq in records:
+                print('>' + header, file=out_file)
+                for start in range(0, len(seq), width or len(seq)):
+                    print(seq[start:start + (width or len(seq))], file=out_file)
+        return fasta
+
+    def test_indexed_fasta(self):
+        """
+        Test record lookups on single-line and wrapped fastas.
+        """
+        records = [('IAR_KLM', 'MKLMNPQ'),
+                   ('IAR_2 description', 'PQRSTKLM'),
+                   ('IAR_3', 'AAAAKLMKLM'),
+                   ('IAR_4', 'QRST')]
+        for width in None, 3:
+            with IndexedFasta(self._write_fasta('peptides_%s.faa' % width, records,
+                                                width)) as fasta:
+                self.assertEqual(fasta.keys(), [x for x, _ in records])
+                self.assertEqual(len(fasta), 4)
+                self.assertTrue('IAR_3' in fasta)
+                self.assertFalse('IAR_5' in fasta)
+                self.assertEqual(fasta.items(), records)
+                self.assertEqual(fasta['IAR_3'], 'AAAAKLMKLM')
+                self.assertRaises(KeyError, fasta.__getitem__, 'IAR_5')
+                # Reuse the index
+                with IndexedFasta(fasta.fasta_file, index=fasta.index) as copy:
+                    self.assertEqual(copy.items(), records)
+            self.assertTrue(fasta._handle.closed)
+
+        with IndexedFasta(self._write_fasta('empty.faa', [])) as fasta:
+            self.assertEqual(len(fasta), 0)
+            self.assertFalse(fasta)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python2.7
+# Copyright 2016 Arjun Arkal Rao
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Author : Arjun Arkal Rao
+Affiliation : UCSC BME, UCSC Genomics Institute
+File : protect/test/test_mutation_calling_common.py
+"""
+from __future__ import print_function
+
+import os
+
+from protect.mutation_calling.common import batch_chromosomes, gtf_to_target_bed
+from protect.mutation_calling.mutect import split_mutect_vcf
+from protect.test import ProtectTest
+
+
+class TestMutationCallingCommon(ProtectTest):
+    def setUp(self):
+        super(TestMutationCallingCommon, self).setUp()
+        self.test_dir = self._createTempDir()
+
+    def _write(self, name, lines):
+        path = os.path.join(self.test_dir, name)
+        with open(path, 'w') as out_file:
+            for line in lines:
+                print(line, file=out_file)
+        return path
+
+    @staticmethod
+    def _read(path):
+        with open(path) as in_file:
+            return [line.rstrip('\n') for line in in_file]
+
+    def test_gtf_to_target_bed(self):
+        """
+        Test that gtf_to_target_bed pads, clips and merges the CDS records, reconciles contig names
+        and drops everything else.
+        """
+        gtf = self._write('annotation.gtf', [
+            '##description: test',
+            '\t'.join(['chr1', 'HAVANA', 'CDS', '101', '200', '.', '+', '0', 'gene_id "A";']),
+            # Overlaps the first record once padded
+            '\t'.join(['chr1', 'HAVANA', 'CDS', '250', '300', '.', '+', '0', 'gene_id "A";']),
+            '\t'.join(['chr1', 'HAVANA', 'CDS', '901', '990', '.', '+', '0', 'gene_id "B";']),
+            '\t'.join(['chr1', 'HAVANA', 'exon', '1', '5000', '.', '+', '.', 'gene_id "A";']),
+            # Named without the chr prefix, and clipped at the start of the contig
+            '\t'.join(['2', 'HAVANA', 'CDS', '10', '60', '.', '-', '0', 'gene_id "C";']),
+            '\t'.join(['MT', 'HAVANA', 'CDS', '100', '120', '.', '+', '0', 'gene_id "D";']),
+            # Not a requested contig
+            '\t'.join(['chr3', 'HAVANA', 'CDS', '10', '60', '.', '+', '0', 'gene_id "E";'])])
+        bed = gtf_to_target_bed(gtf, os.path.join(self.test_dir, 'targets.bed'),
+                                {'chr1': 1000, 'chr2': 5000, 'chrM': 130}, padding=50)
+        self.assertEqual(self._read(bed), ['chr1\t50\t350',
+                                           'chr1\t850\t1000',
+                                           'chr2\t0\t110',
+                                           'chrM\t49\t130'])
+
+    def test_batch_chromosomes(self):
+        """
+        Test that batch_chromosomes keeps the input order, fills batches up to the batch size and
+        gives long chromosomes a batch of their own.
+        """
+        lengths = {'chr1': 250, 'chr2': 60, 'chr3': 50, 'chr4': 40, 'chr5': 300, 'chrM': 1}
+        self.assertEqual(batch_chromosomes(['chr1', 'chr2', 'chr3', 'chr4', 'chr5', 'chrM'],
+                                           lengths, 100),
+                         [['chr1'], ['chr2'], ['chr3', 'chr4'], ['chr5'], ['chrM']])
+        self.assertEqual(batch_chromosomes(['chr2', 'chr3', 'chrM', 'chrUn'], lengths, 200),
+                         [['chr2', 'chr3', 'chrM', 'chrUn']])
+        self.assertEqual(batch_chromosomes([], lengths, 100), [])
+
+    def test_split_mutect_vcf(self):
+        """
+        Test that split_mutect_vcf writes one vcf per requested chromosome, each with the full
+        header.
+        """
+        header = ['##fileformat=VCFv4.1',
+                  '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO']
+        records = ['chr1\t10\t.\tA\tT\t.\tPASS\t.',
+                   'chr2\t20\t.\tC\tG\t.\tREJECT\t.',
+                   'chr1\t30\t.\tG\tA\t.\tPASS\t.']
+        vcf = self._write('mutect.vcf', header + records)
+        out_dir = self._createTempDir('split')
+        vcfs = split_mutect_vcf(vcf, ['chr1', 'chr2', 'chr3'], out_dir)
+        self.assertEqual(sorted(vcfs), ['chr1', 'chr2', 'chr3'])
+        self.assertEqual(self._read(vcfs['chr1']), header + [records[0], records[2]])
+        self.assertEqual(self._read(vcfs['chr2']), header + [records[1]])
+        self.assertEqual(self._read(vcfs['chr3']), header)
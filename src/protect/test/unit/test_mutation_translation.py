@@ -0,0 +1,163 @@
+#!/usr/bin/env python2.7
+# Copyright 2016 Arjun Arkal Rao
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Author : Arjun Arkal Rao
+Affiliation : UCSC BME, UCSC Genomics Institute
+File : protect/test/test_mutation_translation.py
+"""
+from __future__ import print_function
+
+from protect.mutation_translation import (_init_peptide_store,
+                                          _translate_transcript,
+                                          merge_transgene_shards)
+from protect.test import ProtectTest
+from toil.job import Job
+
+import json
+import os
+import protect.mutation_translation
+
+
+def _import_shards(job, shards):
+    """
+    Write the transgene outputs for each shard to the jobstore.
+
+    :return: The fsIDs of the outputs of each shard
+    :rtype: list
+    """
+    return [{name: job.fileStore.writeGlobalFile(path) for name, path in shard.items()}
+            for shard in shards]
+
+
+class TestMutationTranslation(ProtectTest):
+    def setUp(self):
+        super(TestMutationTranslation, self).setUp()
+        self.test_dir = self._createTempDir()
+        self.options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+        self.options.logLevel = 'INFO'
+        self.options.workDir = self.test_dir
+        self.options.clean = 'always'
+
+    def _write_shard(self, shard, peptides, records):
+        """
+        Write the transgene outputs for a shard to a local folder.
+
+        :param int shard: The shard number
+        :param dict peptides: The tumor peptide, normal peptide and mutation of each IAR name
+        :param list records: The records in the transgened vcf
+        :return: The path to each output file
+        :rtype: dict
+        """
+        shard_dir = os.path.join(self.test_dir, 'shard%s' % shard)
+        os.mkdir(shard_dir)
+        outputs = {'mutations.vcf': os.path.join(shard_dir, 'mutations.vcf')}
+        with open(outputs['mutations.vcf'], 'w') as vcf:
+            print('##fileformat=VCFv4.1\n##shard=%s' % shard, file=vcf)
+            for record in records:
+                print(record, file=vcf)
+        for peplen in '9', '10', '15':
+            for sample in 'tumor', 'normal':
+                name = 'transgened_%s_%s_mer_snpeffed.faa' % (sample, peplen)
+                outputs[name] = os.path.join(shard_dir, name)
+                with open(outputs[name], 'w') as fasta:
+                    for iar in sorted(peptides):
+                        print('>%s\n%s' % (iar, peptides[iar][sample == 'normal']), file=fasta)
+            name = 'transgened_tumor_%s_mer_snpeffed.faa.map' % peplen
+            outputs[name] = os.path.join(shard_dir, name)
+            with open(outputs[name], 'w') as map_file:
+                json.dump({iar: peptides[iar][2] for iar in peptides}, map_file)
+        return outputs
+
+    def test_merge_transgene_shards(self):
+        """
+        Test that merge_transgene_shards renames IARs seen in an earlier shard consistently in the
+        fastas and .map files, and merges the vcfs in chromosome order.
+        """
+        univ_options = self._getTestUnivOptions()
+        shards = [
+            self._write_shard(0, {'ENSG1_A1B': ('AAAA', 'AAAB', 'ENST1:A1B'),
+                                  'ENSG2_C2D': ('CCCC', 'CCCD', 'ENST2:C2D')},
+                              ['chr2\t10\t.\tA\tT\t.\tPASS\t.']),
+            self._write_shard(1, {'ENSG1_A1B': ('EEEE', 'EEEF', 'ENST3:A1B'),
+                                  'ENSG4_G4H': ('GGGG', 'GGGH', 'ENST4:G4H')},
+                              ['chr1\t20\t.\tC\tG\t.\tPASS\t.',
+                               'chrX\t30\t.\tG\tA\t.\tPASS\t.'])]
+        a = Job.wrapJobFn(_import_shards, shards)
+        b = Job.wrapJobFn(merge_transgene_shards, a.rv(), univ_options)
+        a.addChild(b)
+        Job.Runner.startToil(a, self.options)
+
+        out_dir = os.path.join(univ_options['output_folder'], univ_options['patient'])
+        for peplen in '9', '10', '15':
+            for sample, index in ('tumor', 0), ('normal', 1):
+                with open(os.path.join(out_dir, 'peptides', 'transgened_%s_%s_mer_snpeffed.faa' %
+                                       (sample, peplen))) as fasta:
+                    self.assertEqual(fasta.read().split(), [
+                        '>ENSG1_A1B', ('AAAA', 'AAAB')[index],
+                        '>ENSG2_C2D', ('CCCC', 'CCCD')[index],
+                        '>ENSG1_A1B_1', ('EEEE', 'EEEF')[index],
+                        '>ENSG4_G4H', ('GGGG', 'GGGH')[index]])
+            with open(os.path.join(out_dir, 'peptides',
+                                   'transgened_tumor_%s_mer_snpeffed.faa.map' % peplen)) as m_f:
+                self.assertEqual(json.load(m_f), {'ENSG1_A1B': 'ENST1:A1B',
+                                                  'ENSG2_C2D': 'ENST2:C2D',
+                                                  'ENSG1_A1B_1': 'ENST3:A1B',
+                                                  'ENSG4_G4H': 'ENST4:G4H'})
+        with open(os.path.join(out_dir, 'mutations', 'transgened', 'mutations.vcf')) as vcf:
+            self.assertEqual(vcf.read().splitlines(), ['##fileformat=VCFv4.1',
+                                                       '##shard=0',
+                                                       'chr1\t20\t.\tC\tG\t.\tPASS\t.',
+                                                       'chr2\t10\t.\tA\tT\t.\tPASS\t.',
+                                                       'chrX\t30\t.\tG\tA\t.\tPASS\t.'])
+
+    def test_translate_transcript(self):
+        """
+        Test that _translate_transcript drops substitutions that don't match the reference protein,
+        groups the ones that can share an n-mer into one IAR for every n-mer length, and clips IARs
+        at the protein ends.
+        """
+        transcript = 'ENSP1|ENST1|ENSG1|OTTHUMG1|OTTHUMT1|GENE-001|GENE|30'
+        normal = 'MKTAYIAKQRQISFVKSHFSRQLEERLGLI'
+        tumor = 'MKTAWIAEHRQISFVKSHFSRQLEECLGLI'
+        fasta = os.path.join(self.test_dir, 'peptides.fa')
+        with open(fasta, 'w') as out_file:
+            print('>ENSP0|ENST0|ENSG0|OTTHUMG0|OTTHUMT0|OTHER-001|OTHER|5\nMAAAA', file=out_file)
+            print('>%s\n%s\n%s' % (transcript, normal[:20], normal[20:]), file=out_file)
+        _init_peptide_store(fasta, None)
+        with protect.mutation_translation._PEPTIDES:
+            iars, used = _translate_transcript(
+                (transcript, [(4, 'Y', 'W'), (7, 'KQ', 'EH'), (10, 'A', 'V'), (25, 'R', 'C')],
+                 [9, 15], 10))
+        # Q11 isn't an A in this protein
+        self.assertEqual(used, [(4, 'Y', 'W'), (7, 'KQ', 'EH'), (25, 'R', 'C')])
+        self.assertEqual(iars[9], [
+            ('ENSG1_ENST1_Y5W+KQ8EH', tumor[:17], normal[:17], 'ENSG1\tENST1\tGENE\tY5W,KQ8EH'),
+            ('ENSG1_ENST1_R26C', tumor[17:], normal[17:], 'ENSG1\tENST1\tGENE\tR26C')])
+        self.assertEqual(iars[15], [
+            ('ENSG1_ENST1_Y5W+KQ8EH', tumor[:23], normal[:23], 'ENSG1\tENST1\tGENE\tY5W,KQ8EH'),
+            ('ENSG1_ENST1_R26C', tumor[11:], normal[11:], 'ENSG1\tENST1\tGENE\tR26C')])
+
+        # Substitutions 9 residues apart share a 10-mer but not a 9-mer.  They are still one IAR
+        # for every n-mer length, so the MHCI calls of both lengths are named the same.
+        _init_peptide_store(fasta, None)
+        with protect.mutation_translation._PEPTIDES:
+            iars, used = _translate_transcript((transcript, [(10, 'Q', 'W'), (19, 'S', 'L')],
+                                                [9, 10, 15], 10))
+        tumor = normal[:10] + 'W' + normal[11:19] + 'L' + normal[20:]
+        for peplen, start, end in (9, 2, 28), (10, 1, 29), (15, 0, 30):
+            self.assertEqual(iars[peplen], [('ENSG1_ENST1_Q11W+S20L', tumor[start:end],
+                                             normal[start:end],
+                                             'ENSG1\tENST1\tGENE\tQ11W,S20L')])
@@ -0,0 +1,240 @@
+#!/usr/bin/env python2.7
+# Copyright 2016 Arjun Arkal Rao
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Author : Arjun Arkal Rao
+Affiliation : UCSC BME, UCSC Genomics Institute
+File : protect/test/test_phlat.py
+"""
+from __future__ import print_function
+
+from protect.haplotyping.phlat import (_canonical_kmers,
+                                       _has_kmer_hit,
+                                       cache_haplotype,
+                                       estimate_read_pairs,
+                                       haplotype_cache_entry,
+                                       subsample_read_pairs)
+from protect.test import ProtectTest
+from toil.job import Job
+
+import gzip
+import numpy as np
+import os
+import random
+import string
+
+
+def _encode(kmer):
+    """
+    2-bit encode a k-mer the slow way.
+
+    :return: The encoded k-mer
+    :rtype: int
+    """
+    return int(''.join(str('ACGT'.index(x)) for x in kmer.upper()), 4)
+
+
+def _reverse_complement(kmer):
+    return kmer.upper()[::-1].translate(string.maketrans('ACGT', 'TGCA'))
+
+
+def _cache_allele_files(job, allele_files, cache_entry):
+    """
+    Write the allele files to the jobstore and cache them.
+
+    :return: None
+    """
+    haplotype_files = {name: job.fileStore.writeGlobalFile(path)
+                       for name, path in allele_files.items()}
+    job.addChildJobFn(cache_haplotype, haplotype_files, cache_entry)
+    return None
+
+
+class TestPhlat(ProtectTest):
+    def setUp(self):
+        super(TestPhlat, self).setUp()
+        self.test_dir = self._createTempDir()
+        self.options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+        self.options.logLevel = 'INFO'
+        self.options.workDir = self.test_dir
+        self.options.clean = 'always'
+
+    def _write_fastqs(self, name, num_pairs, gz=False):
+        """
+        Write a pair of fastqs of random reads with varying lengths.
+
+        :param str name: The prefix for the fastqs
+        :param int num_pairs: The number of read pairs
+        :param bool gz: Whether to gzip the fastqs
+        :return: Paths to the forward and reverse fastqs
+        :rtype: list
+        """
+        random.seed(num_pairs)
+        sequences = [''.join(random.choice('ACGT') for _ in range(random.randint(50, 150)))
+                     for _ in range(100)]
+        fastqs = []
+        for read in '1', '2':
+            fastq = os.path.join(self.test_dir, '%s_%s.fastq%s' % (name, read, '.gz' if gz else ''))
+            with (gzip.open if gz else open)(fastq, 'wb') as out_file:
+                for i in range(num_pairs):
+                    sequence = random.choice(sequences)
+                    print('@read%s/%s\n%s\n+\n%s' % (i, read, sequence, 'I' * len(sequence)),
+                          file=out_file)
+            fastqs.append(fastq)
+        return fastqs
+
+    def _read_names(self, fastq):
+        with (gzip.open if fastq.endswith('.gz') else open)(fastq) as in_file:
+            return [x.strip()[1:-2] for x in in_file.readlines()[::4]]
+
+    def test_canonical_kmers(self):
+        """
+        Test that _canonical_kmers gives the smaller of each k-mer and its reverse complement, and
+        flags the k-mers spanning a non-ACGT base.
+        """
+        sequence = 'ACGTTGCAaccgNGGATCCTAG'
+        for k in 1, 3, 5, 12:
+            kmers, valid = _canonical_kmers(sequence, k)
+            self.assertEqual(len(kmers), len(sequence) - k + 1)
+            for i, (kmer, is_valid) in enumerate(zip(kmers, valid)):
+                window = sequence[i:i + k]
+                self.assertEqual(is_valid, 'N' not in window)
+                if is_valid:
+                    self.assertEqual(int(kmer), min(_encode(window),
+                                                    _encode(_reverse_complement(window))))
+        # A k-mer and its reverse complement are the same canonical k-mer
+        self.assertEqual(list(_canonical_kmers('AACGG', 5)[0]),
+                         list(_canonical_kmers('CCGTT', 5)[0]))
+        # 32-mers use all 64 bits
+        kmers, valid = _canonical_kmers('T' * 33, 32)
+        self.assertTrue(valid.all())
+        self.assertEqual(list(kmers), [0, 0])
+        kmers, valid = _canonical_kmers('G' * 32, 32)
+        self.assertEqual(int(kmers[0]), _encode('C' * 32))
+        # Sequences shorter than k have no k-mers
+        kmers, valid = _canonical_kmers('ACG', 5)
+        self.assertEqual((len(kmers), len(valid)), (0, 0))
+
+    def test_has_kmer_hit(self):
+        """
+        Test that _has_kmer_hit finds reads with a k-mer on either strand, and not k-mers made up
+        by joining reads or spanning a non-ACGT base.
+        """
+        hla = 'GATTACAGGC'
+        kmers, valid = _canonical_kmers(hla, 5)
+        kmers = np.unique(kmers[valid])
+        reads = ['TTTTTGATTTTTTTT\n',  # No hit
+                 'CCCCTTACAGCCCC\n',  # TTACA
+                 'GCCTG\n',  # Reverse complement of CAGGC
+                 'TTANCAGG\n',  # Only the k-mers spanning the N would hit
+                 'TTTGAT\n',  # GATTA across this read and the next
+                 'TACCCC\n',
+                 'ACAGG\n',  # The last read
+                 ]
+        self.assertEqual(list(_has_kmer_hit(reads, kmers, 5)),
+                         [False, True, True, False, False, False, True])
+        self.assertEqual(list(_has_kmer_hit(['GATTA'], kmers, 5)), [True])
+        self.assertEqual(list(_has_kmer_hit(['GATT'], kmers, 5)), [False])
+        # Reads past the last HLA k-mer in sort order
+        self.assertEqual(list(_has_kmer_hit(['TGTTT', 'GGGGG'], kmers, 5)), [False, False])
+
+    def test_estimate_read_pairs(self):
+        """
+        Test that estimate_read_pairs counts the reads in small fastqs, and estimates them in large
+        plain and gzipped fastqs.
+        """
+        for gz in False, True:
+            fastq = self._write_fastqs('small', 500, gz)[0]
+            self.assertEqual(estimate_read_pairs(fastq), 500)
+            self.assertEqual(estimate_read_pairs(fastq, sample_size=500), 500)
+            self.assertEqual(estimate_read_pairs(self._write_fastqs('empty', 0, gz)[0]), 0)
+            fastq = self._write_fastqs('large', 50000, gz)[0]
+            self.assertAlmostEqual(estimate_read_pairs(fastq), 50000, delta=2500)
+
+    def test_subsample_read_pairs(self):
+        """
+        Test that subsample_read_pairs keeps about the requested fraction of read pairs, keeps them
+        paired and in order, and always gives the same subsample for a seed.
+        """
+        for gz in False, True:
+            fastqs = self._write_fastqs('input', 5000, gz)
+            names = self._read_names(fastqs[0])
+            outputs = [os.path.join(self.test_dir, x + '.fastq') for x in ('out_1', 'out_2')]
+            kept, total = subsample_read_pairs(fastqs[0], fastqs[1], 0.2, 1, outputs)
+            self.assertEqual(total, 5000)
+            self.assertAlmostEqual(kept, 1000, delta=150)
+            subsample = self._read_names(outputs[0])
+            self.assertEqual(len(subsample), kept)
+            self.assertEqual(self._read_names(outputs[1]), subsample)
+            self.assertEqual(sorted(subsample, key=names.index), subsample)
+            # The batch size doesn't change the subsample, the seed does
+            self.assertEqual(subsample_read_pairs(fastqs[0], fastqs[1], 0.2, 1, outputs,
+                                                  batch_size=7), (kept, total))
+            self.assertEqual(self._read_names(outputs[0]), subsample)
+            subsample_read_pairs(fastqs[0], fastqs[1], 0.2, 2, outputs)
+            self.assertNotEqual(self._read_names(outputs[0]), subsample)
+            # Keep everything, or nothing
+            self.assertEqual(subsample_read_pairs(fastqs[0], fastqs[1], 1.0, 1, outputs),
+                             (5000, 5000))
+            self.assertEqual(self._read_names(outputs[1]), names)
+            self.assertEqual(subsample_read_pairs(fastqs[0], fastqs[1], 0.0, 1, outputs),
+                             (0, 5000))
+            self.assertEqual(os.path.getsize(outputs[0]), 0)
+
+        # Fastqs with different numbers of reads aren't paired
+        fastqs = [self._write_fastqs('short', 10)[0], self._write_fastqs('long', 11)[1]]
+        self.assertRaises(RuntimeError, subsample_read_pairs, fastqs[0], fastqs[1], 0.5, 1,
+                          outputs)
+
+    def test_haplotype_cache_entry(self):
+        """
+        Test that haplotype cache entries are keyed on the patient and the normal fastq files, not
+        the path used to reach them.
+        """
+        cache = os.path.join(self.test_dir, 'cache')
+        fastqs = self._write_fastqs('normal', 10)
+        entry = haplotype_cache_entry(cache, 'TEST', fastqs)
+        self.assertEqual(os.path.dirname(entry), os.path.join(cache, 'TEST'))
+        relative = [os.path.relpath(x) for x in fastqs]
+        self.assertEqual(haplotype_cache_entry(os.path.relpath(cache), 'TEST', relative), entry)
+        self.assertEqual(os.path.dirname(haplotype_cache_entry(cache, 'TEST2', fastqs)),
+                         os.path.join(cache, 'TEST2'))
+        self.assertNotEqual(haplotype_cache_entry(cache, 'TEST', fastqs[::-1]), entry)
+        # A new normal sample in the same place
+        stat = os.stat(fastqs[0])
+        os.utime(fastqs[0], (stat.st_atime, stat.st_mtime + 10))
+        self.assertNotEqual(haplotype_cache_entry(cache, 'TEST', fastqs), entry)
+
+    def test_cache_haplotype(self):
+        """
+        Test that cache_haplotype fills a new entry, replaces an existing one, and leaves nothing
+        else behind in the cache.
+        """
+        cache_entry = os.path.join(self.test_dir, 'cache', 'TEST', 'entry')
+        for alleles in ('HLA-A*01:01', 'HLA-DRB1*01:01'), ('HLA-A*02:01', 'HLA-DRB1*03:01'):
+            allele_files = {}
+            for allele_file, allele in zip(['mhci_alleles.list', 'mhcii_alleles.list'], alleles):
+                allele_files[allele_file] = os.path.join(self.test_dir, allele_file)
+                with open(allele_files[allele_file], 'w') as out_file:
+                    print(allele, file=out_file)
+            self.options.jobStore = self._getTestJobStorePath()
+            Job.Runner.startToil(Job.wrapJobFn(_cache_allele_files, allele_files, cache_entry),
+                                 self.options)
+            self.assertEqual(os.listdir(os.path.dirname(cache_entry)), ['entry'])
+            self.assertEqual(sorted(os.listdir(cache_entry)), ['mhci_alleles.list',
+                                                               'mhcii_alleles.list'])
+            for allele_file, allele in zip(['mhci_alleles.list', 'mhcii_alleles.list'], alleles):
+                with open(os.path.join(cache_entry, allele_file)) as in_file:
+                    self.assertEqual(in_file.read().strip(), allele)
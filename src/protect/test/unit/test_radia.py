@@ -0,0 +1,83 @@
+#!/usr/bin/env python2.7
+# Copyright 2016 Arjun Arkal Rao
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Author : Arjun Arkal Rao
+Affiliation : UCSC BME, UCSC Genomics Institute
+File : protect/test/test_radia.py
+"""
+from __future__ import print_function
+
+from protect.mutation_calling.radia import select_radia_alleles
+from protect.test import ProtectTest
+
+
+def _sample(gt, ad, af, bq, sb):
+    """
+    Build a RADIA sample field (GT:DP:INDEL:START:STOP:AD:AF:BQ:SB).  DP is the sum of AD.
+    """
+    return ':'.join([gt, str(sum(ad)), '0', '0', '0',
+                     ','.join(str(x) for x in ad), ','.join(af), ','.join(bq), ','.join(sb)])
+
+
+def _record(alt, normal, tumor, rna='.'):
+    return ['chr1', '100', '.', 'A', alt, '20', 'PASS', 'SS=2', 'GT:DP:INDEL:START:STOP:AD:AF:BQ:SB',
+            normal, tumor, rna]
+
+
+class TestRadia(ProtectTest):
+    def test_select_radia_alleles(self):
+        """
+        Test that select_radia_alleles keeps the ALT alleles supported in the tumor DNA or RNA but
+        not the normal, reduces the per-allele fields to them, and recomputes DP and GT.
+        """
+        bq = ['30', '31', '32', '33']
+        sb = ['0.5', '0.6', '0.7', '0.8']
+        records = [
+            # C is supported in the tumor DNA and T in the RNA
+            _record('C,G,T',
+                    _sample('0/0', [20, 0, 0, 0], ['1.0', '0.0', '0.0', '0.0'], bq, sb),
+                    _sample('0/1', [10, 8, 1, 0], ['0.53', '0.42', '0.05', '0.0'], bq, sb),
+                    _sample('0/3', [5, 0, 0, 6], ['0.45', '0.0', '0.0', '0.55'], bq, sb)),
+            # No ALT has enough reads in the tumor, and there is no RNA
+            _record('C,G,T',
+                    _sample('0/0', [20, 0, 0, 0], ['1.0', '0.0', '0.0', '0.0'], bq, sb),
+                    _sample('0/1', [10, 3, 2, 1], ['0.63', '0.19', '0.12', '0.06'], bq, sb)),
+            # G is supported in the tumor but is also seen in the normal
+            _record('C,G,T',
+                    _sample('0/2', [16, 0, 4, 0], ['0.8', '0.0', '0.2', '0.0'], bq, sb),
+                    _sample('0/2', [10, 0, 10, 0], ['0.5', '0.0', '0.5', '0.0'], bq, sb)),
+            # G and T are both supported in the tumor, with G only at the AF threshold
+            _record('C,G,T',
+                    _sample('0/0', [20, 0, 0, 0], ['1.0', '0.0', '0.0', '0.0'], bq, sb),
+                    _sample('1/2', [0, 0, 4, 36], ['0.0', '0.0', '0.1', '0.9'], bq, sb))]
+        out_lines = select_radia_alleles(records)
+        self.assertEqual(len(out_lines), 4)
+        self.assertIsNone(out_lines[1])
+        self.assertIsNone(out_lines[2])
+        self.assertEqual(out_lines[0].split('\t'), _record(
+            'C,T',
+            _sample('0/0', [20, 0, 0], ['1.0', '0.0', '0.0'], ['30', '31', '33'],
+                    ['0.5', '0.6', '0.8']),
+            _sample('0/1', [10, 8, 0], ['0.53', '0.42', '0.0'], ['30', '31', '33'],
+                    ['0.5', '0.6', '0.8']),
+            _sample('0/2', [5, 0, 6], ['0.45', '0.0', '0.55'], ['30', '31', '33'],
+                    ['0.5', '0.6', '0.8'])))
+        self.assertEqual(out_lines[3].split('\t'), _record(
+            'G,T',
+            _sample('0/0', [20, 0, 0], ['1.0', '0.0', '0.0'], ['30', '32', '33'],
+                    ['0.5', '0.7', '0.8']),
+            _sample('1/2', [0, 4, 36], ['0.0', '0.1', '0.9'], ['30', '32', '33'],
+                    ['0.5', '0.7', '0.8'])))
@@ -20,22 +20,30 @@ File : protect/test/test_rankboost.py
 """
 from __future__ import print_function
 
+from protect.common import ParameterError, read_peptide_file
 from protect.pipeline.ProTECT import _parse_config_file
-from protect.rankboost import wrap_rankboost
+from protect.rankboost import (_count_overlaps,
+                               boost_iar_ranks,
+                               compute_iar_features,
+                               read_merged_calls,
+                               wrap_rankboost,
+                               write_rankboost_results)
 from protect.test import ProtectTest
 from toil.job import Job
 
+import numpy as np
 import os
+import pandas
 import subprocess
 
 
 class TestRankboost(ProtectTest):
     def setUp(self):
         super(TestRankboost, self).setUp()
-        test_dir = self._createTempDir()
+        self.test_dir = self._createTempDir()
         self.options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
         self.options.logLevel = 'INFO'
-        self.options.workDir = test_dir
+        self.options.workDir = self.test_dir
         self.options.clean = 'always'
 
     def test_rank_boost(self):
@@ -61,6 +69,107 @@ class TestRankboost(ProtectTest):
         e.addChild(f)
         Job.Runner.startToil(a, self.options)
 
+    def test_count_overlaps(self):
+        """
+        Test that _count_overlaps counts every pair of overlapping spans once.
+        """
+        self.assertEqual(_count_overlaps(np.array([0, 2, 5, 10]), np.array([4, 6, 9, 13])), 2)
+        # Nested spans, and spans that only touch
+        self.assertEqual(_count_overlaps(np.array([0, 1, 2]), np.array([10, 3, 4])), 3)
+        self.assertEqual(_count_overlaps(np.array([0, 5]), np.array([5, 10])), 0)
+        self.assertEqual(_count_overlaps(np.array([], dtype=int), np.array([], dtype=int)), 0)
+
+    def _get_test_features(self):
+        """
+        Compute the features of 3 IARs from a file of merged calls.
+
+        :return: The features of each IAR, indexed by IAR name
+        :rtype: pandas.DataFrame
+        """
+        calls = [
+            # Bind better than their normals (the second is a fusion with no normal), and overlap
+            ['HLA-A*01:01', 'AAAAC', 'AAAAG', 'IAR1', 'AAAAC', '0', '0.5', '5.0'],
+            ['HLA-A*01:01', 'CCCDD', 'NA', 'IAR1', 'CCCDD', '0', '0.8', 'NA'],
+            ['HLA-A*02:01', 'AAAAC', 'AAAAG', 'IAR1', 'AAAAC', '0', '2.0', '2.5'],
+            ['HLA-A*01:01', 'DDDD', 'DDDE', 'IAR1', 'DDDD', '0', '3.0', '3.0'],
+            ['HLA-A*01:01', 'EEEF', 'EEEG', 'IAR2', 'EEEF', '0', '1.5', '1.0'],
+            ['HLA-A*03:01', 'GGGH', 'GGGI', 'IAR3', 'GGGH', '0', '0.2', '0.3']]
+        transcripts = {'IAR1': ['ENSG1', 'ENST1.2', 'GENE1', 'A1B'],
+                       'IAR2': ['ENSG2', 'ENST2.1', 'GENE2', 'C2D'],
+                       'IAR3': ['ENSG3', 'ENST3.4', 'GENE3', 'E3F']}
+        merged_calls = os.path.join(self.test_dir, 'mhci_merged_files.list')
+        with open(merged_calls, 'w') as out_file:
+            for call in calls:
+                print(*(call + transcripts[call[3]]), sep='\t', file=out_file)
+        peptide_file = os.path.join(self.test_dir, 'peptides.faa')
+        with open(peptide_file, 'w') as out_file:
+            print('>IAR1\nAAAACCCCDDDD\n>IAR2\nEEEEFFFF\n>IAR3\nGGGGHHHH', file=out_file)
+        calls = read_merged_calls(merged_calls)
+        self.assertEqual(list(calls['transcript_id'].unique()), ['ENST1', 'ENST2', 'ENST3'])
+        with read_peptide_file(peptide_file) as peptides:
+            return compute_iar_features(calls, peptides, pandas.Series({'ENST1': 10.0,
+                                                                        'ENST3': 100.0}))
+
+    def test_compute_iar_features(self):
+        """
+        Test that compute_iar_features computes every feature for each IAR, and fills in the ones
+        without any qualifying calls with 0.
+        """
+        features = self._get_test_features().set_index('pname')
+        self.assertEqual(list(features.index), ['IAR1', 'IAR2', 'IAR3'])
+        self.assertEqual(list(features['transcript_id']), ['ENST1', 'ENST2', 'ENST3'])
+        expected = {'best_pred': [0.5, 1.5, 0.2],
+                    'npa': [3, 1, 1],
+                    'nph': [2, 0, 1],
+                    'nMHC': [2, 1, 1],
+                    'TPM': [10.0, 0.0, 100.0],
+                    # Only CCCDD and DDDD overlap
+                    'overlap': [1, 0, 0],
+                    'tndelta': [2, 0, 0]}
+        for feature, values in expected.items():
+            self.assertEqual(list(features[feature]), values, feature)
+
+    def test_boost_iar_ranks(self):
+        """
+        Test that boost_iar_ranks starts the IARs at the rank of their best prediction and moves
+        them towards their rank for each weighted feature.
+        """
+        features = self._get_test_features()
+        ranked = boost_iar_ranks(features, {})
+        self.assertEqual(list(ranked['pname']), ['IAR3', 'IAR1', 'IAR2'])
+        self.assertEqual(list(ranked['rank']), [1, 2, 3])
+        self.assertEqual(list(ranked['score']), [1.0, 2.0, 3.0])
+        # IAR1 has the most peptides and altered-self calls.  IAR2 and IAR3 tie on both and on the
+        # score, so IAR3 goes first on its better base rank.
+        ranked = boost_iar_ranks(features, {'npa': 0.5, 'tndelta': 0.5, 'TPM': 0})
+        self.assertEqual(list(ranked['pname']), ['IAR1', 'IAR3', 'IAR2'])
+        self.assertEqual(list(ranked['score']), [1.0, 2.0, 2.0])
+        self.assertEqual(list(ranked['base_rank']), [2.0, 1.0, 3.0])
+        self.assertEqual(list(ranked['rank']), [1, 2, 3])
+        # The input isn't modified
+        self.assertFalse('score' in features)
+        self.assertRaises(ParameterError, boost_iar_ranks, features, {'npa': 0.5, 'foo': 0.5})
+
+    def test_write_rankboost_results(self):
+        """
+        Test that write_rankboost_results writes the reports under the native names and not those
+        of the rankboost container's reports, with the IARs in rank order.
+        """
+        features = self._get_test_features()
+        calls = read_merged_calls(os.path.join(self.test_dir, 'mhci_merged_files.list'))
+        out_dir = os.path.join(self.test_dir, 'reports')
+        os.mkdir(out_dir)
+        reports = write_rankboost_results(boost_iar_ranks(features, {}), calls, 'mhci', out_dir)
+        self.assertEqual(sorted(reports), ['mhci_native_rankboost_concise_results.tsv',
+                                           'mhci_native_rankboost_detailed_results.txt'])
+        self.assertEqual(sorted(os.listdir(out_dir)), sorted(reports))
+        concise = pandas.read_table(reports['mhci_native_rankboost_concise_results.tsv'])
+        self.assertEqual(list(concise['pname']), ['IAR3', 'IAR1', 'IAR2'])
+        with open(reports['mhci_native_rankboost_detailed_results.txt']) as in_file:
+            iars = [x.split('\t')[1] for x in in_file if x.startswith('#') and
+                    not x.startswith('# ')]
+        self.assertEqual(iars, ['IAR3', 'IAR1', 'IAR2'])
+
     @staticmethod
     def _get_all_tools(job, config_file):
         sample_set, univ_options, tool_options = _parse_config_file(job, config_file,
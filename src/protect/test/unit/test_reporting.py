@@ -21,13 +21,19 @@ File : protect/test/test_reporting.py
 from __future__ import print_function
 
 import os
+import textwrap
+from collections import OrderedDict
 
+import pandas as pd
 from toil.job import Job
 
-from protect.addons.assess_car_t_validity import assess_car_t_validity
-from protect.addons.assess_immunotherapy_resistance import assess_itx_resistance
-from protect.addons.assess_mhc_pathway import assess_mhc_genes
+from protect.addons.assess_car_t_validity import (assess_car_t_validity,
+                                                  write_car_t_validity_report)
+from protect.addons.assess_immunotherapy_resistance import (assess_itx_resistance,
+                                                            write_itx_resistance_report)
+from protect.addons.assess_mhc_pathway import assess_mhc_genes, write_mhc_pathway_report
 from protect.common import get_file_from_s3, untargz
+from protect.haplotyping.phlat import parse_phlat_file
 from protect.pipeline.ProTECT import _parse_config_file
 from protect.test import ProtectTest
 
@@ -35,10 +41,10 @@ from protect.test import ProtectTest
 class TestReporting(ProtectTest):
     def setUp(self):
         super(TestReporting, self).setUp()
-        test_dir = self._createTempDir()
+        self.test_dir = self._createTempDir()
         self.options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
         self.options.logLevel = 'INFO'
-        self.options.workDir = test_dir
+        self.options.workDir = self.test_dir
         self.options.clean = 'always'
 
     def test_mhc_assessment(self):
@@ -104,6 +110,150 @@ class TestReporting(ProtectTest):
         # d.addChild(e)
         Job.Runner.startToil(a, self.options)
 
+    def _get_test_haplotype(self):
+        """
+        Parse the test haplotype file.
+
+        :return: The alleles called per MHC gene
+        :rtype: dict
+        """
+        test_src_folder = os.path.join(self._projectRootPath(), 'src', 'protect', 'test')
+        rna_haplotype = untargz(os.path.join(test_src_folder,
+                                             'test_inputs/test_mhc_haplotype.sum.tar.gz'),
+                                self.test_dir)
+        with open(rna_haplotype) as rna_mhc:
+            return parse_phlat_file(rna_mhc, {'HLA_A': [], 'HLA_B': [], 'HLA_C': [], 'HLA_DPA': [],
+                                              'HLA_DQA': [], 'HLA_DPB': [], 'HLA_DQB': [],
+                                              'HLA_DRB': []})
+
+    @staticmethod
+    def _expression(tpms):
+        return pd.DataFrame({'TPM': tpms.values()}, index=tpms.keys())
+
+    def test_write_mhc_pathway_report(self):
+        """
+        Test that write_mhc_pathway_report makes the calls expected of the test inputs in
+        test_mhc_assessment from the haplotype and the expression.
+        """
+        background = pd.DataFrame(
+            OrderedDict([('Name', ['TNF', 'CTSL', 'HLA_DRA', 'TAP1', 'B2M']),
+                         ('Roles', ['MHC activators', 'MHCII loading', 'MHCII loading',
+                                    'MHCI loading', 'MHCI loading,MHC activators']),
+                         ('Stomach', [5.0, 10.0, 3.0, 1.0, 1.0]),
+                         ('STAD normal', [4.0, 20.0, 3.004, 1.0, 1.0])]),
+            index=['ENSG1', 'ENSG2', 'ENSG3', 'ENSG4', 'ENSG5'])
+        report = os.path.join(self.test_dir, 'mhc_pathway_report.txt')
+        with open(report, 'w') as mpr:
+            write_mhc_pathway_report(self._expression({'ENSG1': 1.0, 'ENSG2': 50.0,
+                                                       'ENSG3': 3.0}),
+                                     background, self._get_test_haplotype(), 'STAD', mpr)
+        self._check_mhc_pathway_report(report)
+        with open(report) as in_file:
+            lines = in_file.read().splitlines()
+        row = '{:12}{:<12}{:<17}{:<12}{:<20}{:<17}'
+        # Thresholds are compared at 2 decimal places, and genes without expression are at 0
+        self.assertTrue(row.format('HLA_DRA', 3.0, '3.00', 'LOW', '3.00', 'LOW') in lines)
+        self.assertTrue(row.format('CTSL', 50.0, '10.00', 'PASS', '20.00', 'PASS') in lines)
+        # B2M is reported under both its roles
+        self.assertEqual(lines.count(row.format('B2M', 0.0, '1.00', 'LOW', '1.00', 'LOW')), 2)
+        self.assertTrue(row.format('HLA_DQA', 2, 0, 'FAIL', 2, 'FAIL') in lines)
+
+        # Without a haplotype, or backgrounds for the tumor type
+        with open(report, 'w') as mpr:
+            write_mhc_pathway_report(self._expression({'ENSG1': 1.0}), background, None, 'OV', mpr)
+        with open(report) as in_file:
+            lines = in_file.read().splitlines()
+        self.assertTrue(row.format('HLA_A', 2, 'NA', 'NA', 2, 'NA') in lines)
+        self.assertTrue(row.format('TNF', 1.0, 'NA', 'NA', 'NA', 'NA') in lines)
+        self.assertTrue(row.format('CTSL', 0.0, 'NA', 'NA', 'NA', 'NA') in lines)
+
+    def test_write_itx_resistance_report(self):
+        """
+        Test that write_itx_resistance_report lists the genes of each pathway for the tumor type
+        with their backgrounds, and calls the pathways with enough genes expressed beyond both
+        backgrounds in the right direction.
+        """
+        json_data = {'Cancer_to_pathway': {'STAD': ['P1', 'P2']},
+                     'Pathways': {
+                         'P1': {'paper': 'doi:1', 'description': 'Pathway one ' * 10,
+                                'genes': OrderedDict([('ENSG1', 'GENE1'), ('ENSG2', 'GENE2')]),
+                                'up_is_good': True,
+                                'status': {'True': 'P1 is active', 'False': 'P1 is inactive'}},
+                         'P2': {'paper': 'doi:2', 'description': 'Pathway two',
+                                'genes': OrderedDict([('ENSG3', 'GENE3'), ('ENSG4', 'GENE4')]),
+                                'up_is_good': False,
+                                'status': {'True': 'P2 is active', 'False': 'P2 is inactive'}}}}
+        full_data = pd.DataFrame({'Stomach': [5.0, 1.0, 5.0, 5.0],
+                                  'STAD normal': [4.0, 2.0, 5.0, 5.0]},
+                                 index=['ENSG1', 'ENSG2', 'ENSG3', 'ENSG4'])
+        expression = self._expression({'ENSG1': 10.0, 'ENSG2': 2.0, 'ENSG3': 1.0})
+        report = os.path.join(self.test_dir, 'immunotherapy_resistance_report.txt')
+        with open(report, 'w') as report_file:
+            write_itx_resistance_report(expression, full_data, json_data, 'STAD', report_file)
+        row = '\t{:10}{:<20}{:<20}{:<12}'
+        # P2 is not called since ENSG4 has no expression
+        expected = ['Pathway: P1', '', 'Papers: doi:1', 'Description of pathway:'] + \
+            textwrap.fill('Pathway one ' * 10, width=100).splitlines() + [
+                'Pathway genes: ',
+                row.format('Gene', 'GTEX Median', 'TCGA N Median', 'Observed'),
+                row.format('GENE1', '5.00', '4.00', '10.00'),
+                row.format('GENE2', '1.00', '2.00', '2.00'),
+                'Status: P1 is active', '',
+                'Pathway: P2', '', 'Papers: doi:2', 'Description of pathway:', 'Pathway two',
+                'Pathway genes: ',
+                row.format('Gene', 'GTEX Median', 'TCGA N Median', 'Observed'),
+                row.format('GENE3', '5.00', '5.00', '1.00'),
+                row.format('GENE4', '5.00', '5.00', 'NA'),
+                'Status: P2 is inactive', '']
+        with open(report) as in_file:
+            self.assertEqual(in_file.read().splitlines(), expected)
+
+        with open(report, 'w') as report_file:
+            write_itx_resistance_report(expression, full_data, json_data, 'OV', report_file)
+        with open(report) as in_file:
+            self.assertEqual(in_file.read().splitlines(), ['Data not available for OV'])
+
+    def test_write_car_t_validity_report(self):
+        """
+        Test that write_car_t_validity_report lists the targets for the tissue of origin by
+        expression, and the trials in other cancers for the overexpressed ones.
+        """
+        target_data = pd.DataFrame(
+            OrderedDict([('TARGET', ['cldn18', 'her2', 'msln', 'her2', 'cldn18']),
+                         ('GTEX', [5.0, 50.0, 1.0, 1.0, 2.0]),
+                         ('TCGA', [6.0, 60.0, 1.0, 2.0, 3.0]),
+                         ('ENSG', ['ENSG5', 'ENSG6', 'ENSG7', 'ENSG6', 'ENSG5']),
+                         ('DOI', ['doi:5', 'doi:6', 'doi:7', 'doi:8', 'doi:9']),
+                         ('Clinical trials', ['NCT5', 'NCT6', 'NCT7', 'NCT8', 'NCT9'])]),
+            index=pd.Index(['Stomach', 'Stomach', 'Stomach', 'Breast', 'Lung'], name='Tissue'))
+        expression = self._expression({'ENSG5': 10.0, 'ENSG6': 3.0})
+        report = os.path.join(self.test_dir, 'car_t_target_report.txt')
+        with open(report, 'w') as car_t_report:
+            write_car_t_validity_report(expression, target_data, 'STAD', car_t_report)
+        row = '\t{:10}{:<10}{:<10}{:<10}{:<40}{:<12}'
+        other_row = '\t{:10}{:<10}{:<10}{:<10}{:<40}{:<17}{:<20}'
+        # Only CLDN18 is overexpressed in the stomach
+        expected = [
+            'Available clinical trials for stomach cancer with GTEX and TCGA median values',
+            row.format('Gene', 'GTEX', 'TCGA N', 'Observed', 'DOI for gene papers',
+                       'Clinical Trials'), '',
+            row.format('CLDN18', '5.00', '6.00', '10.00', 'doi:5', 'NCT5'),
+            row.format('HER2', '50.00', '60.00', '3.00', 'doi:6', 'NCT6'),
+            row.format('MSLN', '1.00', '1.00', 'NA', 'doi:7', 'NCT7'),
+            '',
+            'Based on the genes overexpressed in this cancer type, here\'s a list of clinical '
+            'trials for other types of cancer',
+            other_row.format('Gene', 'GTEX', 'TCGA N', 'Observed', 'DOI for gene papers',
+                             'Clinical Trials', 'Cancer'), '',
+            other_row.format('CLDN18', '2.00', '3.00', '10.00', 'doi:9', 'NCT9', 'Lung')]
+        with open(report) as in_file:
+            self.assertEqual(in_file.read().splitlines(), expected)
+
+        with open(report, 'w') as car_t_report:
+            write_car_t_validity_report(expression, target_data, 'OV', car_t_report)
+        with open(report) as in_file:
+            self.assertEqual(in_file.read().splitlines(), ['Data not available for OV'])
+
     @staticmethod
     def _get_all_tools(job, config_file):
         sample_set, univ_options, tool_options = _parse_config_file(job, config_file,
@@ -151,6 +301,15 @@ class TestReporting(ProtectTest):
         print(os.listdir(os.path.join(univ_options['output_folder'], 'test/reports')))
         assert os.path.exists(os.path.join(univ_options['output_folder'], 'test/reports',
                                            'mhc_pathway_report.txt'))
+        TestReporting._check_mhc_pathway_report(outfile)
+
+    @staticmethod
+    def _check_mhc_pathway_report(outfile):
+        """
+        Check the calls in an mhc pathway report made on the test inputs.
+
+        :param str outfile: Path to the report
+        """
         # Ensure that the 2 input genes were processed correctly
         outdict = {}
         with open(outfile) as o_f:
@@ -0,0 +1,82 @@
+#!/usr/bin/env python2.7
+# Copyright 2016 Arjun Arkal Rao
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Author : Arjun Arkal Rao
+Affiliation : UCSC BME, UCSC Genomics Institute
+File : protect/test/test_rsem.py
+"""
+from __future__ import print_function
+
+from protect.expression_profiling.rsem import (load_gene_expression,
+                                               load_isoform_expression,
+                                               write_expression_table)
+from protect.test import ProtectTest
+
+import os
+import zipfile
+
+
+class TestRsem(ProtectTest):
+    def setUp(self):
+        super(TestRsem, self).setUp()
+        self.test_dir = self._createTempDir()
+
+    def _write(self, name, lines):
+        path = os.path.join(self.test_dir, name)
+        with open(path, 'w') as out_file:
+            for line in lines:
+                print(*line, sep='\t', file=out_file)
+        return path
+
+    def test_expression_table(self):
+        """
+        Test that write_expression_table stores the gene and isoform expression with versionless
+        ids, summing the ids that only differ in version, and that load_*_expression read the same
+        values from the table and from the rsem results.
+        """
+        genes = self._write('rsem.genes.results', [
+            ('gene_id', 'transcript_id(s)', 'length', 'effective_length', 'expected_count', 'TPM',
+             'FPKM'),
+            ('ENSG1.5', 'ENST1.1,ENST2.3', '1000', '900', '100.00', '10.00', '8.00'),
+            ('ENSG2.1', 'ENST3.2', '500', '400', '0.00', '0.00', '0.00'),
+            # The PAR_Y copy of ENSG3
+            ('ENSG3.7', 'ENST4.1', '200', '100', '5.00', '1.50', '1.00'),
+            ('ENSG3.7_PAR_Y', 'ENST4.1_PAR_Y', '200', '100', '1.00', '0.50', '0.25')])
+        isoforms = self._write('rsem.isoforms.results', [
+            ('transcript_id', 'gene_id', 'length', 'effective_length', 'expected_count', 'TPM',
+             'FPKM', 'IsoPct'),
+            ('ENST1.1', 'ENSG1.5', '600', '500', '60.00', '6.00', '5.00', '60.00'),
+            ('ENST2.3', 'ENSG1.5', '400', '300', '40.00', '4.00', '3.00', '40.00'),
+            ('ENST3.2', 'ENSG2.1', '500', '400', '0.00', '0.00', '0.00', '0.00'),
+            ('ENST4.1', 'ENSG3.7', '200', '100', '5.00', '1.50', '1.00', '100.00'),
+            ('ENST4.1_PAR_Y', 'ENSG3.7_PAR_Y', '200', '100', '1.00', '0.50', '0.25', '100.00')])
+        table = os.path.join(self.test_dir, 'rsem.expression.npz')
+        write_expression_table(genes, isoforms, table)
+        self.assertTrue(zipfile.is_zipfile(table))
+
+        for source in table, genes:
+            expression = load_gene_expression(source).sort_index()
+            self.assertEqual(list(expression.index), ['ENSG1', 'ENSG2', 'ENSG3'])
+            self.assertEqual(list(expression['expected_count']), [100.0, 0.0, 6.0])
+            self.assertEqual(list(expression['TPM']), [10.0, 0.0, 2.0])
+            self.assertEqual(list(expression['FPKM']), [8.0, 0.0, 1.25])
+        for source in table, isoforms:
+            expression = load_isoform_expression(source).sort_index()
+            self.assertEqual(list(expression.index), ['ENST1', 'ENST2', 'ENST3', 'ENST4'])
+            self.assertEqual(list(expression['gene_id']), ['ENSG1', 'ENSG1', 'ENSG2', 'ENSG3'])
+            self.assertEqual(list(expression['expected_count']), [60.0, 40.0, 0.0, 6.0])
+            self.assertEqual(list(expression['TPM']), [6.0, 4.0, 0.0, 2.0])
+            self.assertEqual(list(expression['FPKM']), [5.0, 3.0, 0.0, 1.25])
@@ -20,7 +20,9 @@ File : protect/test/test_snpeff.py
 """
 from __future__ import print_function
 
-from protect.mutation_annotation.snpeff import run_snpeff
+from protect.mutation_annotation.snpeff import (read_annotation_cache,
+                                                run_snpeff,
+                                                update_annotation_cache)
 from protect.pipeline.ProTECT import _parse_config_file
 from protect.test import ProtectTest
 from toil.job import Job
@@ -59,6 +61,44 @@ class TestSnpeff(ProtectTest):
         c.addChild(d)
         Job.Runner.startToil(a, self.options)
 
+    def test_annotation_cache(self):
+        """
+        Test that annotations added to the snpeff annotation cache are read back for the requested
+        chromosomes, and that a partial line left by a failed write is skipped, and dropped by the
+        next update.
+        """
+        cache_dir = os.path.join(self._createTempDir(), 'hg19_3.6')
+        self.assertEqual(read_annotation_cache(cache_dir, {'chr1'}),
+                         {'annotations': {}, 'header': None})
+        header = ['##SnpEffVersion="3.6"\n', '##INFO=<ID=EFF,Number=.,Type=String>\n']
+        update_annotation_cache(cache_dir, header,
+                                {('chr1', '100', 'A', 'T'): 'NON_SYNONYMOUS_CODING(MODERATE)',
+                                 ('chr2', '200', 'C', 'G'): ''})
+        # The header is only written by the first update
+        update_annotation_cache(cache_dir, ['##other\n'],
+                                {('chr1', '300', 'G', 'GA'): 'FRAME_SHIFT(HIGH)'})
+        with open(os.path.join(cache_dir, 'chr1.tsv'), 'a') as outfile:
+            outfile.write('400\tC\tT\tSTOP_GAI')
+        self.assertEqual(read_annotation_cache(cache_dir, {'chr1', 'chrX'}),
+                         {'annotations': {('chr1', '100', 'A', 'T'):
+                                              'NON_SYNONYMOUS_CODING(MODERATE)',
+                                          ('chr1', '300', 'G', 'GA'): 'FRAME_SHIFT(HIGH)'},
+                          'header': header})
+        self.assertEqual(read_annotation_cache(cache_dir, {'chr2'})['annotations'],
+                         {('chr2', '200', 'C', 'G'): ''})
+        # The next update doesn't append onto the partial line
+        update_annotation_cache(cache_dir, header, {('chr1', '500', 'T', 'C'): 'INTRON(MODIFIER)'})
+        self.assertEqual(read_annotation_cache(cache_dir, {'chr1'})['annotations'],
+                         {('chr1', '100', 'A', 'T'): 'NON_SYNONYMOUS_CODING(MODERATE)',
+                          ('chr1', '300', 'G', 'GA'): 'FRAME_SHIFT(HIGH)',
+                          ('chr1', '500', 'T', 'C'): 'INTRON(MODIFIER)'})
+        # A file that is all partial line
+        with open(os.path.join(cache_dir, 'chr3.tsv'), 'w') as outfile:
+            outfile.write('600\tG')
+        update_annotation_cache(cache_dir, header, {('chr3', '700', 'A', 'G'): ''})
+        self.assertEqual(read_annotation_cache(cache_dir, {'chr3'})['annotations'],
+                         {('chr3', '700', 'A', 'G'): ''})
+
     @staticmethod
     def _get_all_tools(job, config_file):
         sample_set, univ_options, tool_options = _parse_config_file(job, config_file,